@@ -1,10 +1,11 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_file
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import Flask, Response, g, render_template, request, redirect, url_for, flash, session, jsonify, send_file, get_template_attribute, stream_with_context
 from werkzeug.utils import secure_filename
+from sqlalchemy.orm import joinedload
 from datetime import datetime, timezone
+import io
 import os
 import json
-import requests
+import time
 # note: credentials are hardcoded below, environment variables no longer used
 
 app = Flask(__name__)
@@ -13,6 +14,9 @@ app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://reach_2_user:LPxy8sWuWo9zI
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['CONSULTATION_PAGE_SIZE'] = 20  # rows per page in consultation lists
+app.config['MESSAGE_POLL_MAX_WAIT'] = 25  # longest a message long-poll may wait, in seconds
+app.config['MESSAGE_POLL_INTERVAL'] = 1  # seconds between checks while a long-poll waits
 
 # email settings (EmailJS API) - hardcoded credentials
 app.config.update({
@@ -23,40 +27,8 @@ app.config.update({
     'MAIL_DEFAULT_SENDER': 'noreply@yourdomain.com'
 })
 
-def send_email(subject, body, recipients):
-    if not recipients:
-        return
-    try:
-        # Convert list to comma-separated string if needed
-        recipient_str = recipients if isinstance(recipients, str) else ', '.join(recipients)
-        print(f"DEBUG: Sending email to {recipient_str} with subject '{subject}'")
-        
-        url = "https://api.emailjs.com/api/v1.0/email/send"
-        data = {
-            "service_id": app.config['EMAILJS_SERVICE_ID'],
-            "template_id": app.config['EMAILJS_TEMPLATE_ID'],
-            "user_id": app.config['EMAILJS_USER_ID'],
-            "accessToken": app.config['EMAILJS_ACCESS_TOKEN'],
-            "template_params": {
-                "to_email": recipient_str,
-                "subject": subject,
-                "message": body
-            }
-        }
-        
-        headers = {"Content-Type": "application/json"}
-        response = requests.post(url, json=data, headers=headers, timeout=10)
-        
-        print(f"DEBUG: EmailJS response status: {response.status_code}")
-        print(f"DEBUG: EmailJS response text: {response.text}")
-        
-        if response.status_code not in [200, 201, 202]:
-            raise Exception(f"EmailJS error: {response.text}")
-        
-        print(f"DEBUG: Email sent successfully to {recipient_str}")
-    except Exception as e:
-        print(f"DEBUG: Email send error: {e}")
-        raise
+# Optional overrides for local runs and benchmarks, e.g. FLASK_SQLALCHEMY_DATABASE_URI=sqlite:///local.db
+app.config.from_prefixed_env()
 
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -65,77 +37,90 @@ os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'attachments'), exist_ok=T
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx'}
 
 # Import models after app config
-from models import db, User, Teacher, Student, Consultation, ConsultationMessage
+from models import db, User, Teacher, Student, Consultation, ConsultationMessage, MessageAttachment
+import teacher_stats
+from categories import CATEGORY_DATA, get_subcategory_label, category_keys
+import consultation_search
+from pagination import paginate_newest_first
+import email_outbox
+import migrations
+import attachment_store
+import reference_cache
+import passwords
+import live_events
+import student_roster
+import category_trends
+import instrumentation
+import db_pool
+import db_routing
+import identity
+from db_routing import use_replica
+from identity import login_required
+# Engine options have to be in place before db.init_app creates the engine
+pool_metrics = db_pool.init_app(app)
+db_routing.init_app(app)
 db.init_app(app)
+migrations.init_app(app)
+teacher_stats.init_app(app)
+outbox_worker = email_outbox.init_app(app)
+attachments = attachment_store.init_app(app)
+reference_data = reference_cache.init_app(app)
+password_hasher = passwords.init_app(app)
+event_broker = live_events.init_app(app)
+student_roster.init_app(app)
+category_trends.init_app(app)
+identity.init_app(app)
+request_metrics = instrumentation.init_app(app)
+request_metrics.register_gauges('reference_cache', reference_data.stats)
+request_metrics.register_gauges('live_events', lambda: {'subscribers': event_broker.subscriber_count()})
+request_metrics.register_gauges('db_pool', lambda: pool_metrics.stats(db.engine))
+request_metrics.register_gauges('emailjs', outbox_worker.client.stats)
+
+
+def start_serving():
+    """Prepare a serving process; CLI commands and scripts importing app skip this"""
+    with app.app_context():
+        # Open the pools now, not on the first requests
+        for engine in db.engines.values():
+            db_pool.warm_up(engine, app.config['DB_POOL_WARM_UP'])
+    if app.config['EMAIL_OUTBOX_IN_PROCESS']:
+        # Send retries and digests left over from before a restart without waiting for a new email
+        outbox_worker.start()
+
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# Category data for consultation mapping
-CATEGORY_DATA = {
-    'family': {
-        'label': 'Family & Home Situation',
-        'subcategories': {
-            'family_pressure': 'Pressure from Parents or Guardians',
-            'family_arguments': 'Frequent Arguments at Home',
-            'family_away': 'Living Away from Parents / Guardians',
-            'family_unsupported': 'Feeling Unsupported at Home',
-            'family_financial': 'Financial Difficulties Affecting Family'
-        }
-    },
-    'school': {
-        'label': 'School & Academic Concerns',
-        'subcategories': {
-            'school_requirements': 'Too Many School Requirements',
-            'school_difficulty': 'Difficulty Keeping Up with Lessons',
-            'school_fear': 'Fear of Disappointing Teachers or Parents',
-            'school_time': 'Trouble Managing Time',
-            'school_grades': 'Worry About Grades or Performance'
-        }
-    },
-    'peers': {
-        'label': 'Peer & Social Relationships',
-        'subcategories': {
-            'peers_problems': 'Problems with Friends',
-            'peers_ignored': 'Feeling Left Out or Ignored',
-            'peers_conflict': 'Conflict with Classmates',
-            'peers_teased': 'Being Teased or Treated Unfairly',
-            'peers_pressure': 'Pressure to Fit In'
-        }
-    },
-    'personal': {
-        'label': 'Personal Feelings & Daily Struggles',
-        'subcategories': {
-            'personal_overwhelmed': 'Feeling Overwhelmed by Responsibilities',
-            'personal_feelings': 'Difficulty Expressing Feelings',
-            'personal_unmotivated': 'Feeling Unmotivated or Tired Most Days',
-            'personal_focus': 'Trouble Focusing or Concentrating',
-            'personal_misunderstood': 'Feeling Misunderstood'
-        }
-    },
-    'life_changes': {
-        'label': 'Life Changes & Adjustments',
-        'subcategories': {
-            'changes_senior_high': 'Adjusting to Senior High School',
-            'changes_home_school': 'Changes at Home or School',
-            'changes_responsibilities': 'New Responsibilities',
-            'changes_routine': 'Loss of Routine or Structure',
-            'changes_future': 'Preparing for the Future'
-        }
-    },
-    'other': {
-        'label': 'Other',
-        'subcategories': {
-            'other_concern': 'Something Else I Want to Talk About'
-        }
-    }
-}
-
-def get_subcategory_label(category, subcategory):
-    """Get the full descriptive label for a subcategory"""
-    if category in CATEGORY_DATA and subcategory in CATEGORY_DATA[category]['subcategories']:
-        return CATEGORY_DATA[category]['subcategories'][subcategory]
-    return subcategory.replace('_', ' ').title()
+def versioned_json(version, payload):
+    """JSON response with a strong ETag; answers a matching If-None-Match with 304 without serializing payload"""
+    if request.if_none_match.contains(version):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(payload)
+    response.set_etag(version)
+    # Let browsers keep the body but revalidate on every use
+    response.cache_control.no_cache = True
+    return response
+
+def publish_consultation_update(consultation, name, previous_status=None):
+    """Queue a dashboard event for the consultation's teacher and student, sent when the session commits"""
+    for channel, macro in ((f'teacher:{consultation.teacher_id}', 'teacher_item'),
+                           (f'student:{consultation.student_id}', 'student_item')):
+        live_events.publish_after_commit(channel, name, {
+            'id': consultation.id,
+            'status': consultation.status,
+            'previous_status': previous_status,
+            'html': str(get_template_attribute('_consultation_items.html', macro)(consultation))
+        })
+
+@app.errorhandler(passwords.HashingBusy)
+def password_hashing_busy(error):
+    # Every hashing slot stayed taken for PASSWORD_HASH_QUEUE_TIMEOUT seconds, e.g. a login storm
+    app.logger.warning(f'Password hashing queue full on {request.path}')
+    flash('The server is busy right now. Please try again in a moment.', 'error')
+    response = redirect(request.url)
+    response.headers['Retry-After'] = '5'
+    return response
 
 # Database initialization will happen in main block
 
@@ -202,13 +187,13 @@ def register():
                 flash('Passwords do not match', 'error')
                 return redirect(url_for('register'))
             
-            if User.query.filter_by(email=email).first():
+            if User.find_by_email(email):
                 flash('Email already registered', 'error')
                 return redirect(url_for('register'))
             
             user = User(
                 email=email,
-                password_hash=generate_password_hash(password),
+                password_hash=password_hasher.hash(password),
                 user_type='student'
             )
             db.session.add(user)
@@ -232,6 +217,7 @@ def register():
             )
             db.session.add(student)
             db.session.commit()
+            reference_data.invalidate_sections()
             
             flash('Registration successful! Please login.', 'success')
             return redirect(url_for('login'))
@@ -277,13 +263,13 @@ def register():
                 availability = None
                 specialization = None
             
-            if User.query.filter_by(email=email).first():
+            if User.find_by_email(email):
                 flash('Email already registered', 'error')
                 return redirect(url_for('register'))
             
             user = User(
                 email=email,
-                password_hash=generate_password_hash(password),
+                password_hash=password_hasher.hash(password),
                 user_type='teacher'
             )
             db.session.add(user)
@@ -302,6 +288,8 @@ def register():
             )
             db.session.add(teacher)
             db.session.commit()
+            if is_guidance_advocate:
+                reference_data.invalidate_advocates()
             
             flash('Registration successful! Please login.', 'success')
             return redirect(url_for('login'))
@@ -318,16 +306,17 @@ def login():
             flash('Please enter both email and password', 'error')
             return render_template('login.html')
         
-        # Try exact match first, then case-insensitive
-        user = User.query.filter_by(email=email).first()
-        if not user:
-            # Try case-insensitive search for emails stored before normalization
-            user = User.query.filter(db.func.lower(User.email) == email).first()
+        user = User.find_by_email(email)
         
         if user:
             # Check password
-            password_valid = check_password_hash(user.password_hash, password)
+            password_valid = password_hasher.verify(user.password_hash, password)
             if password_valid:
+                # Upgrade hashes made with an older method or cost while we have the plain password
+                if password_hasher.needs_rehash(user.password_hash):
+                    user.password_hash = password_hasher.hash(password)
+                    db.session.commit()
+                
                 session['user_id'] = user.id
                 session['user_type'] = user.user_type
                 session['user_email'] = user.email
@@ -351,50 +340,30 @@ def logout():
 
 @app.route('/api/sections/<int:grade>')
 def get_sections(grade):
-    sections = db.session.query(Student.section).filter_by(grade=grade).distinct().all()
-    section_list = [s[0] for s in sections]
-    # Add common sections if none exist
-    if not section_list:
-        section_list = ['A', 'B', 'C', 'D', 'E']
-    return jsonify({'sections': sorted(section_list)})
+    # Falls back to common sections if the grade has no students yet
+    version, sections = reference_data.versioned_sections(grade)
+    return versioned_json(version, {'sections': sections})
 
 @app.route('/api/guidance-advocates')
 def get_guidance_advocates():
-    advocates = Teacher.query.filter_by(is_guidance_advocate=True).all()
-    advocates_data = [
-        {
-            'id': advocate.id,
-            'name': advocate.full_name(),
-            'email': advocate.user.email,
-            'availability': advocate.availability,
-            'specialization': advocate.specialization,
-            'handling_section': advocate.handling_section,
-            'handling_grade': advocate.handling_grade
-        }
-        for advocate in advocates
-    ]
-    return jsonify({'advocates': advocates_data})
+    version, advocates = reference_data.versioned_advocates()
+    return versioned_json(version, {'advocates': advocates})
 
 @app.route('/student/dashboard')
+@login_required('student')
 def student_dashboard():
-    if 'user_id' not in session or session.get('user_type') != 'student':
-        return redirect(url_for('login'))
+    student = g.identity.profile
     
-    student = Student.query.filter_by(user_id=session['user_id']).first()
-    if not student:
-        return redirect(url_for('login'))
-    
-    consultations = Consultation.query.filter_by(student_id=student.id, deleted=False).order_by(Consultation.created_at.desc()).all()
-    return render_template('student_dashboard.html', student=student, consultations=consultations)
+    page = paginate_newest_first(
+        Consultation.query.filter_by(student_id=student.id, deleted=False),
+        Consultation, limit=app.config['CONSULTATION_PAGE_SIZE']
+    )
+    return render_template('student_dashboard.html', student=student, consultations=page.items, next_cursor=page.next_cursor)
 
 @app.route('/student/consultation/new', methods=['GET', 'POST'])
+@login_required('student')
 def new_consultation():
-    if 'user_id' not in session or session.get('user_type') != 'student':
-        return redirect(url_for('login'))
-    
-    student = Student.query.filter_by(user_id=session['user_id']).first()
-    if not student:
-        return redirect(url_for('login'))
+    student = g.identity.profile
     
     if request.method == 'POST':
         category = request.form.get('category')
@@ -433,10 +402,13 @@ def new_consultation():
                 flash('No teacher assigned to your grade and section', 'error')
             return redirect(url_for('student_dashboard'))
         
+        category_key, subcategory_key = category_keys(category, subcategory)
         consultation = Consultation(
-            student_id=student.id,
+            student=student,
             teacher_id=teacher.id,
             subject=subject,
+            category=category_key,
+            subcategory=subcategory_key,
             status='pending'
         )
         db.session.add(consultation)
@@ -449,18 +421,11 @@ def new_consultation():
             message=f"Help Types: {help_types_str}\n\n{message}"
         )
         db.session.add(consultation_message)
-        db.session.commit()
         
-        # Send email notification to guidance advocates
-        recipients = []
-        advocates = Teacher.query.filter_by(is_guidance_advocate=True).all()
-        print(f"DEBUG: Found {len(advocates)} guidance advocates")
-        for adv in advocates:
-            if adv.user and adv.user.email:
-                recipients.append(adv.user.email)
-                print(f"DEBUG: Added recipient: {adv.user.email}")
+        # Queue the advocates' notification in the same transaction; with EMAIL_DIGEST_WINDOW
+        # it waits to be sent as part of a digest unless the category is urgent
+        recipients = reference_data.advocate_emails()
         
-        print(f"DEBUG: Total recipients for email: {len(recipients)}")
         if recipients:
             email_subject = f"New Consultation: {student.full_name()} - {subcategory_label}"
             email_body = f"New consultation from: {student.full_name()}\n"
@@ -472,16 +437,12 @@ def new_consultation():
             email_body += f"Message:\n{message}\n\n"
             email_body += f"Assigned to: {teacher.full_name()}\n"
             email_body += f"Consultation ID: {consultation.id}"
-            
-            print(f"DEBUG: Sending email with subject: {email_subject}")
-            try:
-                send_email(email_subject, email_body, recipients)
-                print(f"DEBUG: Email notification sent for new consultation {consultation.id}")
-            except Exception as e:
-                print(f"DEBUG: Failed to send email notification for consultation {consultation.id}: {e}")
-                # Don't fail the consultation creation if email fails
-        else:
-            print("DEBUG: No recipients found for email notification")
+            email_outbox.enqueue_digest(app.config, email_subject, email_body, recipients,
+                                        category=category_key, subcategory=subcategory_key)
+        
+        publish_consultation_update(consultation, 'consultation.created')
+        db.session.commit()
+        outbox_worker.wake()
         
         flash('Consultation created successfully', 'success')
         return redirect(url_for('view_consultation', consultation_id=consultation.id))
@@ -534,10 +495,9 @@ def preconsultation():
         if assigned and assigned.user and assigned.user.email:
             recipients.append(assigned.user.email)
 
-        advocates = Teacher.query.filter_by(is_guidance_advocate=True).all()
-        for adv in advocates:
-            if adv.user and adv.user.email and adv.user.email not in recipients:
-                recipients.append(adv.user.email)
+        for email in reference_data.advocate_emails():
+            if email not in recipients:
+                recipients.append(email)
 
         if not recipients:
             flash('No recipients found for preconsultation', 'error')
@@ -563,9 +523,13 @@ def preconsultation():
             email_body += f"Last time: {last_time}\n"
         email_body += f"\nHas talked to someone about the problem: {talked_someone.replace('_', ' ').title() if talked_someone else 'Not specified'}\n"
         try:
-            send_email(subject, email_body, recipients)
-            flash('Preconsultation emailed to counselor(s) successfully', 'success')
-        except Exception:
+            email_outbox.enqueue_email(subject, email_body, recipients)
+            db.session.commit()
+            outbox_worker.wake()
+            flash('Preconsultation sent to counselor(s) successfully', 'success')
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f'Error queueing preconsultation email: {str(e)}')
             flash('Failed to send preconsultation email. Please try again.', 'error')
         return redirect(url_for('preconsultation'))
 
@@ -573,13 +537,10 @@ def preconsultation():
     return render_template('preconsultation.html')
 
 @app.route('/teacher/dashboard')
+@use_replica
+@login_required('teacher')
 def teacher_dashboard():
-    if 'user_id' not in session or session.get('user_type') != 'teacher':
-        return redirect(url_for('login'))
-    
-    teacher = Teacher.query.filter_by(user_id=session['user_id']).first()
-    if not teacher:
-        return redirect(url_for('login'))
+    teacher = g.identity.profile
     
     # Get students based on teacher role (excluding archived)
     if teacher.is_guidance_advocate:
@@ -593,22 +554,23 @@ def teacher_dashboard():
             archived=False
         ).all()
     
-    # Get all consultations for this teacher
-    consultations = Consultation.query.filter_by(teacher_id=teacher.id, deleted=False).order_by(Consultation.created_at.desc()).all()
+    # First page of consultations for this teacher; the rest load on scroll
+    page = paginate_newest_first(
+        Consultation.query.filter_by(teacher_id=teacher.id, deleted=False).options(joinedload(Consultation.student)),
+        Consultation, limit=app.config['CONSULTATION_PAGE_SIZE']
+    )
     
     # Count pending consultations
-    pending_count = Consultation.query.filter_by(teacher_id=teacher.id, status='pending', deleted=False).count()
+    # Maintained on write in teacher_stats.py
+    pending_count = teacher_stats.teacher_counters(teacher.id)['pending']
     
-    return render_template('teacher_dashboard.html', teacher=teacher, students=students, consultations=consultations, pending_count=pending_count)
+    return render_template('teacher_dashboard.html', teacher=teacher, students=students, consultations=page.items, next_cursor=page.next_cursor, pending_count=pending_count)
 
 @app.route('/teacher/archived-students')
+@use_replica
+@login_required('teacher')
 def archived_students():
-    if 'user_id' not in session or session.get('user_type') != 'teacher':
-        return redirect(url_for('login'))
-    
-    teacher = Teacher.query.filter_by(user_id=session['user_id']).first()
-    if not teacher:
-        return redirect(url_for('login'))
+    teacher = g.identity.profile
     
     # Get archived students based on teacher role
     if teacher.is_guidance_advocate:
@@ -623,15 +585,9 @@ def archived_students():
     return render_template('archived_students.html', teacher=teacher, archived_students=archived)
 
 @app.route('/teacher/student/<int:student_id>/restore', methods=['POST'])
+@login_required('teacher')
 def restore_student(student_id):
-    if 'user_id' not in session or session.get('user_type') != 'teacher':
-        flash('Unauthorized access', 'error')
-        return redirect(url_for('login'))
-    
-    teacher = Teacher.query.filter_by(user_id=session['user_id']).first()
-    if not teacher:
-        flash('Teacher not found', 'error')
-        return redirect(url_for('login'))
+    teacher = g.identity.profile
     
     student = Student.query.get_or_404(student_id)
     
@@ -662,160 +618,102 @@ def restore_student(student_id):
         return redirect(url_for('archived_students'))
 
 @app.route('/teacher/statistics')
+@use_replica
+@login_required('teacher')
 def teacher_statistics():
-    if 'user_id' not in session or session.get('user_type') != 'teacher':
-        return redirect(url_for('login'))
-    
-    teacher = Teacher.query.filter_by(user_id=session['user_id']).first()
-    if not teacher:
-        return redirect(url_for('login'))
-    
-    # Get all students under this teacher (excluding archived)
-    students = Student.query.filter_by(
-        grade=teacher.handling_grade,
-        section=teacher.handling_section,
-        archived=False
-    ).all()
+    teacher = g.identity.profile
     
     # If guidance advocate, get all students for filter
     all_students = None
     if teacher.is_guidance_advocate:
-        all_students = Student.query.filter_by(archived=False).all()
+        all_students_query = Student.query.filter_by(archived=False)
         # Apply filter if provided
         filter_grade = request.args.get('filter_grade', '').strip()
         filter_section = request.args.get('filter_section', '').strip().upper()
         if filter_grade:
             try:
-                grade_int = int(filter_grade)
-                all_students = [s for s in all_students if s.grade == grade_int]
+                all_students_query = all_students_query.filter_by(grade=int(filter_grade))
             except ValueError:
                 pass
         if filter_section:
-            all_students = [s for s in all_students if s.section == filter_section]
+            all_students_query = all_students_query.filter_by(section=filter_section)
+        all_students = all_students_query.all()
     
-    # Get all consultations for this teacher (including deleted)
-    consultations = Consultation.query.filter_by(teacher_id=teacher.id).all()
-    
-    # Calculate statistics
-    total_students = len(students)
-    total_consultations = len(consultations)
-    
-    # Count consultations by status
-    pending_consultations = Consultation.query.filter_by(teacher_id=teacher.id, status='pending', deleted=False).count()
-    read_consultations = Consultation.query.filter_by(teacher_id=teacher.id, status='read', deleted=False).count()
-    responded_consultations = Consultation.query.filter_by(teacher_id=teacher.id, status='responded', deleted=False).count()
-    
-    # Get unique sections
-    unique_sections = db.session.query(Student.section).filter_by(
-        grade=teacher.handling_grade,
-        section=teacher.handling_section
-    ).distinct().count()
-    
-    # Get consultation frequency (students with consultations)
-    students_with_consultations = db.session.query(Consultation.student_id).filter_by(
-        teacher_id=teacher.id,
-        deleted=False
-    ).distinct().count()
-    
-    # Get average consultations per student
-    avg_consultations = total_consultations / total_students if total_students > 0 else 0
-    
-    # Get list of students with their consultation counts
-    student_consultation_stats = []
-    for student in students:
-        count = Consultation.query.filter_by(student_id=student.id, teacher_id=teacher.id, deleted=False).count()
-        student_consultation_stats.append({
-            'student': student,
-            'consultation_count': count
-        })
-    
-    # Sort by consultation count descending
-    student_consultation_stats.sort(key=lambda x: x['consultation_count'], reverse=True)
+    # First page of consultations for this teacher (including deleted)
+    page = paginate_newest_first(
+        Consultation.query.filter_by(teacher_id=teacher.id).options(joinedload(Consultation.student)),
+        Consultation, limit=app.config['CONSULTATION_PAGE_SIZE']
+    )
     
-    # Get consultation status breakdown for chart
-    status_breakdown = {
-        'pending': pending_consultations,
-        'read': read_consultations,
-        'responded': responded_consultations
-    }
+    # Status breakdown and per-student counts come from grouped queries
+    statistics, student_consultation_stats = teacher_stats.compute_teacher_statistics(teacher)
     
-    statistics = {
-        'total_students': total_students,
-        'total_consultations': total_consultations,
-        'pending_consultations': pending_consultations,
-        'read_consultations': read_consultations,
-        'responded_consultations': responded_consultations,
-        'unique_sections': unique_sections,
-        'students_with_consultations': students_with_consultations,
-        'avg_consultations': round(avg_consultations, 2),
-        'students_without_consultations': total_students - students_with_consultations,
-        'status_breakdown': status_breakdown
-    }
+    return render_template('teacher_statistics.html', teacher=teacher, statistics=statistics, student_stats=student_consultation_stats, consultations=page.items, next_cursor=page.next_cursor, all_students=all_students)
+
+@app.route('/api/statistics/trends')
+@use_replica
+@login_required('teacher', api=True)
+def statistics_trends():
+    """Consultations opened per day or week by category, subcategory, grade or section, from the daily rollups"""
+    by = request.args.get('by', 'category')
+    bucket = request.args.get('bucket', 'week')
+    category = request.args.get('category') or None
+    if by not in category_trends.DIMENSIONS or bucket not in category_trends.BUCKETS:
+        return jsonify({'error': 'Unknown grouping'}), 400
+    if category is not None and category not in CATEGORY_DATA:
+        return jsonify({'error': 'Unknown category'}), 400
+    try:
+        start, end = category_trends.parse_range(request.args, app.config)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    return render_template('teacher_statistics.html', teacher=teacher, statistics=statistics, student_stats=student_consultation_stats, consultations=consultations, all_students=all_students)
+    # Guidance advocates see school-wide trends, like the student list on their statistics page
+    teacher_id = None if g.identity.is_guidance_advocate else g.identity.profile_id
+    return jsonify(category_trends.category_trends(start, end, by=by, bucket=bucket, teacher_id=teacher_id, category=category))
 
 @app.route('/consultation/<int:consultation_id>')
+@login_required('student', 'teacher')
 def view_consultation(consultation_id):
+    user_type = g.identity.user_type
     consultation = Consultation.query.get_or_404(consultation_id)
     
     # Check if consultation is deleted
     if consultation.deleted:
         flash('This consultation has been deleted', 'info')
-        if 'user_id' in session:
-            user_type = session.get('user_type')
-            if user_type == 'student':
-                return redirect(url_for('student_dashboard'))
-            else:
-                return redirect(url_for('teacher_dashboard'))
-        return redirect(url_for('login'))
-    
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
-    user_type = session.get('user_type')
-    user_id = session['user_id']
+        return redirect(url_for('student_dashboard' if user_type == 'student' else 'teacher_dashboard'))
     
     # Check authorization
     if user_type == 'student':
-        student = Student.query.filter_by(user_id=user_id).first()
-        if consultation.student_id != student.id:
+        if consultation.student_id != g.identity.profile_id:
             flash('Unauthorized access', 'error')
             return redirect(url_for('student_dashboard'))
-    elif user_type == 'teacher':
-        teacher = Teacher.query.filter_by(user_id=user_id).first()
-        if consultation.teacher_id != teacher.id:
-            flash('Unauthorized access', 'error')
-            return redirect(url_for('teacher_dashboard'))
-    else:
-        return redirect(url_for('login'))
-    
-    messages = ConsultationMessage.query.filter_by(consultation_id=consultation_id).order_by(ConsultationMessage.created_at.asc()).all()
+    elif consultation.teacher_id != g.identity.profile_id:
+        flash('Unauthorized access', 'error')
+        return redirect(url_for('teacher_dashboard'))
     
-    # Mark as read if teacher views it
+    # Mark as read if teacher views it (before loading messages, so the commit
+    # does not expire them and trigger one refresh query per message)
     if user_type == 'teacher' and consultation.status == 'pending':
         consultation.status = 'read'
+        publish_consultation_update(consultation, 'consultation.updated', previous_status='pending')
         db.session.commit()
     
+    messages = ConsultationMessage.query.filter_by(consultation_id=consultation_id).order_by(ConsultationMessage.created_at.asc()).all()
+    
+    # The student is already loaded with the consultation, so only a teacher's profile costs a query
+    current_user = g.identity.profile
     if user_type == 'student':
-        student = Student.query.filter_by(user_id=user_id).first()
-        return render_template('view_consultation.html', consultation=consultation, messages=messages, current_user=student, user_type='student')
+        return render_template('view_consultation.html', consultation=consultation, messages=messages, current_user=current_user, user_type='student')
     else:
-        teacher = Teacher.query.filter_by(user_id=user_id).first()
-        student = Student.query.get(consultation.student_id)
-        return render_template('view_consultation.html', consultation=consultation, messages=messages, current_user=teacher, user_type='teacher', student=student)
+        student = consultation.student
+        return render_template('view_consultation.html', consultation=consultation, messages=messages, current_user=current_user, user_type='teacher', student=student)
 
 
 
 @app.route('/teacher/student/<int:student_id>/delete', methods=['POST'])
+@login_required('teacher')
 def delete_student(student_id):
-    if 'user_id' not in session or session.get('user_type') != 'teacher':
-        flash('Unauthorized access', 'error')
-        return redirect(url_for('login'))
-    
-    teacher = Teacher.query.filter_by(user_id=session['user_id']).first()
-    if not teacher:
-        flash('Teacher not found', 'error')
-        return redirect(url_for('login'))
+    teacher = g.identity.profile
     
     student = Student.query.get_or_404(student_id)
     
@@ -846,57 +744,50 @@ def delete_student(student_id):
         return redirect(url_for('view_student', student_id=student_id))
 
 @app.route('/consultation/<int:consultation_id>/reply', methods=['POST'])
+@login_required('student', 'teacher')
 def reply_consultation(consultation_id):
     consultation = Consultation.query.get_or_404(consultation_id)
-    
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
-    user_type = session.get('user_type')
-    user_id = session['user_id']
+    user_type = g.identity.user_type
+    sender_id = g.identity.profile_id
     
     # Check authorization
     if user_type == 'student':
-        student = Student.query.filter_by(user_id=user_id).first()
-        if consultation.student_id != student.id:
+        if consultation.student_id != sender_id:
             flash('Unauthorized access', 'error')
             return redirect(url_for('student_dashboard'))
-        sender_id = student.id
-    elif user_type == 'teacher':
-        teacher = Teacher.query.filter_by(user_id=user_id).first()
-        if consultation.teacher_id != teacher.id:
-            flash('Unauthorized access', 'error')
-            return redirect(url_for('teacher_dashboard'))
-        sender_id = teacher.id
-    else:
-        return redirect(url_for('login'))
+    elif consultation.teacher_id != sender_id:
+        flash('Unauthorized access', 'error')
+        return redirect(url_for('teacher_dashboard'))
     
     message_text = request.form.get('message')
     file = request.files.get('attachment')
     
     filename = None
+    attachment = None
     if file and file.filename and allowed_file(file.filename):
+        # The upload was already streamed into the attachment store while the form
+        # was parsed; this only links it to its deduplicated blob
         filename = secure_filename(file.filename)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
-        filename = timestamp + filename
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'attachments', filename)
-        file.save(file_path)
+        attachment = attachments.save_upload(file, filename)
     
     consultation_message = ConsultationMessage(
         consultation_id=consultation_id,
         sender_type=user_type,
         sender_id=sender_id,
         message=message_text,
-        attachment_filename=filename
+        attachment_filename=filename,
+        attachment=attachment
     )
     
     # Update consultation status
+    previous_status = consultation.status
     if user_type == 'teacher':
         consultation.status = 'responded'
     else:
         consultation.status = 'pending'
     
     db.session.add(consultation_message)
+    publish_consultation_update(consultation, 'consultation.updated', previous_status=previous_status)
     db.session.commit()
     
     flash('Reply sent successfully', 'success')
@@ -904,14 +795,11 @@ def reply_consultation(consultation_id):
 
 
 @app.route('/consultation/<int:consultation_id>/delete', methods=['POST'])
+@login_required('student')
 def delete_consultation(consultation_id):
-    if 'user_id' not in session or session.get('user_type') != 'student':
-        return redirect(url_for('login'))
-
-    student = Student.query.filter_by(user_id=session['user_id']).first()
     consultation = Consultation.query.get_or_404(consultation_id)
 
-    if consultation.student_id != student.id:
+    if consultation.student_id != g.identity.profile_id:
         flash('Unauthorized access', 'error')
         return redirect(url_for('student_dashboard'))
 
@@ -926,14 +814,11 @@ def delete_consultation(consultation_id):
 
 
 @app.route('/consultation/<int:consultation_id>/delete-teacher', methods=['POST'])
+@login_required('teacher')
 def delete_consultation_teacher(consultation_id):
-    if 'user_id' not in session or session.get('user_type') != 'teacher':
-        return redirect(url_for('login'))
-
-    teacher = Teacher.query.filter_by(user_id=session['user_id']).first()
     consultation = Consultation.query.get_or_404(consultation_id)
 
-    if consultation.teacher_id != teacher.id:
+    if consultation.teacher_id != g.identity.profile_id:
         flash('Unauthorized access', 'error')
         return redirect(url_for('teacher_dashboard'))
 
@@ -948,13 +833,10 @@ def delete_consultation_teacher(consultation_id):
 
 
 @app.route('/teacher/student/<int:student_id>')
+@use_replica
+@login_required('teacher')
 def view_student(student_id):
-    if 'user_id' not in session or session.get('user_type') != 'teacher':
-        return redirect(url_for('login'))
-    
-    teacher = Teacher.query.filter_by(user_id=session['user_id']).first()
-    if not teacher:
-        return redirect(url_for('login'))
+    teacher = g.identity.profile
     
     student = Student.query.get_or_404(student_id)
     
@@ -971,18 +853,168 @@ def view_student(student_id):
             return redirect(url_for('teacher_dashboard'))
     
     user = student.user
-    consultations = Consultation.query.filter_by(student_id=student.id).order_by(Consultation.created_at.desc()).all()
+    page = paginate_newest_first(
+        Consultation.query.filter_by(student_id=student.id),
+        Consultation, limit=app.config['CONSULTATION_PAGE_SIZE']
+    )
     
-    return render_template('view_student.html', student=student, user=user, teacher=teacher, consultations=consultations)
+    return render_template('view_student.html', student=student, user=user, teacher=teacher, consultations=page.items, next_cursor=page.next_cursor)
+
+@app.route('/api/consultations/<list_name>')
+@use_replica
+@login_required(api=True)
+def consultation_page(list_name):
+    """Next page of a consultation list as JSON, for infinite scrolling"""
+    user_type = g.identity.user_type
+    profile_id = g.identity.profile_id
+    if list_name == 'student' and user_type == 'student':
+        query = Consultation.query.filter_by(student_id=profile_id, deleted=False)
+        macro = 'student_item'
+    elif list_name in ('teacher', 'history', 'student-record') and user_type == 'teacher':
+        if list_name == 'teacher':
+            query = Consultation.query.filter_by(teacher_id=profile_id, deleted=False).options(joinedload(Consultation.student))
+            macro = 'teacher_item'
+        elif list_name == 'history':
+            query = Consultation.query.filter_by(teacher_id=profile_id).options(joinedload(Consultation.student))
+            macro = 'history_item'
+        else:
+            student = Student.query.get_or_404(request.args.get('student_id', type=int))
+            # Same rule as view_student: regular teachers only see their own section
+            teacher = g.identity.profile
+            if not teacher.is_guidance_advocate and (student.grade != teacher.handling_grade or student.section != teacher.handling_section):
+                return jsonify({'error': 'Unauthorized access'}), 403
+            query = Consultation.query.filter_by(student_id=student.id)
+            macro = 'student_record_item'
+    else:
+        return jsonify({'error': 'Unknown consultation list'}), 404
+    
+    limit = min(request.args.get('limit', app.config['CONSULTATION_PAGE_SIZE'], type=int), 100)
+    try:
+        page = paginate_newest_first(query, Consultation, cursor=request.args.get('cursor'), limit=max(limit, 1))
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    
+    render_item = get_template_attribute('_consultation_items.html', macro)
+    return jsonify({
+        'consultations': [
+            {
+                'id': c.id,
+                'subject': c.subject,
+                'status': c.status,
+                'deleted': c.deleted,
+                'created_at': c.created_at.isoformat()
+            }
+            for c in page.items
+        ],
+        'html': ''.join(render_item(c) for c in page.items),
+        'next_cursor': page.next_cursor
+    })
+
+@app.route('/api/consultations/search')
+@use_replica
+@login_required('teacher', api=True)
+def search_consultations():
+    """The teacher's consultations matching ?q= in the subject or any message, best match first"""
+    text = request.args.get('q', '').strip()
+    if not consultation_search.query_terms(text):
+        return jsonify({'error': 'Enter something to search for'}), 400
+    limit = max(min(request.args.get('limit', app.config['CONSULTATION_PAGE_SIZE'], type=int), 100), 1)
+    page = max(request.args.get('page', 1, type=int), 1)
+    consultations, has_more = consultation_search.search_consultations(
+        g.identity.profile_id, text, limit=limit, offset=(page - 1) * limit
+    )
+    
+    render_item = get_template_attribute('_consultation_items.html', 'teacher_item')
+    return jsonify({
+        'consultations': [
+            {
+                'id': c.id,
+                'subject': c.subject,
+                'status': c.status,
+                'student': c.student.full_name(),
+                'created_at': c.created_at.isoformat()
+            }
+            for c in consultations
+        ],
+        'html': ''.join(render_item(c) for c in consultations),
+        'next_page': page + 1 if has_more else None
+    })
+
+@app.route('/api/consultation/<int:consultation_id>/messages')
+@use_replica
+@login_required(api=True)
+def consultation_messages(consultation_id):
+    """Messages newer than ?after=<message id> as JSON; waits up to ?wait= seconds for one to arrive"""
+    consultation = Consultation.query.get_or_404(consultation_id)
+    if consultation.deleted:
+        return jsonify({'error': 'This consultation has been deleted'}), 404
+    
+    user_type = g.identity.user_type
+    profile_id = g.identity.profile_id
+    owner_id = consultation.student_id if user_type == 'student' else consultation.teacher_id
+    if owner_id != profile_id:
+        return jsonify({'error': 'Unauthorized access'}), 403
+    
+    after = request.args.get('after', 0, type=int)
+    wait = min(max(request.args.get('wait', 0, type=float), 0), app.config['MESSAGE_POLL_MAX_WAIT'])
+    deadline = time.monotonic() + wait
+    query = ConsultationMessage.query.filter(
+        ConsultationMessage.consultation_id == consultation_id,
+        ConsultationMessage.id > after
+    ).order_by(ConsultationMessage.id.asc()).limit(100)
+    # Replies published in this process wake the wait early; the interval covers other processes
+    with event_broker.subscribe(f'{user_type}:{profile_id}') as subscription:
+        while True:
+            messages = query.all()
+            remaining = deadline - time.monotonic()
+            if messages or remaining <= 0:
+                break
+            # End the transaction so the connection goes back to the pool and the next check sees new rows
+            db.session.rollback()
+            subscription.get(timeout=min(app.config['MESSAGE_POLL_INTERVAL'], remaining))
+    
+    render_message = get_template_attribute('_message_items.html', 'message_bubble')
+    return jsonify({
+        'messages': [
+            {
+                'id': m.id,
+                'sender_type': m.sender_type,
+                'message': m.message,
+                'attachment_id': m.attachment.id if m.attachment else None,
+                'created_at': m.created_at.isoformat()
+            }
+            for m in messages
+        ],
+        'html': ''.join(render_message(m, user_type, consultation.student) for m in messages),
+        'last_id': messages[-1].id if messages else after,
+        'status': consultation.status
+    })
+
+@app.route('/events')
+@login_required(api=True)
+def event_stream():
+    """Server-Sent Events for the logged-in user's dashboard (see live_events.py)"""
+    if not app.config['LIVE_EVENTS_ENABLED']:
+        # Each stream would hold a server thread; only served under gevent
+        return jsonify({'error': 'Live events are not enabled'}), 404
+    if event_broker.subscriber_count() >= app.config['LIVE_EVENTS_MAX_STREAMS']:
+        response = jsonify({'error': 'Too many live connections'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '30'
+        return response
+    
+    subscription = event_broker.subscribe(f'{g.identity.user_type}:{g.identity.profile_id}')
+    body = live_events.stream(subscription, app.config['LIVE_EVENTS_HEARTBEAT'], app.config['LIVE_EVENTS_MAX_DURATION'])
+    response = Response(body, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @app.route('/teacher/student/<int:student_id>/edit', methods=['GET', 'POST'])
+@login_required('teacher')
 def edit_student(student_id):
-    if 'user_id' not in session or session.get('user_type') != 'teacher':
-        return redirect(url_for('login'))
-    
-    teacher = Teacher.query.filter_by(user_id=session['user_id']).first()
-    if not teacher:
-        return redirect(url_for('login'))
+    teacher = g.identity.profile
     
     student = Student.query.get_or_404(student_id)
     
@@ -1027,7 +1059,7 @@ def edit_student(student_id):
         new_email = request.form.get('email', '').lower().strip()
         if new_email and new_email != user.email:
             # Check if email is already taken by another user
-            existing_user = User.query.filter_by(email=new_email).first()
+            existing_user = User.find_by_email(new_email)
             if existing_user and existing_user.id != user.id:
                 flash('Email already registered to another account', 'error')
                 return redirect(url_for('edit_student', student_id=student_id))
@@ -1039,22 +1071,19 @@ def edit_student(student_id):
             if len(new_password) < 6:
                 flash('Password must be at least 6 characters long', 'error')
                 return redirect(url_for('edit_student', student_id=student_id))
-            user.password_hash = generate_password_hash(new_password)
+            user.password_hash = password_hasher.hash(new_password)
         
         db.session.commit()
+        reference_data.invalidate_sections()
         flash('Student information updated successfully', 'success')
         return redirect(url_for('view_student', student_id=student_id))
     
     return render_template('edit_student.html', student=student, user=user, teacher=teacher)
 
 @app.route('/teacher/edit', methods=['GET', 'POST'])
+@login_required('teacher')
 def edit_teacher():
-    if 'user_id' not in session or session.get('user_type') != 'teacher':
-        return redirect(url_for('login'))
-    
-    teacher = Teacher.query.filter_by(user_id=session['user_id']).first()
-    if not teacher:
-        return redirect(url_for('login'))
+    teacher = g.identity.profile
     
     if request.method == 'POST':
         # Update teacher information
@@ -1068,22 +1097,74 @@ def edit_teacher():
             teacher.availability = request.form.get('availability', '').strip() or None
         
         db.session.commit()
+        if teacher.is_guidance_advocate:
+            reference_data.invalidate_advocates()
         flash('Teacher information updated successfully', 'success')
         return redirect(url_for('teacher_dashboard'))
     
     return render_template('edit_teacher.html', teacher=teacher)
 
+@app.route('/teacher/students/import', methods=['POST'])
+@login_required('advocate', api=True)
+def import_students():
+    """Bulk-import a CSV or JSON Lines roster (see student_roster.py); guidance advocates only"""
+    roster = request.files.get('roster')
+    if not roster or not roster.filename:
+        return jsonify({'error': 'No roster file uploaded'}), 400
+    fmt = request.form.get('format') or ('jsonl' if roster.filename.lower().endswith(('.jsonl', '.ndjson')) else 'csv')
+    if fmt not in student_roster.FORMATS:
+        return jsonify({'error': f'Unknown format: {fmt}'}), 400
+    
+    # Werkzeug keeps small uploads in memory and spools larger ones to disk; read it one row at a time
+    roster.stream.seek(0)
+    report = student_roster.import_students(
+        io.BufferedReader(roster.stream), fmt, password_hasher,
+        batch_size=app.config['STUDENT_IMPORT_BATCH_SIZE']
+    )
+    reference_data.invalidate_sections()
+    app.logger.info(f'{g.identity.profile.full_name()} imported {report.imported} student(s) at {report.rows_per_second:.0f} rows/s')
+    if report.failed is not None:
+        return jsonify(report.as_dict()), 400
+    return jsonify(report.as_dict())
+
+@app.route('/teacher/export/<table>')
+@use_replica
+@login_required('advocate')
+def export_table(table):
+    """Stream students or consultations as CSV (default) or ?format=jsonl; guidance advocates only"""
+    fmt = request.args.get('format', 'csv')
+    if table not in student_roster.EXPORTS or fmt not in student_roster.FORMATS:
+        return jsonify({'error': 'Unknown export'}), 404
+    
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    response = Response(stream_with_context(student_roster.export_rows(table, fmt)), mimetype=mimetype)
+    response.headers.set('Content-Disposition', 'attachment', filename=f'{table}.{fmt}')
+    return response
+
 @app.route('/download/<filename>')
 def download_file(filename):
     return send_file(os.path.join(app.config['UPLOAD_FOLDER'], 'attachments', filename), as_attachment=True)
 
+@app.route('/attachment/<int:attachment_id>')
+@login_required()
+def download_attachment(attachment_id):
+    attachment = MessageAttachment.query.get_or_404(attachment_id)
+    consultation = attachment.message.consultation
+    
+    # Only the two people in the consultation may download its files
+    owner_id = consultation.student_id if g.identity.user_type == 'student' else consultation.teacher_id
+    if owner_id != g.identity.profile_id:
+        flash('Unauthorized access', 'error')
+        return redirect(url_for('index'))
+    
+    return attachments.send(attachment)
+
 if __name__ == '__main__':
     with app.app_context():
-        # Drop all tables and recreate them (for development)
-        # Remove this in production and use proper migrations
-        #db.drop_all()
-        db.create_all()
+        # Create missing tables and apply pending migrations (same as `flask db upgrade`)
+        migrations.upgrade()
         print("Database tables created/updated successfully!")
+    start_serving()
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
 
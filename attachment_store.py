@@ -0,0 +1,277 @@
+"""Content-addressed storage for consultation attachments.
+
+Uploads are streamed straight to a temporary file in the store while their
+SHA-256 is computed, so Werkzeug never holds the body in memory. When the
+transaction that references it commits, the file is moved to
+blobs/<aa>/<sha256>; a rollback discards it, so the store never holds a blob
+without an AttachmentBlob row. If a blob with the same hash already exists
+the upload is discarded and the existing blob is referenced instead.
+
+Because a blob never changes, its hash doubles as a strong ETag for
+downloads. send() answers conditional and Range requests itself, or, with
+ATTACHMENT_OFFLOAD set, only writes the headers and leaves the transfer to
+the front proxy:
+
+    ATTACHMENT_OFFLOAD = 'x-accel-redirect'   # nginx
+    location /_attachments/ { internal; alias /srv/app/uploads/blobs/; }
+
+    ATTACHMENT_OFFLOAD = 'x-sendfile'         # Apache mod_xsendfile, lighttpd
+"""
+import hashlib
+import io
+import logging
+import os
+import tempfile
+
+import click
+from flask import Request, Response, current_app, request, send_file
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from models import db, AttachmentBlob, MessageAttachment, ConsultationMessage
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+DEFAULT_CONFIG = {
+    # None serves blobs from the worker; 'x-accel-redirect' or 'x-sendfile' hands them to the proxy
+    'ATTACHMENT_OFFLOAD': None,
+    # Internal nginx location that maps onto the blobs directory
+    'ATTACHMENT_ACCEL_PREFIX': '/_attachments/',
+    # Seconds a browser may reuse a download without revalidating
+    'ATTACHMENT_CACHE_MAX_AGE': 3600,
+}
+
+
+class HashingSpool(io.RawIOBase):
+    """Temporary file that hashes everything written to it"""
+
+    def __init__(self, directory):
+        fd, self.path = tempfile.mkstemp(dir=directory, prefix='upload-')
+        self._file = os.fdopen(fd, 'w+b')
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def readinto(self, buffer):
+        return self._file.readinto(buffer)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def flush(self):
+        if not self._file.closed:
+            self._file.flush()
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+            # Still here means the upload was never stored
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+        super().close()
+
+
+class StreamingUploadRequest(Request):
+    """Request class that spools consultation attachments into the attachment store"""
+
+    # Only these views store their uploads as attachments; others (e.g. roster imports) keep Werkzeug's handling
+    attachment_endpoints = {'reply_consultation'}
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        store = current_app.extensions.get('attachment_store')
+        if store is None or self.endpoint not in self.attachment_endpoints:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        return store.spool()
+
+
+class AttachmentStore:
+    def __init__(self, root):
+        # Absolute, so send_file does not resolve it against the app root instead of the cwd
+        self.root = os.path.abspath(root)
+        self.tmp_dir = os.path.join(self.root, 'tmp')
+        self.blob_dir = os.path.join(self.root, 'blobs')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        os.makedirs(self.blob_dir, exist_ok=True)
+
+    def spool(self):
+        return HashingSpool(self.tmp_dir)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.blob_dir, sha256[:2], sha256)
+
+    def send(self, attachment):
+        """Return a download response for attachment, honouring If-None-Match, If-Modified-Since and Range"""
+        blob = attachment.blob
+        mode = current_app.config['ATTACHMENT_OFFLOAD']
+        if mode:
+            response = self._offload_response(attachment, mode)
+        else:
+            response = send_file(
+                self.blob_path(blob.sha256),
+                mimetype=blob.content_type,
+                as_attachment=True,
+                download_name=attachment.filename,
+                etag=blob.sha256,
+                last_modified=blob.created_at,
+                max_age=None
+            )
+            # Advertise ranges on full responses too, so clients know they can resume
+            response.accept_ranges = 'bytes'
+        # Attachments are only for the consultation's participants, so never let shared caches keep them
+        response.cache_control.no_cache = None
+        response.cache_control.private = True
+        response.cache_control.max_age = current_app.config['ATTACHMENT_CACHE_MAX_AGE']
+        return response
+
+    def _offload_response(self, attachment, mode):
+        blob = attachment.blob
+        response = Response(mimetype=blob.content_type or 'application/octet-stream')
+        # Filenames went through secure_filename, so they are plain ASCII
+        response.headers.set('Content-Disposition', 'attachment', filename=attachment.filename)
+        if mode == 'x-accel-redirect':
+            prefix = current_app.config['ATTACHMENT_ACCEL_PREFIX'].rstrip('/')
+            response.headers['X-Accel-Redirect'] = f'{prefix}/{blob.sha256[:2]}/{blob.sha256}'
+        elif mode == 'x-sendfile':
+            response.headers['X-Sendfile'] = self.blob_path(blob.sha256)
+        else:
+            raise ValueError(f'Unknown ATTACHMENT_OFFLOAD mode: {mode}')
+        response.set_etag(blob.sha256)
+        response.last_modified = blob.created_at
+        # The proxy serves byte ranges itself; only answer 304/412 here
+        response.make_conditional(request)
+        if response.status_code == 304:
+            response.headers.pop('X-Accel-Redirect', None)
+            response.headers.pop('X-Sendfile', None)
+        return response
+
+    def _as_spool(self, stream):
+        """Return stream as a HashingSpool, copying it in chunks if it is not one already"""
+        if isinstance(stream, HashingSpool):
+            return stream
+        spool = self.spool()
+        stream.seek(0)
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            spool.write(chunk)
+        return spool
+
+    def _store_on_commit(self, spool, sha256):
+        """Move spool into the blob store once the current transaction commits"""
+        db.session.info.setdefault('attachment_blobs', []).append((spool, self.blob_path(sha256)))
+
+    def save_upload(self, file, filename):
+        """Store an uploaded FileStorage and return an unsaved MessageAttachment for it"""
+        spool = self._as_spool(file.stream)
+        spool.flush()
+        sha256 = spool.hexdigest()
+
+        blob = db.session.get(AttachmentBlob, sha256)
+        if blob is None or not os.path.exists(self.blob_path(sha256)):
+            self._store_on_commit(spool, sha256)
+        else:
+            spool.close()
+        if blob is None:
+            blob = AttachmentBlob(sha256=sha256, size=spool.size, content_type=file.mimetype or None)
+            try:
+                # A concurrent upload of the same file may insert the row first
+                with db.session.begin_nested():
+                    db.session.add(blob)
+            except IntegrityError:
+                blob = db.session.get(AttachmentBlob, sha256)
+        return MessageAttachment(blob=blob, filename=filename)
+
+    def import_legacy(self, legacy_dir):
+        """Move timestamped files from uploads/attachments into the store. Returns (imported, missing)."""
+        imported = missing = 0
+        messages = ConsultationMessage.query.filter(
+            ConsultationMessage.attachment_filename.isnot(None)
+        ).all()
+        for message in messages:
+            if message.attachment is not None:
+                continue
+            path = os.path.join(legacy_dir, message.attachment_filename)
+            if not os.path.exists(path):
+                missing += 1
+                continue
+            display_name = message.attachment_filename
+            if '_' in display_name:
+                display_name = display_name.split('_', 2)[-1]
+            with open(path, 'rb') as legacy_file:
+                spool = self._as_spool(legacy_file)
+            sha256 = spool.hexdigest()
+            blob = db.session.get(AttachmentBlob, sha256)
+            if blob is None:
+                self._store_on_commit(spool, sha256)
+                blob = AttachmentBlob(sha256=sha256, size=spool.size)
+                db.session.add(blob)
+                db.session.flush()
+            else:
+                spool.close()
+            message.attachment = MessageAttachment(blob=blob, filename=display_name)
+            message.attachment_filename = display_name
+            db.session.commit()
+            os.unlink(path)
+            imported += 1
+        return imported, missing
+
+
+@event.listens_for(Session, 'after_commit')
+def _move_committed_blobs(session):
+    if session.get_nested_transaction() is not None:
+        # Only a savepoint; the outer transaction may still roll back
+        return
+    for spool, path in session.info.pop('attachment_blobs', []):
+        try:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(spool.path, path)
+        except OSError:
+            logger.exception('Could not move committed attachment into %s', path)
+        spool.close()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_rolled_back_blobs(session, previous_transaction):
+    if previous_transaction.parent is None:
+        for spool, _ in session.info.pop('attachment_blobs', []):
+            spool.close()
+
+
+def init_app(app):
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    store = AttachmentStore(app.config['UPLOAD_FOLDER'])
+    app.extensions['attachment_store'] = store
+    app.request_class = StreamingUploadRequest
+
+    @app.cli.command('import-attachments')
+    def import_attachments_command():
+        """Move legacy uploads/attachments files into the deduplicated store."""
+        legacy_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'attachments')
+        imported, missing = store.import_legacy(legacy_dir)
+        click.echo(f'Imported {imported} attachment(s), {missing} file(s) missing on disk')
+
+    return store
@@ -0,0 +1,129 @@
+"""Fail when a dashboard query falls back to a sequential scan.
+
+Seeds a scratch database with a large dataset, refreshes planner statistics
+and EXPLAINs the queries behind the dashboards and statistics page. Exits
+with status 1 if any plan scans a whole table instead of using an index.
+
+    python benchmarks/check_query_plans.py                      # in-memory SQLite
+    python benchmarks/check_query_plans.py --db postgresql://localhost/reach_plans
+
+Never point --db at a real deployment: the schema is dropped and re-seeded.
+"""
+import argparse
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy import and_, func, or_
+from sqlalchemy.orm import joinedload
+
+from models import db, User, Teacher, Student, Consultation, ConsultationMessage, TeacherConsultationStats
+from seed_data import seed_database
+
+CHECKED_TABLES = {'consultation', 'student', 'consultation_message', 'user', 'teacher_consultation_stats'}
+
+
+def dashboard_queries():
+    """(name, query) pairs mirroring the filters used in app.py"""
+    teacher = Teacher.query.filter_by(is_guidance_advocate=False).first()
+    advocate = Teacher.query.filter_by(is_guidance_advocate=True).first()
+    consultation = Consultation.query.filter_by(teacher_id=teacher.id).first()
+    dashboard_page = Consultation.query.filter_by(teacher_id=teacher.id, deleted=False).options(
+        joinedload(Consultation.student))
+    # A later page, as paginate_newest_first builds it from a cursor
+    cursor = Consultation.query.filter_by(teacher_id=teacher.id, deleted=False).order_by(
+        Consultation.created_at.desc(), Consultation.id.desc()).offset(20).first()
+    return [
+        ('teacher_dashboard consultations page',
+         dashboard_page.order_by(Consultation.created_at.desc(), Consultation.id.desc()).limit(21)),
+        ('teacher_dashboard consultations next page',
+         dashboard_page.filter(or_(
+             Consultation.created_at < cursor.created_at,
+             and_(Consultation.created_at == cursor.created_at, Consultation.id < cursor.id)
+         )).order_by(Consultation.created_at.desc(), Consultation.id.desc()).limit(21)),
+        ('teacher_statistics history page',
+         Consultation.query.filter_by(teacher_id=teacher.id).order_by(
+             Consultation.created_at.desc(), Consultation.id.desc()).limit(21)),
+        ('teacher_dashboard pending_count (teacher_stats counters)',
+         TeacherConsultationStats.query.filter_by(teacher_id=teacher.id)),
+        ('teacher_dashboard section students',
+         Student.query.filter_by(grade=teacher.handling_grade, section=teacher.handling_section, archived=False)),
+        ('teacher_dashboard advocate students',
+         Student.query.filter_by(preferred_guidance_advocate_id=advocate.id, archived=False)),
+        ('student_dashboard consultations page',
+         Consultation.query.filter_by(student_id=consultation.student_id, deleted=False).order_by(
+             Consultation.created_at.desc(), Consultation.id.desc()).limit(21)),
+        ('view_consultation messages',
+         ConsultationMessage.query.filter_by(consultation_id=consultation.id).order_by(ConsultationMessage.created_at.asc())),
+        ('teacher_statistics per-student counts',
+         db.session.query(Consultation.student_id, func.count(Consultation.id)).filter_by(
+             teacher_id=teacher.id, deleted=False).group_by(Consultation.student_id)),
+        ('api sections',
+         db.session.query(Student.section).filter_by(grade=teacher.handling_grade).distinct()),
+        ('login / registration email lookup',
+         User.query.filter(func.lower(User.email) == 'someone@example.com')),
+    ]
+
+
+def explain(query):
+    dialect = db.engine.dialect
+    sql = str(query.statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+    prefix = 'EXPLAIN QUERY PLAN ' if dialect.name == 'sqlite' else 'EXPLAIN '
+    rows = db.session.execute(db.text(prefix + sql)).fetchall()
+    # SQLite returns (id, parent, notused, detail); PostgreSQL one text column
+    return [row[-1] for row in rows]
+
+
+def sequential_scans(plan_lines, dialect_name):
+    scans = []
+    for line in plan_lines:
+        if dialect_name == 'sqlite':
+            match = re.match(r'\s*SCAN (\w+)', line)
+            if match and 'USING' not in line:
+                scans.append(match.group(1))
+        else:
+            match = re.search(r'Seq Scan on "?(\w+)', line)
+            if match:
+                scans.append(match.group(1))
+    return [t for t in scans if t in CHECKED_TABLES]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default='sqlite://')
+    parser.add_argument('--students-per-section', type=int, default=40)
+    parser.add_argument('--show-plans', action='store_true')
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.db
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        counts = seed_database(students_per_section=args.students_per_section)
+        print('Seeded ' + ', '.join(f'{n} {t}' for t, n in counts.items()))
+        db.session.execute(db.text('ANALYZE'))
+        db.session.commit()
+
+        failures = 0
+        for name, query in dashboard_queries():
+            plan = explain(query)
+            scans = sequential_scans(plan, db.engine.dialect.name)
+            status = 'FAIL' if scans else 'ok'
+            print(f"{status:>4}  {name}" + (f"  (sequential scan on {', '.join(scans)})" if scans else ''))
+            if args.show_plans or scans:
+                for line in plan:
+                    print(f'        {line}')
+            failures += bool(scans)
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Local stand-in for the EmailJS send endpoint.
+
+Point EMAILJS_API_URL at it to exercise the email outbox without touching
+the real provider:
+
+    python benchmarks/fake_emailjs.py --port 8025 --latency 0.2 --fail-rate 0.1
+
+or start it in-process with FakeEmailJS().start() and read .received.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeEmailJS:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, fail_rate=0.0, status_code=500):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.status_code = status_code
+        self.received = []
+        self.connections = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/api/v1.0/email/send'
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                with fake._lock:
+                    fake.connections += 1
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                payload = json.loads(self.rfile.read(length) or b'{}')
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if random.random() < fake.fail_rate:
+                    status, text = fake.status_code, b'Simulated failure'
+                else:
+                    status, text = 200, b'OK'
+                    with fake._lock:
+                        fake.received.append(payload)
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-Length', str(len(text)))
+                self.end_headers()
+                self.wfile.write(text)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake EmailJS endpoint')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before answering')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of requests answered with an error')
+    args = parser.parse_args()
+    fake = FakeEmailJS(args.host, args.port, args.latency, args.fail_rate)
+    print(f'Fake EmailJS listening on {fake.url}')
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
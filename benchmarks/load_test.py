@@ -0,0 +1,407 @@
+"""Load test: simulated students and teachers against the real app.
+
+Seeds a scratch database with seed_data.py, stubs EmailJS with the local
+fake from fake_emailjs.py, serves the app from a threaded Werkzeug server
+and runs a scenario with --users virtual users for --duration seconds. Like
+a Locust user, each virtual user logs in once and then loops over its
+scenario's weighted tasks, waiting --think seconds between them.
+
+    python benchmarks/load_test.py --scenario mixed --users 20 --duration 30 -o before.json
+    python benchmarks/load_test.py --scenario mixed --users 20 --duration 30 --compare before.json
+
+Scenarios: login (a login storm), dashboards, statistics, replies (with an
+attachment on every reply), preconsultation, messages (message long-polls
+woken by replies) and mixed (all of them but messages).
+
+--db points at a local Postgres instead of SQLite; an empty database is
+migrated and seeded, one that already has users is reused as it is. With
+--url the load goes to an app that is already running against that
+database (start benchmarks/fake_emailjs.py for it yourself).
+
+Per-route request rates and latency percentiles are printed and, with -o,
+written as JSON together with the commit and settings, so runs can be
+compared between commits with --compare.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = 'benchmark-password'
+# seconds a message long-poll may wait for a new message
+LONG_POLL_WAIT = 5
+# one small attachment per reply
+ATTACHMENT = b'%PDF-1.4\n' + bytes(random.Random(0).getrandbits(8) for _ in range(32 * 1024))
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+class Recorder:
+    """Latencies per route name, shared by every virtual user"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, name, seconds, ok):
+        with self._lock:
+            self.latencies[name].append(seconds)
+            if not ok:
+                self.errors[name] += 1
+
+    def summary(self, elapsed):
+        def stats(latencies, errors):
+            ms = [latency * 1000 for latency in latencies]
+            return {
+                'requests': len(ms),
+                'errors': errors,
+                'rps': round(len(ms) / elapsed, 2),
+                'mean_ms': round(sum(ms) / len(ms), 2),
+                'p50_ms': round(percentile(ms, 50), 2),
+                'p90_ms': round(percentile(ms, 90), 2),
+                'p95_ms': round(percentile(ms, 95), 2),
+                'p99_ms': round(percentile(ms, 99), 2),
+                'max_ms': round(max(ms), 2),
+            }
+
+        with self._lock:
+            routes = {name: stats(latencies, self.errors[name])
+                      for name, latencies in sorted(self.latencies.items())}
+            every = [latency for latencies in self.latencies.values() for latency in latencies]
+            total = stats(every, sum(self.errors.values())) if every else None
+        return routes, total
+
+
+class VirtualUser:
+    def __init__(self, base_url, recorder, account, rng):
+        self.base_url = base_url
+        self.recorder = recorder
+        self.account = account  # {'role', 'email', 'consultations'}; None for anonymous users
+        self.rng = rng
+        self.http = requests.Session()
+        self.last_message = {}  # consultation id -> newest message id seen
+
+    def request(self, name, method, path, ok_status=(200,), **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self.http.request(method, self.base_url + path, allow_redirects=False, **kwargs)
+            ok = response.status_code in ok_status
+        except requests.RequestException:
+            response, ok = None, False
+        self.recorder.record(name, time.perf_counter() - started, ok)
+        return response
+
+    def log_in(self, record=True):
+        self.http = requests.Session()
+        started = time.perf_counter()
+        response = self.http.post(self.base_url + '/login', allow_redirects=False,
+                                  data={'email': self.account['email'], 'password': PASSWORD})
+        ok = response.status_code == 302 and 'dashboard' in response.headers.get('Location', '')
+        if record:
+            self.recorder.record('POST /login', time.perf_counter() - started, ok)
+        return ok
+
+    def consultation_id(self):
+        return self.rng.choice(self.account['consultations'])
+
+
+# Tasks; each makes one request as the given virtual user
+
+def login(user):
+    user.log_in()
+
+
+def student_dashboard(user):
+    user.request('GET /student/dashboard', 'GET', '/student/dashboard')
+
+
+def teacher_dashboard(user):
+    user.request('GET /teacher/dashboard', 'GET', '/teacher/dashboard')
+
+
+def consultation_list(user):
+    user.request('GET /api/consultations/teacher', 'GET', '/api/consultations/teacher')
+
+
+def view_consultation(user):
+    user.request('GET /consultation/<id>', 'GET', f'/consultation/{user.consultation_id()}')
+
+
+def statistics(user):
+    user.request('GET /teacher/statistics', 'GET', '/teacher/statistics')
+
+
+def trends(user):
+    by = user.rng.choice(['category', 'subcategory', 'grade', 'section'])
+    user.request('GET /api/statistics/trends', 'GET', f'/api/statistics/trends?by={by}&bucket=week')
+
+
+def reply(user):
+    user.request('POST /consultation/<id>/reply', 'POST', f'/consultation/{user.consultation_id()}/reply',
+                 ok_status=(302,), data={'message': 'Load test reply'},
+                 files={'attachment': ('notes.pdf', ATTACHMENT, 'application/pdf')})
+
+
+def poll_messages(user):
+    consultation_id = user.consultation_id()
+    after = user.last_message.get(consultation_id, 0)
+    response = user.request('GET /api/consultation/<id>/messages', 'GET',
+                            f'/api/consultation/{consultation_id}/messages?after={after}&wait={LONG_POLL_WAIT}')
+    if response is not None and response.status_code == 200:
+        user.last_message[consultation_id] = response.json()['last_id']
+
+
+def preconsultation(user):
+    user.request('POST /preconsultation', 'POST', '/preconsultation', ok_status=(302,), data={
+        'student_name': 'Load Test', 'student_grade': '11', 'student_section': 'A',
+        'category': 'school', 'subcategory': 'school_grades', 'help_type': ['talk'],
+        'message': 'Load test preconsultation', 'talked_before': 'no', 'talked_someone': 'no',
+    })
+
+
+# scenario -> [(role, share of the virtual users, [(weight, task)])]
+SCENARIOS = {
+    'login': [('student', 1, [(1, login)])],
+    'dashboards': [
+        ('student', 1, [(3, student_dashboard), (1, view_consultation)]),
+        ('teacher', 1, [(3, teacher_dashboard), (2, consultation_list), (1, view_consultation)]),
+    ],
+    'statistics': [
+        ('teacher', 1, [(2, statistics), (1, trends)]),
+        ('advocate', 1, [(2, statistics), (1, trends)]),
+    ],
+    'replies': [
+        ('student', 1, [(1, reply)]),
+        ('teacher', 1, [(1, reply)]),
+    ],
+    'preconsultation': [(None, 1, [(1, preconsultation)])],
+    'messages': [
+        ('student', 3, [(1, poll_messages)]),
+        ('teacher', 1, [(3, poll_messages), (1, reply)]),
+    ],
+}
+SCENARIOS['mixed'] = [
+    ('student', 6, [(4, student_dashboard), (2, view_consultation), (1, reply)]),
+    ('teacher', 3, [(3, teacher_dashboard), (2, consultation_list), (2, view_consultation), (1, reply), (1, statistics)]),
+    ('advocate', 1, [(2, statistics), (1, trends), (1, teacher_dashboard)]),
+    (None, 1, [(1, preconsultation)]),
+]
+
+
+def load_accounts(limit=20):
+    """Seeded accounts by role, each with up to limit of its open consultations"""
+    from models import db, User, Teacher, Student, Consultation
+
+    def consultations(column):
+        ids = defaultdict(list)
+        for owner_id, consultation_id in db.session.query(column, Consultation.id).filter(Consultation.deleted == False):
+            if len(ids[owner_id]) < limit:
+                ids[owner_id].append(consultation_id)
+        return ids
+
+    by_student, by_teacher = consultations(Consultation.student_id), consultations(Consultation.teacher_id)
+    accounts = {'student': [], 'teacher': [], 'advocate': []}
+    for email, student_id in db.session.query(User.email, Student.id).join(Student, Student.user_id == User.id).filter(Student.archived == False):
+        if by_student[student_id]:
+            accounts['student'].append({'role': 'student', 'email': email, 'consultations': by_student[student_id]})
+    for email, teacher_id, advocate in db.session.query(User.email, Teacher.id, Teacher.is_guidance_advocate).join(Teacher, Teacher.user_id == User.id):
+        if by_teacher[teacher_id]:
+            role = 'advocate' if advocate else 'teacher'
+            accounts[role].append({'role': role, 'email': email, 'consultations': by_teacher[teacher_id]})
+    return accounts
+
+
+def plan_users(scenario, count, accounts, rng):
+    """(account, tasks) for each virtual user, split between the scenario's roles by share"""
+    groups = SCENARIOS[scenario]
+    total = sum(share for _, share, _ in groups)
+    assigned = [0] * len(groups)
+    users = []
+    for i in range(count):
+        # every role gets one user first, then the role furthest below its share gets the next
+        k = i if i < len(groups) else max(range(len(groups)), key=lambda k: groups[k][1] * (i + 1) / total - assigned[k])
+        assigned[k] += 1
+        role, _, tasks = groups[k]
+        if role is not None and not accounts[role]:
+            raise SystemExit(f'No seeded {role} accounts with consultations')
+        account = rng.choice(accounts[role]) if role is not None else None
+        users.append((account, tasks))
+    return users
+
+
+class Clock:
+    """Starts the run once every virtual user is ready, so setup logins are not measured"""
+
+    def __init__(self, users, duration):
+        self.duration = duration
+        self.started = self.deadline = None
+        self.ready = threading.Barrier(users, action=self._start)
+
+    def _start(self):
+        self.started = time.perf_counter()
+        self.deadline = time.monotonic() + self.duration
+
+
+def run_user(base_url, recorder, account, tasks, clock, think, seed):
+    rng = random.Random(seed)
+    user = VirtualUser(base_url, recorder, account, rng)
+    # In the login scenario logging in is the task itself
+    logged_in = account is None or any(task is login for _, task in tasks) or user.log_in(record=False)
+    clock.ready.wait()
+    if not logged_in:
+        recorder.record('setup login', 0, False)
+        return
+    weights = [weight for weight, _ in tasks]
+    while time.monotonic() < clock.deadline:
+        rng.choices([task for _, task in tasks], weights)[0](user)
+        if think:
+            time.sleep(rng.uniform(0, 2 * think))
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report, baseline=None):
+    base_routes = (baseline or {}).get('routes', {})
+    print(f"{report['scenario']}: {report['users']} users for {report['duration']}s on {report['database']}"
+          f" (commit {report['commit'] or 'unknown'})")
+    header = f"{'route':<38} {'reqs':>6} {'err':>4} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}"
+    print(header + ('   rps / p95 vs baseline' if baseline else ''))
+    rows = list(report['routes'].items()) + ([('TOTAL', report['total'])] if report['total'] else [])
+    for name, stats in rows:
+        line = (f"{name:<38} {stats['requests']:>6} {stats['errors']:>4} {stats['rps']:>8.1f} "
+                f"{stats['p50_ms']:>8.1f} {stats['p95_ms']:>8.1f} {stats['p99_ms']:>8.1f} {stats['max_ms']:>8.1f}")
+        old = baseline.get('total') if baseline and name == 'TOTAL' else base_routes.get(name)
+        if old:
+            line += f"   {(stats['rps'] / old['rps'] - 1) * 100 if old['rps'] else 0:+6.1f}% / " \
+                    f"{(stats['p95_ms'] / old['p95_ms'] - 1) * 100 if old['p95_ms'] else 0:+6.1f}%"
+        print(line)
+    print('latencies in ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='mixed')
+    parser.add_argument('--users', type=int, default=10, help='concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run after every user has logged in')
+    parser.add_argument('--think', type=float, default=0, help='mean seconds a user waits between requests')
+    parser.add_argument('--db', help='database URI (default: a scratch SQLite file)')
+    parser.add_argument('--url', help='load an already running app instead of serving one here')
+    parser.add_argument('--sections', default='ABCDE', help='sections per grade (grades 11 and 12)')
+    parser.add_argument('--students-per-section', type=int, default=30)
+    parser.add_argument('--consultations-per-student', type=int, default=4)
+    parser.add_argument('--hash-method', default='pbkdf2:sha256:600000', help='PASSWORD_HASH_METHOD')
+    parser.add_argument('--email-latency', type=float, default=0.1, help='seconds the fake EmailJS takes per send')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--seed-only', action='store_true', help='migrate and seed the database, then exit')
+    parser.add_argument('-o', '--output', help='write the report here as JSON')
+    parser.add_argument('--compare', help='a report from an earlier run to compare against')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='load-test-')
+    os.environ['FLASK_SQLALCHEMY_DATABASE_URI'] = args.db or f'sqlite:///{scratch}/load.db'
+    os.environ['FLASK_UPLOAD_FOLDER'] = os.path.join(scratch, 'uploads')
+    os.environ['FLASK_PASSWORD_HASH_METHOD'] = args.hash_method
+
+    from fake_emailjs import FakeEmailJS
+    fake_emailjs = FakeEmailJS(latency=args.email_latency).start()
+    os.environ['FLASK_EMAILJS_API_URL'] = fake_emailjs.url
+
+    from werkzeug.security import generate_password_hash
+    from werkzeug.serving import make_server
+
+    from app import app
+    from models import db, User
+    import migrations
+    from seed_data import seed_database
+
+    with app.app_context():
+        migrations.upgrade(echo=lambda message: None)
+        if db.session.query(User.id).first() is None:
+            rows = seed_database(sections=args.sections, students_per_section=args.students_per_section,
+                                 consultations_per_student=args.consultations_per_student, seed=args.seed,
+                                 password_hash=generate_password_hash(PASSWORD, args.hash_method))
+        else:
+            rows = None
+            print('Database already has users; reusing them (their password must be the benchmark one)')
+        if args.seed_only:
+            fake_emailjs.stop()
+            return
+        accounts = load_accounts()
+        database = db.engine.dialect.name
+
+    server = None
+    base_url = args.url.rstrip('/') if args.url else None
+    if base_url is None:
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{server.server_port}'
+
+    rng = random.Random(args.seed)
+    users = plan_users(args.scenario, args.users, accounts, rng)
+    recorder = Recorder()
+    clock = Clock(len(users), args.duration)
+    with ThreadPoolExecutor(len(users)) as pool:
+        runs = [pool.submit(run_user, base_url, recorder, account, tasks, clock, args.think, args.seed + i)
+                for i, (account, tasks) in enumerate(users)]
+    for run in runs:
+        run.result()
+    elapsed = time.perf_counter() - clock.started
+
+    if server is not None:
+        server.shutdown()
+        app.extensions['passwords'].shutdown()
+    fake_emailjs.stop()
+
+    routes, total = recorder.summary(elapsed)
+    report = {
+        'scenario': args.scenario,
+        'users': args.users,
+        'duration': round(elapsed, 2),
+        'think': args.think,
+        'database': database,
+        'commit': git_commit(),
+        'started_at': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        'hash_method': args.hash_method,
+        'rows': rows,
+        'emails_sent': len(fake_emailjs.received),
+        'routes': routes,
+        'total': total,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Login storm: many students logging in at once, as at the start of a school day.
+
+Serves the real app from a threaded Werkzeug server against a scratch
+SQLite database, fires --logins concurrent POST /login requests from
+--concurrency client threads and reports throughput and p50/p99 latency.
+Compare hashing on the request thread with the process pool:
+
+    python benchmarks/login_storm.py --workers 0
+    python benchmarks/login_storm.py --workers 4
+    python benchmarks/login_storm.py --method pbkdf2:sha256:200000 --legacy-method pbkdf2:sha256:600000
+
+With --legacy-method the seeded hashes use that method, so every first
+login also pays for the transparent rehash to --method.
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = 'benchmark-password'
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=None, help='PASSWORD_HASH_WORKERS (0 = request thread)')
+    parser.add_argument('--method', default='pbkdf2:sha256:600000', help='PASSWORD_HASH_METHOD')
+    parser.add_argument('--legacy-method', help='hash the seeded passwords with this method instead')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='login-storm-')
+    os.environ['FLASK_SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{scratch}/storm.db'
+    os.environ['FLASK_EMAIL_OUTBOX_IN_PROCESS'] = 'false'
+    os.environ['FLASK_PASSWORD_HASH_METHOD'] = args.method
+    if args.workers is not None:
+        os.environ['FLASK_PASSWORD_HASH_WORKERS'] = str(args.workers)
+
+    from werkzeug.security import generate_password_hash
+    from werkzeug.serving import make_server
+
+    from app import app
+    from models import db, User
+    from seed_data import seed_database
+
+    with app.app_context():
+        db.create_all()
+        # One student per login; every account shares a password (and so a hash)
+        seed_database(grades=(11,), sections='A', students_per_section=args.logins, advocates=0,
+                      consultations_per_student=1, password_hash=generate_password_hash(PASSWORD, args.legacy_method or args.method))
+        emails = [email for (email,) in db.session.query(User.email).filter_by(user_type='student')]
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/login'
+
+    def login(email):
+        start = time.perf_counter()
+        response = requests.post(url, data={'email': email, 'password': PASSWORD}, allow_redirects=False)
+        return time.perf_counter() - start, response.status_code == 302 and 'dashboard' in response.headers.get('Location', '')
+
+    hasher = app.extensions['passwords']
+    print(f'{len(emails)} logins, {args.concurrency} concurrent, method {args.method}, '
+          f'{hasher.workers or "no"} hashing worker(s)')
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as clients:
+        results = list(clients.map(login, emails))
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    hasher.shutdown()
+
+    latencies = [latency * 1000 for latency, ok in results]
+    failures = sum(1 for _, ok in results if not ok)
+    print(f'throughput {len(results) / elapsed:8.1f} logins/s   failed {failures}')
+    print(f'latency ms p50 {percentile(latencies, 50):8.1f}   p99 {percentile(latencies, 99):8.1f}   '
+          f'max {max(latencies):8.1f}')
+    if args.legacy_method:
+        with app.app_context():
+            upgraded = sum(1 for (password_hash,) in db.session.query(User.password_hash).filter_by(user_type='student')
+                           if not hasher.needs_rehash(password_hash))
+        print(f'rehashed on login: {upgraded} of {len(emails)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""Count SQL statements per route and fail when a route exceeds its budget.
+
+Runs the real app against a seeded in-memory SQLite database through the
+Flask test client. A lazy load sneaking back into a template shows up as a
+statement count that grows with the data, so run it at two sizes:
+
+    python benchmarks/query_budget.py --students-per-section 10
+    python benchmarks/query_budget.py --students-per-section 80
+"""
+import argparse
+import os
+import sys
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('FLASK_SQLALCHEMY_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('FLASK_EMAIL_OUTBOX_IN_PROCESS', 'false')
+
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+
+from seed_data import seed_database
+
+PASSWORD = 'benchmark-password'
+
+# Upper bound on statements per request, including the login/session lookups. Each client's
+# first request caches its profile id in the session (identity.py), so the JSON routes that
+# only need the id run no profile query at all
+BUDGETS = {
+    'GET /teacher/dashboard': 4,
+    'GET /teacher/statistics': 5,
+    'GET /teacher/archived-students': 2,
+    'GET /teacher/student/<id>': 3,
+    # marking the consultation read also bumps the teacher's counters
+    'GET /consultation/<id> (teacher)': 6,
+    'GET /student/dashboard': 2,
+    'GET /api/guidance-advocates': 1,
+    'GET /api/sections/<grade>': 1,
+    'GET /api/consultations/teacher': 1,
+    'GET /api/consultations/search': 1,
+    'GET /api/statistics/trends': 1,
+    # the advocate list is served from the reference cache warmed by the API call above;
+    # the consultation also bumps the teacher's counters and its daily rollup row
+    'POST /student/consultation/new': 8,
+    'POST /preconsultation': 2,
+}
+
+
+@contextmanager
+def count_queries(engine):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def login(client, email):
+    response = client.post('/login', data={'email': email, 'password': PASSWORD})
+    assert response.status_code == 302, f'login failed for {email}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--students-per-section', type=int, default=40)
+    parser.add_argument('-v', '--verbose', action='store_true', help='print every statement')
+    args = parser.parse_args()
+
+    from app import app
+    from models import db, Teacher, Student, Consultation
+    import migrations
+
+    with app.app_context():
+        # Migrations rather than create_all() so the search index exists
+        migrations.upgrade(echo=lambda message: None)
+        seed_database(students_per_section=args.students_per_section,
+                      password_hash=generate_password_hash(PASSWORD))
+        teacher = Teacher.query.filter_by(is_guidance_advocate=False).first()
+        advocate = Teacher.query.filter_by(is_guidance_advocate=True).first()
+        consultation = Consultation.query.filter_by(teacher_id=teacher.id, deleted=False).first()
+        student = db.session.get(Student, consultation.student_id)
+        teacher_email, advocate_email, student_email = teacher.user.email, advocate.user.email, student.user.email
+        consultation_id, student_id, grade = consultation.id, student.id, student.grade
+        engine = db.engine
+
+    teacher_client, advocate_client, student_client, anonymous = (app.test_client() for _ in range(4))
+    login(teacher_client, teacher_email)
+    login(advocate_client, advocate_email)
+    login(student_client, student_email)
+
+    requests_to_check = [
+        ('GET /teacher/dashboard', lambda: teacher_client.get('/teacher/dashboard')),
+        ('GET /teacher/statistics', lambda: advocate_client.get('/teacher/statistics')),
+        ('GET /teacher/archived-students', lambda: teacher_client.get('/teacher/archived-students')),
+        ('GET /teacher/student/<id>', lambda: teacher_client.get(f'/teacher/student/{student_id}')),
+        ('GET /consultation/<id> (teacher)', lambda: teacher_client.get(f'/consultation/{consultation_id}')),
+        ('GET /student/dashboard', lambda: student_client.get('/student/dashboard')),
+        ('GET /api/guidance-advocates', lambda: anonymous.get('/api/guidance-advocates')),
+        ('GET /api/sections/<grade>', lambda: anonymous.get(f'/api/sections/{grade}')),
+        ('GET /api/consultations/teacher', lambda: teacher_client.get('/api/consultations/teacher')),
+        ('GET /api/consultations/search', lambda: teacher_client.get('/api/consultations/search?q=grades')),
+        ('GET /api/statistics/trends', lambda: advocate_client.get('/api/statistics/trends?by=section')),
+        ('POST /student/consultation/new', lambda: student_client.post('/student/consultation/new', data={
+            'category': 'school', 'subcategory': 'school_grades', 'message': 'Benchmark', 'help_type': ['talk']})),
+        ('POST /preconsultation', lambda: anonymous.post('/preconsultation', data={
+            'student_name': 'Benchmark', 'student_grade': str(grade), 'student_section': 'A',
+            'category': 'family', 'subcategory': 'family_away', 'message': 'Benchmark', 'talked_before': 'no'})),
+    ]
+
+    failures = 0
+    for name, send in requests_to_check:
+        with count_queries(engine) as statements:
+            response = send()
+        assert response.status_code < 400, f'{name} returned {response.status_code}'
+        budget = BUDGETS[name]
+        over = len(statements) > budget
+        failures += over
+        print(f"{'FAIL' if over else 'ok':>4}  {name:<34} {len(statements):>3} statements (budget {budget})")
+        if args.verbose or over:
+            for statement in statements:
+                print('        ' + ' '.join(statement.split())[:160])
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
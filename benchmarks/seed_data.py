@@ -0,0 +1,141 @@
+"""Bulk data generator for benchmarks and query-plan checks.
+
+seed_database() fills an empty schema with teachers, guidance advocates,
+students, consultations and messages using executemany inserts, so tens of
+thousands of rows take seconds rather than minutes. Must be called inside an
+app context with models.db bound to a scratch database.
+"""
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+
+from categories import CATEGORY_DATA
+from category_trends import rebuild_rollups
+from models import db, User, Teacher, Student, Consultation, ConsultationMessage
+from teacher_stats import reconcile_counters
+
+# Share of consultations per category; unlisted categories get 1
+CATEGORY_WEIGHTS = {'school': 35, 'personal': 25, 'family': 15, 'peers': 15, 'life_changes': 7, 'other': 3}
+
+
+def _subject_weights():
+    """Every (category, subcategory) key in CATEGORY_DATA and its weight"""
+    subjects, weights = [], []
+    for category, data in CATEGORY_DATA.items():
+        # within a category the first-listed concerns are the common ones
+        ranks = [1 / rank for rank in range(1, len(data['subcategories']) + 1)]
+        for subcategory, rank in zip(data['subcategories'], ranks):
+            subjects.append((category, subcategory))
+            weights.append(CATEGORY_WEIGHTS.get(category, 1) * rank / sum(ranks))
+    return subjects, weights
+
+
+SUBJECTS, SUBJECT_WEIGHTS = _subject_weights()
+
+# placeholder hash; benchmarks that log in set real hashes themselves
+PASSWORD_HASH = 'pbkdf2:sha256:600000$seed$0000000000000000000000000000000000000000000000000000000000000000'
+
+
+def _insert(model, rows, chunk=5000):
+    for i in range(0, len(rows), chunk):
+        db.session.execute(insert(model), rows[i:i + chunk])
+
+
+def seed_database(grades=(11, 12), sections='ABCDEFGHIJ', students_per_section=40,
+                  advocates=5, consultations_per_student=4, messages_per_consultation=3,
+                  days=365, seed=0, password_hash=PASSWORD_HASH):
+    """Generate a school's worth of data and return row counts per table"""
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    counts = {}
+
+    users, teachers, students = [], [], []
+    user_id = teacher_id = student_id = 0
+
+    def new_user(email, user_type):
+        nonlocal user_id
+        user_id += 1
+        users.append({'id': user_id, 'email': email, 'password_hash': password_hash,
+                      'user_type': user_type, 'created_at': now - timedelta(days=days)})
+        return user_id
+
+    section_teachers = {}
+    for grade in grades:
+        for section in sections:
+            teacher_id += 1
+            uid = new_user(f'teacher{teacher_id}@example.com', 'teacher')
+            teachers.append({'id': teacher_id, 'user_id': uid, 'first_name': f'Teacher{teacher_id}',
+                             'last_name': 'Seed', 'handling_grade': grade, 'handling_section': section,
+                             'is_guidance_advocate': False, 'created_at': now - timedelta(days=days)})
+            section_teachers[(grade, section)] = teacher_id
+
+    advocate_ids = []
+    for _ in range(advocates):
+        teacher_id += 1
+        uid = new_user(f'advocate{teacher_id}@example.com', 'teacher')
+        teachers.append({'id': teacher_id, 'user_id': uid, 'first_name': f'Advocate{teacher_id}',
+                         'last_name': 'Seed', 'is_guidance_advocate': True,
+                         'availability': 'Monday-Friday 9AM-5PM', 'created_at': now - timedelta(days=days)})
+        advocate_ids.append(teacher_id)
+
+    # (student_id, teacher_id) pairs that consultations are drawn from
+    assignments = []
+    for grade in grades:
+        for section in sections:
+            for _ in range(students_per_section):
+                student_id += 1
+                uid = new_user(f'student{student_id}@example.com', 'student')
+                advocate = rng.choice(advocate_ids) if advocate_ids and rng.random() < 0.2 else None
+                students.append({'id': student_id, 'user_id': uid, 'first_name': f'Student{student_id}',
+                                 'last_name': 'Seed', 'grade': grade, 'section': section,
+                                 'preferred_guidance_advocate_id': advocate,
+                                 'archived': rng.random() < 0.05,
+                                 'created_at': now - timedelta(days=days)})
+                assignments.append((student_id, advocate or section_teachers[(grade, section)]))
+
+    consultations, messages = [], []
+    consultation_id = message_id = 0
+    for sid, tid in assignments:
+        # a few students account for most consultations
+        for _ in range(int(rng.expovariate(1 / consultations_per_student))):
+            consultation_id += 1
+            created = now - timedelta(seconds=rng.randint(0, days * 86400))
+            if created.weekday() >= 5 and rng.random() < 0.75:
+                # school days are busier than weekends
+                created -= timedelta(days=2)
+            deleted = rng.random() < 0.05
+            category, subcategory = rng.choices(SUBJECTS, SUBJECT_WEIGHTS)[0]
+            consultations.append({'id': consultation_id, 'student_id': sid, 'teacher_id': tid,
+                                  'subject': CATEGORY_DATA[category]['subcategories'][subcategory],
+                                  'category': category, 'subcategory': subcategory,
+                                  'status': rng.choices(['pending', 'read', 'responded'], [2, 3, 5])[0],
+                                  'deleted': deleted, 'deleted_by': 'student' if deleted else None,
+                                  'deleted_at': created if deleted else None,
+                                  'created_at': created, 'updated_at': created})
+            for n in range(max(1, int(rng.expovariate(1 / messages_per_consultation)))):
+                message_id += 1
+                sender_type = 'student' if n % 2 == 0 else 'teacher'
+                messages.append({'id': message_id, 'consultation_id': consultation_id,
+                                 'sender_type': sender_type, 'sender_id': sid if sender_type == 'student' else tid,
+                                 'message': f'Seeded message {message_id}',
+                                 'created_at': created + timedelta(minutes=30 * n)})
+
+    for model, rows in [(User, users), (Teacher, teachers), (Student, students),
+                        (Consultation, consultations), (ConsultationMessage, messages)]:
+        _insert(model, rows)
+        counts[model.__tablename__] = len(rows)
+    db.session.commit()
+
+    if db.engine.dialect.name == 'postgresql':
+        # explicit ids bypass the sequences; move them past the seeded rows
+        for model in (User, Teacher, Student, Consultation, ConsultationMessage):
+            table = model.__tablename__
+            db.session.execute(db.text(
+                f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), (SELECT MAX(id) FROM \"{table}\"))"))
+        db.session.commit()
+
+    # executemany inserts skip the ORM flush hooks that maintain the counters and rollups
+    reconcile_counters()
+    rebuild_rollups()
+    return counts
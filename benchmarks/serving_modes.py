@@ -0,0 +1,138 @@
+"""Compare the threaded and gevent serving modes (serve.py) under the same load.
+
+Seeds one scratch SQLite database, then for each mode starts serve.py's
+server in a subprocess on a fresh copy of it and runs load_test.py against
+it with --url. Each run's JSON report is kept next to the database and the
+per-route request rates and p95 latencies are printed side by side:
+
+    python benchmarks/serving_modes.py --scenario messages --users 300
+    python benchmarks/serving_modes.py --scenario mixed --users 100 --db-latency 20
+
+SQLite answers in microseconds and does not yield to other greenlets, so
+--db-latency adds a sleep before every statement to stand in for the
+round trip to the remote Postgres (the sleep yields in gevent mode, as a
+psycogreen wait does). --db runs against a local Postgres instead; both
+modes then share that database.
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+HASH_METHOD = 'pbkdf2:sha256:1000'  # logins are not what is being compared
+
+
+def run_server(mode, port, db_latency, connections):
+    """The --serve entry point: serve.py's server with simulated database latency"""
+    import serve
+    serve.patch(mode)
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from app import app, start_serving
+
+    if db_latency:
+        @event.listens_for(Engine, 'before_cursor_execute')
+        def round_trip(conn, cursor, statement, parameters, context, executemany):
+            # time.sleep is gevent's by now in gevent mode
+            time.sleep(db_latency / 1000)
+
+    start_serving()
+    serve.serve(app, mode, '127.0.0.1', port, connections)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(url, process, timeout=60):
+    # Imported here so the --serve process can monkey-patch before anything loads ssl
+    import requests
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'Server exited with {process.returncode}')
+        try:
+            requests.get(url + '/login', timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise SystemExit(f'Server at {url} did not come up')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', default='threaded,gevent')
+    parser.add_argument('--scenario', default='messages')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--db-latency', type=float, default=5, help='ms added to every SQL statement')
+    parser.add_argument('--db', help='local Postgres URI (default: a scratch SQLite file per mode)')
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--email-latency', type=float, default=0.2, help='seconds the fake EmailJS takes per send')
+    parser.add_argument('--serve', choices=('threaded', 'gevent'), help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return run_server(args.serve, args.port, args.db_latency, args.connections)
+
+    from fake_emailjs import FakeEmailJS
+    fake_emailjs = FakeEmailJS(latency=args.email_latency).start()
+
+    scratch = tempfile.mkdtemp(prefix='serving-modes-')
+    template = os.path.join(scratch, 'template.db')
+    load_test = [sys.executable, os.path.join(HERE, 'load_test.py'), '--hash-method', HASH_METHOD]
+    # Seed once (Postgres: unless it already has users) so every mode starts from the same rows
+    subprocess.run(load_test + ['--db', args.db or f'sqlite:///{template}', '--seed-only'], check=True)
+    env = dict(os.environ, FLASK_PASSWORD_HASH_METHOD=HASH_METHOD, FLASK_EMAILJS_API_URL=fake_emailjs.url)
+
+    reports = {}
+    for mode in args.modes.split(','):
+        uri = args.db or f'sqlite:///{scratch}/{mode}.db'
+        if not args.db:
+            shutil.copy(template, os.path.join(scratch, f'{mode}.db'))
+        port = free_port()
+        server_env = dict(env, FLASK_SQLALCHEMY_DATABASE_URI=uri, FLASK_UPLOAD_FOLDER=os.path.join(scratch, f'uploads-{mode}'))
+        server = subprocess.Popen([sys.executable, __file__, '--serve', mode, '--port', str(port),
+                                   '--db-latency', str(args.db_latency), '--connections', str(args.connections)],
+                                  cwd=ROOT, env=server_env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        url = f'http://127.0.0.1:{port}'
+        output = os.path.join(scratch, f'{mode}.json')
+        try:
+            wait_until_up(url, server)
+            print(f'--- {mode}')
+            subprocess.run(load_test + ['--url', url, '--db', uri, '--scenario', args.scenario,
+                                        '--users', str(args.users), '--duration', str(args.duration), '-o', output],
+                           check=True)
+        finally:
+            server.terminate()
+            server.wait()
+        with open(output) as f:
+            reports[mode] = json.load(f)
+    fake_emailjs.stop()
+
+    modes = list(reports)
+    routes = sorted({name for report in reports.values() for name in report['routes']})
+    print(f'\n{args.scenario}, {args.users} users, {args.db_latency:g} ms per statement; reports in {scratch}')
+    print(f"{'route':<38}" + ''.join(f'{mode + " rps":>16}{mode + " p95":>16}' for mode in modes))
+    for name in routes + ['TOTAL']:
+        line = f'{name:<38}'
+        for mode in modes:
+            stats = reports[mode]['total'] if name == 'TOTAL' else reports[mode]['routes'].get(name)
+            line += f"{stats['rps']:>16.1f}{stats['p95_ms']:>16.1f}" if stats else f"{'-':>16}{'-':>16}"
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
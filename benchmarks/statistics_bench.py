@@ -0,0 +1,137 @@
+"""Compare the old per-student COUNT loop on /teacher/statistics with the
+grouped queries in teacher_stats.py as the section grows.
+
+Run from the repository root:
+
+    python benchmarks/statistics_bench.py [--sizes 10,100,500] [--db sqlite:///bench.db]
+
+Uses an in-memory SQLite database by default, so the numbers show how the
+query count scales; point --db at a local Postgres to see real round-trip cost.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from sqlalchemy import event
+
+from models import db, User, Teacher, Student, Consultation
+from teacher_stats import compute_teacher_statistics
+
+
+def legacy_statistics(teacher):
+    """The statistics computation as it was before teacher_stats.py"""
+    students = Student.query.filter_by(grade=teacher.handling_grade, section=teacher.handling_section, archived=False).all()
+    consultations = Consultation.query.filter_by(teacher_id=teacher.id).all()
+    total_students = len(students)
+    total_consultations = len(consultations)
+    pending = Consultation.query.filter_by(teacher_id=teacher.id, status='pending', deleted=False).count()
+    read = Consultation.query.filter_by(teacher_id=teacher.id, status='read', deleted=False).count()
+    responded = Consultation.query.filter_by(teacher_id=teacher.id, status='responded', deleted=False).count()
+    unique_sections = db.session.query(Student.section).filter_by(
+        grade=teacher.handling_grade, section=teacher.handling_section).distinct().count()
+    with_consultations = db.session.query(Consultation.student_id).filter_by(
+        teacher_id=teacher.id, deleted=False).distinct().count()
+    student_stats = []
+    for student in students:
+        count = Consultation.query.filter_by(student_id=student.id, teacher_id=teacher.id, deleted=False).count()
+        student_stats.append({'student': student, 'consultation_count': count})
+    student_stats.sort(key=lambda x: x['consultation_count'], reverse=True)
+    return {
+        'total_students': total_students,
+        'total_consultations': total_consultations,
+        'pending_consultations': pending,
+        'read_consultations': read,
+        'responded_consultations': responded,
+        'unique_sections': unique_sections,
+        'students_with_consultations': with_consultations,
+    }, student_stats
+
+
+def seed_section(section_size, consultations_per_student=3):
+    """Create one teacher with a section of section_size students"""
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    section = 'A'
+    teacher_user = User(email='teacher@example.com', password_hash='x', user_type='teacher')
+    db.session.add(teacher_user)
+    db.session.flush()
+    teacher = Teacher(user_id=teacher_user.id, first_name='Bench', last_name='Teacher',
+                      handling_grade=11, handling_section=section)
+    db.session.add(teacher)
+    db.session.flush()
+    rng = random.Random(section_size)
+    for i in range(section_size):
+        user = User(email=f'student{i}@example.com', password_hash='x', user_type='student')
+        db.session.add(user)
+        db.session.flush()
+        student = Student(user_id=user.id, first_name=f'Student{i}', last_name='Bench', grade=11, section=section)
+        db.session.add(student)
+        db.session.flush()
+        for _ in range(rng.randint(0, consultations_per_student * 2)):
+            db.session.add(Consultation(
+                student_id=student.id,
+                teacher_id=teacher.id,
+                subject='Worry About Grades or Performance',
+                status=rng.choice(['pending', 'read', 'responded']),
+                deleted=rng.random() < 0.1
+            ))
+    db.session.commit()
+    return teacher.id
+
+
+def measure(fn, teacher_id, repeat):
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = db.engine
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        timings = []
+        for _ in range(repeat):
+            statements.clear()
+            db.session.expire_all()
+            teacher = db.session.get(Teacher, teacher_id)
+            statements.clear()
+            start = time.perf_counter()
+            result = fn(teacher)
+            timings.append(time.perf_counter() - start)
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    timings.sort()
+    return result, len(statements), timings[len(timings) // 2] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='10,50,200,1000')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--db', default='sqlite://')
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.db
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+
+    print(f"{'students':>9} | {'legacy queries':>14} {'legacy ms':>10} | {'grouped queries':>15} {'grouped ms':>10}")
+    with app.app_context():
+        for size in [int(s) for s in args.sizes.split(',')]:
+            teacher_id = seed_section(size)
+            legacy, legacy_queries, legacy_ms = measure(legacy_statistics, teacher_id, args.repeat)
+            grouped, grouped_queries, grouped_ms = measure(compute_teacher_statistics, teacher_id, args.repeat)
+            for key, value in legacy[0].items():
+                assert grouped[0][key] == value, f'{key}: {grouped[0][key]} != {value}'
+            assert sorted(s['consultation_count'] for s in legacy[1]) == sorted(s['consultation_count'] for s in grouped[1])
+            print(f'{size:>9} | {legacy_queries:>14} {legacy_ms:>10.2f} | {grouped_queries:>15} {grouped_ms:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Consultation categories offered on the new consultation and preconsultation forms.
+
+The keys ('school', 'school_grades') are stored on Consultation and used by
+the trend rollups; the labels are what students and teachers see.
+"""
+
+# Category data for consultation mapping
+CATEGORY_DATA = {
+    'family': {
+        'label': 'Family & Home Situation',
+        'subcategories': {
+            'family_pressure': 'Pressure from Parents or Guardians',
+            'family_arguments': 'Frequent Arguments at Home',
+            'family_away': 'Living Away from Parents / Guardians',
+            'family_unsupported': 'Feeling Unsupported at Home',
+            'family_financial': 'Financial Difficulties Affecting Family'
+        }
+    },
+    'school': {
+        'label': 'School & Academic Concerns',
+        'subcategories': {
+            'school_requirements': 'Too Many School Requirements',
+            'school_difficulty': 'Difficulty Keeping Up with Lessons',
+            'school_fear': 'Fear of Disappointing Teachers or Parents',
+            'school_time': 'Trouble Managing Time',
+            'school_grades': 'Worry About Grades or Performance'
+        }
+    },
+    'peers': {
+        'label': 'Peer & Social Relationships',
+        'subcategories': {
+            'peers_problems': 'Problems with Friends',
+            'peers_ignored': 'Feeling Left Out or Ignored',
+            'peers_conflict': 'Conflict with Classmates',
+            'peers_teased': 'Being Teased or Treated Unfairly',
+            'peers_pressure': 'Pressure to Fit In'
+        }
+    },
+    'personal': {
+        'label': 'Personal Feelings & Daily Struggles',
+        'subcategories': {
+            'personal_overwhelmed': 'Feeling Overwhelmed by Responsibilities',
+            'personal_feelings': 'Difficulty Expressing Feelings',
+            'personal_unmotivated': 'Feeling Unmotivated or Tired Most Days',
+            'personal_focus': 'Trouble Focusing or Concentrating',
+            'personal_misunderstood': 'Feeling Misunderstood'
+        }
+    },
+    'life_changes': {
+        'label': 'Life Changes & Adjustments',
+        'subcategories': {
+            'changes_senior_high': 'Adjusting to Senior High School',
+            'changes_home_school': 'Changes at Home or School',
+            'changes_responsibilities': 'New Responsibilities',
+            'changes_routine': 'Loss of Routine or Structure',
+            'changes_future': 'Preparing for the Future'
+        }
+    },
+    'other': {
+        'label': 'Other',
+        'subcategories': {
+            'other_concern': 'Something Else I Want to Talk About'
+        }
+    }
+}
+
+
+def get_subcategory_label(category, subcategory):
+    """Get the full descriptive label for a subcategory"""
+    if category in CATEGORY_DATA and subcategory in CATEGORY_DATA[category]['subcategories']:
+        return CATEGORY_DATA[category]['subcategories'][subcategory]
+    return subcategory.replace('_', ' ').title()
+
+
+def category_keys(category, subcategory):
+    """(category, subcategory) as submitted, with any key not in CATEGORY_DATA replaced by None"""
+    if category not in CATEGORY_DATA:
+        return None, None
+    if subcategory not in CATEGORY_DATA[category]['subcategories']:
+        return category, None
+    return category, subcategory
@@ -0,0 +1,192 @@
+"""Daily consultation rollups behind the category trend charts.
+
+ConsultationDailyRollup keeps one count per (UTC day, teacher, category,
+subcategory, student grade, section). A flush hook adds each new
+consultation to its row with an upsert in the same transaction, so the
+trends API reads a few hundred rollup rows instead of scanning and parsing
+every consultation. Rows count consultations opened; a later soft delete
+does not take one back out. Grade and section are the student's when the
+consultation was opened.
+
+Bulk Core inserts bypass the hook, so follow them with rebuild_rollups().
+"""
+from datetime import date, datetime, timedelta
+
+import click
+from sqlalchemy import delete, event, func, inspect, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from categories import CATEGORY_DATA
+from models import db, Student, Consultation, ConsultationDailyRollup
+
+DEFAULT_CONFIG = {
+    'TRENDS_DEFAULT_WEEKS': 12,  # range returned when ?start= is not given
+    'TRENDS_MAX_DAYS': 731,  # longest range one request may ask for
+}
+
+KEY_COLUMNS = ('day', 'teacher_id', 'category', 'subcategory', 'grade', 'section')
+
+# ?by= value -> rollup columns a series is keyed on
+DIMENSIONS = {
+    'category': ('category',),
+    'subcategory': ('category', 'subcategory'),
+    'grade': ('grade',),
+    'section': ('grade', 'section'),
+}
+
+BUCKETS = ('day', 'week')
+
+_DIALECT_INSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+
+def _upsert(connection, rows):
+    """Add each row's count to the matching rollup row, creating it if needed"""
+    table = ConsultationDailyRollup.__table__
+    statement = _DIALECT_INSERTS[connection.dialect.name](table)
+    statement = statement.on_conflict_do_update(
+        index_elements=KEY_COLUMNS,
+        set_={'count': table.c.count + statement.excluded['count']}
+    )
+    connection.execute(statement, rows)
+
+
+@event.listens_for(Session, 'after_flush')
+def _update_rollups(session, flush_context):
+    new = [obj for obj in session.new if isinstance(obj, Consultation)]
+    if not new:
+        return
+    connection = session.connection()
+    # The student is normally already loaded by whoever created the consultation
+    unloaded = {obj.student_id for obj in new if 'student' in inspect(obj).unloaded}
+    placement = {}
+    if unloaded:
+        placement = dict(
+            (student_id, (grade, section)) for student_id, grade, section in connection.execute(
+                select(Student.id, Student.grade, Student.section).where(Student.id.in_(unloaded)))
+        )
+    counts = {}
+    for obj in new:
+        if obj.student_id in placement:
+            grade, section = placement[obj.student_id]
+        else:
+            grade, section = obj.student.grade, obj.student.section
+        key = (obj.created_at.date(), obj.teacher_id, obj.category or '', obj.subcategory or '',
+               grade or 0, section or '')
+        counts[key] = counts.get(key, 0) + 1
+    _upsert(connection, [dict(zip(KEY_COLUMNS, key), count=count) for key, count in counts.items()])
+
+
+def rebuild_rollups():
+    """Recount every rollup row from Consultation; returns the number of rows written"""
+    day = func.date(Consultation.created_at)
+    key = [
+        day,
+        Consultation.teacher_id,
+        func.coalesce(Consultation.category, ''),
+        func.coalesce(Consultation.subcategory, ''),
+        func.coalesce(Student.grade, 0),
+        func.coalesce(Student.section, ''),
+    ]
+    grouped = select(*key, func.count(Consultation.id)).join(
+        Student, Student.id == Consultation.student_id
+    ).group_by(*key)
+    db.session.execute(delete(ConsultationDailyRollup))
+    result = db.session.execute(
+        ConsultationDailyRollup.__table__.insert().from_select(KEY_COLUMNS + ('count',), grouped)
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def bucket_start(day, bucket):
+    """First day of the bucket containing day; weeks start on Monday"""
+    return day - timedelta(days=day.weekday()) if bucket == 'week' else day
+
+
+def _label(by, key):
+    if by in ('category', 'subcategory'):
+        data = CATEGORY_DATA.get(key[0])
+        if data is None:
+            return 'Uncategorized'
+        if by == 'category':
+            return data['label']
+        return data['subcategories'].get(key[1], f"{data['label']} (unspecified)")
+    if not key[0]:
+        return 'No grade'
+    return f'Grade {key[0]}' if by == 'grade' else f'Grade {key[0]} {key[1] or "(no section)"}'
+
+
+def category_trends(start, end, by='category', bucket='week', teacher_id=None, category=None):
+    """Consultations opened per bucket between start and end (inclusive), one series per ?by= key.
+
+    teacher_id limits the counts to one teacher's consultations; category
+    limits them to one category, e.g. to break it down by subcategory.
+    """
+    rollup = ConsultationDailyRollup
+    dimensions = [getattr(rollup, column) for column in DIMENSIONS[by]]
+    query = select(rollup.day, *dimensions, func.sum(rollup.count)).where(
+        rollup.day >= start, rollup.day <= end
+    ).group_by(rollup.day, *dimensions)
+    if teacher_id is not None:
+        query = query.where(rollup.teacher_id == teacher_id)
+    if category is not None:
+        query = query.where(rollup.category == category)
+
+    buckets = []
+    day = bucket_start(start, bucket)
+    while day <= end:
+        buckets.append(day)
+        day += timedelta(days=7 if bucket == 'week' else 1)
+    position = {day: i for i, day in enumerate(buckets)}
+
+    series = {}
+    for day, *key, count in db.session.execute(query):
+        counts = series.setdefault(tuple(key), [0] * len(buckets))
+        counts[position[bucket_start(day, bucket)]] += count
+    ordered = sorted(series.items(), key=lambda item: (-sum(item[1]), item[0]))
+    return {
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'bucket': bucket,
+        'by': by,
+        'buckets': [day.isoformat() for day in buckets],
+        'series': [
+            {
+                'key': dict(zip(DIMENSIONS[by], (value or None for value in key))),
+                'label': _label(by, key),
+                'counts': counts,
+                'total': sum(counts),
+            }
+            for key, counts in ordered
+        ],
+        'total': sum(sum(counts) for counts in series.values()),
+    }
+
+
+def parse_range(args, config, today=None):
+    """(start, end) from ?start=&end= ISO dates; raises ValueError with a message for the client"""
+    # Rollup days are UTC days
+    today = today or datetime.utcnow().date()
+    try:
+        end = date.fromisoformat(args['end']) if args.get('end') else today
+        start = date.fromisoformat(args['start']) if args.get('start') else (
+            bucket_start(end, 'week') - timedelta(weeks=config['TRENDS_DEFAULT_WEEKS'] - 1))
+    except ValueError:
+        raise ValueError('Dates must be YYYY-MM-DD')
+    if start > end:
+        raise ValueError('start must not be after end')
+    if (end - start).days >= config['TRENDS_MAX_DAYS']:
+        raise ValueError(f"At most {config['TRENDS_MAX_DAYS']} days per request")
+    return start, end
+
+
+def init_app(app):
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+
+    @app.cli.command('rebuild-trends')
+    def rebuild_trends_command():
+        """Recount the daily consultation rollups from the consultation table."""
+        rows = rebuild_rollups()
+        click.echo(f'Rebuilt {rows} rollup row(s)')
@@ -0,0 +1,116 @@
+"""Full-text search over consultation subjects and messages.
+
+PostgreSQL: GIN expression indexes on to_tsvector('english', ...) of
+consultation.subject and consultation_message.message, declared in models.py.
+The database maintains them on every insert, so no extra column or trigger
+is needed.
+
+SQLite: two FTS5 tables that use consultation and consultation_message as
+external content and are kept current by triggers, so search also works on
+a local database and in the benchmarks.
+
+Both are installed by migration 0005 (flask db upgrade). Every search term
+must appear in the subject or in one message. Results are limited to one
+teacher's consultations that are not deleted and ranked by relevance: every
+matching message adds to a consultation's score, and a subject match counts
+SUBJECT_WEIGHT times as much as a message match.
+"""
+import re
+
+from sqlalchemy import and_, column, func, literal_column, select, table, union_all
+from sqlalchemy.orm import joinedload
+
+from models import db, Consultation, ConsultationMessage, search_vector
+
+SUBJECT_WEIGHT = 2.0
+MAX_TERMS = 10
+
+# (FTS5 table, content table, indexed column)
+SQLITE_FTS_TABLES = [
+    ('consultation_fts', 'consultation', 'subject'),
+    ('consultation_message_fts', 'consultation_message', 'message'),
+]
+
+
+def install_sqlite(connection):
+    """Create the FTS5 tables and their triggers if missing, then index the existing rows"""
+    for fts, source, col in SQLITE_FTS_TABLES:
+        remove = f"INSERT INTO {fts}({fts}, rowid, {col}) VALUES ('delete', old.id, old.{col});"
+        add = f"INSERT INTO {fts}(rowid, {col}) VALUES (new.id, new.{col});"
+        for ddl in [
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+            f"{col}, content='{source}', content_rowid='id', tokenize='porter unicode61')",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {source} BEGIN {add} END",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {source} BEGIN {remove} END",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {col} ON {source} BEGIN {remove} {add} END",
+            f"INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+        ]:
+            connection.exec_driver_sql(ddl)
+
+
+def query_terms(text):
+    """Words to search for; punctuation and query syntax are dropped"""
+    return re.findall(r'\w+', text.lower())[:MAX_TERMS]
+
+
+def _postgres_hits(terms):
+    query = func.plainto_tsquery(literal_column("'english'"), ' '.join(terms))
+    subject = search_vector(Consultation.subject)
+    message = search_vector(ConsultationMessage.message)
+    subject_hits = select(
+        Consultation.id.label('consultation_id'),
+        (func.ts_rank(subject, query) * SUBJECT_WEIGHT).label('score')
+    ).where(subject.op('@@')(query))
+    message_hits = select(
+        ConsultationMessage.consultation_id,
+        func.ts_rank(message, query).label('score')
+    ).join(Consultation, Consultation.id == ConsultationMessage.consultation_id).where(message.op('@@')(query))
+    return subject_hits, message_hits
+
+
+def _sqlite_hits(terms):
+    # Quoted terms are matched literally (after stemming) and ANDed, like plainto_tsquery
+    match = ' '.join(f'"{term}"' for term in terms)
+    subject_fts = table('consultation_fts', column('rowid'))
+    message_fts = table('consultation_message_fts', column('rowid'))
+
+    def matches(fts):
+        return literal_column(fts.name).op('MATCH')(match)
+
+    def rank(fts):
+        # bm25() is lower-is-better
+        return -func.bm25(literal_column(fts.name))
+
+    subject_hits = select(
+        Consultation.id.label('consultation_id'),
+        (rank(subject_fts) * SUBJECT_WEIGHT).label('score')
+    ).select_from(subject_fts).join(Consultation, Consultation.id == subject_fts.c.rowid).where(matches(subject_fts))
+    message_hits = select(
+        ConsultationMessage.consultation_id,
+        rank(message_fts).label('score')
+    ).select_from(message_fts).join(
+        ConsultationMessage, ConsultationMessage.id == message_fts.c.rowid
+    ).join(Consultation, Consultation.id == ConsultationMessage.consultation_id).where(matches(message_fts))
+    return subject_hits, message_hits
+
+
+def search_consultations(teacher_id, text, limit=20, offset=0):
+    """Return (consultations, has_more) for teacher_id matching text, best match first"""
+    terms = query_terms(text)
+    if not terms:
+        return [], False
+    if db.engine.dialect.name == 'postgresql':
+        subject_hits, message_hits = _postgres_hits(terms)
+    else:
+        subject_hits, message_hits = _sqlite_hits(terms)
+
+    scope = and_(Consultation.teacher_id == teacher_id, Consultation.deleted == False)
+    hits = union_all(subject_hits.where(scope), message_hits.where(scope)).subquery()
+    ranked = select(
+        hits.c.consultation_id, func.sum(hits.c.score).label('score')
+    ).group_by(hits.c.consultation_id).subquery()
+    # Fetch one extra row to know whether another page exists
+    rows = Consultation.query.join(ranked, ranked.c.consultation_id == Consultation.id).options(
+        joinedload(Consultation.student)
+    ).order_by(ranked.c.score.desc(), Consultation.id.desc()).offset(offset).limit(limit + 1).all()
+    return rows[:limit], len(rows) > limit
@@ -0,0 +1,163 @@
+"""Engine and connection pool settings for the remote PostgreSQL database.
+
+The database is a network round trip away and its proxy drops idle
+connections, so the defaults matter:
+
+* DB_POOL_PRE_PING tests a connection before handing it out and replaces it
+  if the server closed it while idle, instead of failing the request.
+* DB_POOL_RECYCLE retires connections before the proxy times them out.
+* DB_STATEMENT_TIMEOUT_MS makes PostgreSQL cancel a runaway query rather
+  than let it hold a connection (and a worker) indefinitely.
+* warm_up() opens DB_POOL_WARM_UP connections when the app starts serving
+  (app.start_serving(), not on import, so CLI commands stay quick) so the
+  first requests do not each pay for a TCP + TLS handshake.
+
+init_app() must run before db.init_app(), which is when Flask-SQLAlchemy
+reads SQLALCHEMY_ENGINE_OPTIONS. Anything already set there wins over the
+DB_* keys. PoolMetrics counts checkouts and how long they waited; stats()
+reports them with the pool's current occupancy.
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event, exc, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = {
+    'DB_POOL_SIZE': 5,  # connections kept open per process
+    'DB_MAX_OVERFLOW': 10,  # extra connections allowed under load, closed when returned
+    'DB_POOL_TIMEOUT': 10,  # seconds a request waits for a free connection before failing
+    'DB_POOL_RECYCLE': 300,  # seconds before a connection is replaced
+    'DB_POOL_PRE_PING': True,
+    'DB_STATEMENT_TIMEOUT_MS': 15000,  # PostgreSQL statement_timeout; 0 disables
+    'DB_CONNECT_TIMEOUT': 10,  # seconds to establish a new connection
+    'DB_POOL_WARM_UP': None,  # connections opened at startup; None means DB_POOL_SIZE, 0 skips
+}
+
+
+class PoolMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.timeouts = 0
+        self.connections_opened = 0
+        self.invalidated = 0
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def pool_class(self):
+        """A QueuePool subclass that reports into this object"""
+        metrics = self
+
+        class InstrumentedQueuePool(QueuePool):
+            def _do_get(self):
+                # Time from asking for a connection to getting one, including opening it
+                started = time.perf_counter()
+                try:
+                    return super()._do_get()
+                except exc.TimeoutError:
+                    metrics._count('timeouts')
+                    raise
+                finally:
+                    metrics.record_wait(time.perf_counter() - started)
+
+        event.listen(InstrumentedQueuePool, 'connect', lambda *args: metrics._count('connections_opened'))
+        # Includes connections pre-ping found dead
+        event.listen(InstrumentedQueuePool, 'invalidate', lambda *args: metrics._count('invalidated'))
+        return InstrumentedQueuePool
+
+    def stats(self, engine=None):
+        """Counters since startup, plus the current occupancy of engine's pool if given"""
+        with self._lock:
+            stats = {
+                'checkouts': self.checkouts,
+                'wait_seconds_total': round(self.wait_seconds_total, 6),
+                'wait_seconds_max': round(self.wait_seconds_max, 6),
+                'timeouts': self.timeouts,
+                'connections_opened': self.connections_opened,
+                'invalidated': self.invalidated,
+            }
+        pool = engine.pool if engine is not None else None
+        if isinstance(pool, QueuePool):
+            stats.update({
+                'size': pool.size(),
+                'checked_out': pool.checkedout(),
+                'idle': pool.checkedin(),
+                'overflow': max(pool.overflow(), 0),
+            })
+        return stats
+
+
+def engine_options(uri, config, metrics):
+    """SQLALCHEMY_ENGINE_OPTIONS for uri built from the DB_* config keys"""
+    url = make_url(uri)
+    options = {'pool_pre_ping': config['DB_POOL_PRE_PING']}
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        # Flask-SQLAlchemy gives in-memory SQLite a single shared connection; there is no pool to size
+        return options
+    options.update({
+        'poolclass': metrics.pool_class(),
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+    })
+    if url.get_backend_name() == 'postgresql':
+        connect_args = {'connect_timeout': config['DB_CONNECT_TIMEOUT']}
+        if config['DB_STATEMENT_TIMEOUT_MS']:
+            connect_args['options'] = f"-c statement_timeout={int(config['DB_STATEMENT_TIMEOUT_MS'])}"
+        options['connect_args'] = connect_args
+    return options
+
+
+def warm_up(engine, count):
+    """Open count pooled connections in parallel and return them to the pool; returns how many opened"""
+    if not count or not isinstance(engine.pool, QueuePool):
+        return 0
+    # Connections made before a fork must not be shared with the child
+    os.register_at_fork(after_in_child=lambda: engine.dispose(close=False))
+    started = time.perf_counter()
+    connections = []
+    try:
+        # Each thread holds its connection until all are open, so every checkout opens a new one
+        with ThreadPoolExecutor(count) as executor:
+            for connection in executor.map(lambda _: engine.connect(), range(count)):
+                connections.append(connection)
+        for connection in connections:
+            connection.execute(text('SELECT 1'))
+    except exc.SQLAlchemyError as e:
+        log.warning('Database pool warm-up failed after %d connection(s): %s', len(connections), e)
+    finally:
+        for connection in connections:
+            connection.close()
+    log.info('Opened %d database connection(s) in %.2fs', len(connections), time.perf_counter() - started)
+    return len(connections)
+
+
+def init_app(app):
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    if app.config['DB_POOL_WARM_UP'] is None:
+        app.config['DB_POOL_WARM_UP'] = app.config['DB_POOL_SIZE']
+    metrics = PoolMetrics()
+    options = engine_options(app.config['SQLALCHEMY_DATABASE_URI'], app.config, metrics)
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+    app.extensions['db_pool'] = metrics
+    return metrics
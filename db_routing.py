@@ -0,0 +1,69 @@
+"""Send read-only views to a read replica.
+
+With DATABASE_REPLICA_URI set, the replica is added as the 'replica' bind
+and views decorated with @use_replica read from it. Everything else, and
+any flush or INSERT/UPDATE/DELETE issued from a replica view, still goes to
+the primary. Once a request has written, its later reads go to the
+primary too.
+
+Replicas lag behind the primary. A user who has just written (posted a
+reply, marked a consultation read) is pinned to the primary for
+DB_REPLICA_STICKY_SECONDS, through a timestamp in their session cookie, so
+they always see their own change on the next page.
+
+For local testing, point both URIs at SQLite files holding the same
+schema, e.g. FLASK_DATABASE_REPLICA_URI=sqlite:////tmp/replica.db.
+"""
+import functools
+import time
+
+from flask import current_app, session
+from flask_sqlalchemy.session import Session
+
+DEFAULT_CONFIG = {
+    'DATABASE_REPLICA_URI': None,  # None sends everything to the primary
+    'DB_REPLICA_STICKY_SECONDS': 10,  # read from the primary this long after a user's last write
+}
+
+REPLICA_BIND = 'replica'
+STICKY_KEY = 'db_primary_until'
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            if self._flushing or getattr(clause, 'is_dml', False):
+                # Every ORM write flushes, and every flush asks for a bind
+                self.info['wrote'] = True
+            elif self.info.get('use_replica') and not self.info.get('wrote'):
+                replica = self._db.engines.get(REPLICA_BIND)
+                if replica is not None:
+                    return replica
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+
+def use_replica(view):
+    """Serve the view's reads from the replica unless the user wrote something moments ago"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if session.get(STICKY_KEY, 0) < time.time():
+            current_app.extensions['sqlalchemy'].session.info['use_replica'] = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def init_app(app):
+    """Register the replica bind; call before db.init_app()"""
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    replica_uri = app.config['DATABASE_REPLICA_URI']
+    if not replica_uri:
+        return
+    app.config['SQLALCHEMY_BINDS'] = {**app.config.get('SQLALCHEMY_BINDS', {}), REPLICA_BIND: replica_uri}
+
+    @app.after_request
+    def stick_to_primary(response):
+        db_session = app.extensions['sqlalchemy'].session
+        if db_session.registry.has() and db_session().info.get('wrote'):
+            session[STICKY_KEY] = time.time() + app.config['DB_REPLICA_STICKY_SECONDS']
+        return response
@@ -0,0 +1,428 @@
+"""Persistent email outbox drained by a background worker.
+
+Request handlers call enqueue_email(), which only adds an EmailOutbox row to
+the current transaction. OutboxWorker claims due rows in batches, posts them
+to EmailJS from a small thread pool and records the outcome: sent, retried
+later with exponential backoff, or moved to the 'dead' state once
+EMAIL_OUTBOX_MAX_ATTEMPTS is reached.
+
+EmailJSClient keeps one pooled keep-alive session, so consecutive sends
+reuse a TLS connection instead of opening a new one each. It sits behind a
+circuit breaker: after EMAILJS_BREAKER_FAILURES consecutive errors it stops
+calling EmailJS for EMAILJS_BREAKER_RESET seconds, then lets one probe
+through and closes again if the probe succeeds. Messages refused while the
+breaker is open are rescheduled without using up an attempt. Latency, error
+and breaker counters are exported through stats().
+
+Notifications sent with enqueue_digest() can be batched instead. With
+EMAIL_DIGEST_WINDOW set, each recipient's notifications wait as
+EmailDigestItem rows. Once a recipient's oldest one is EMAIL_DIGEST_WINDOW
+seconds old, the worker folds them into a single summary email, and
+recipients with identical digests share one send. Notifications for the
+categories or subcategories in EMAIL_DIGEST_URGENT skip the wait.
+"""
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import click
+import requests
+from requests.adapters import HTTPAdapter
+
+from instrumentation import track_http
+from models import db, EmailOutbox, EmailDigestItem
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = {
+    'EMAILJS_API_URL': 'https://api.emailjs.com/api/v1.0/email/send',
+    'EMAILJS_TIMEOUT': 10,  # seconds to wait for the response
+    'EMAILJS_CONNECT_TIMEOUT': 3,
+    'EMAILJS_BREAKER_FAILURES': 5,  # consecutive failures that open the circuit
+    'EMAILJS_BREAKER_RESET': 30,  # seconds the circuit stays open before a probe is let through
+    'EMAIL_OUTBOX_BATCH_SIZE': 20,
+    'EMAIL_OUTBOX_WORKERS': 4,
+    'EMAIL_OUTBOX_POLL_INTERVAL': 5,  # seconds between polls when idle
+    'EMAIL_OUTBOX_LEASE': 60,  # seconds before an unfinished 'sending' row is reclaimed
+    'EMAIL_OUTBOX_MAX_ATTEMPTS': 6,
+    'EMAIL_OUTBOX_RETRY_BASE': 30,  # first retry delay in seconds, doubled per attempt
+    'EMAIL_OUTBOX_RETRY_MAX': 3600,
+    'EMAIL_OUTBOX_IN_PROCESS': True,  # start the worker inside the web process
+    'EMAIL_DIGEST_WINDOW': 0,  # seconds to collect notifications per recipient; 0 sends each one right away
+    'EMAIL_DIGEST_MAX_ITEMS': 50,  # notifications per digest; the rest go in the next one
+    'EMAIL_DIGEST_URGENT': ('peers_teased',),  # category or subcategory keys that are never delayed
+}
+
+
+class CircuitOpen(Exception):
+    """The circuit breaker is refusing calls until its reset timeout has passed"""
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name, failures=5, reset_timeout=30, clock=time.monotonic):
+        self.name = name
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opens = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def before_call(self):
+        """Raise CircuitOpen unless a call may go ahead now"""
+        with self._lock:
+            if self.state == self.OPEN:
+                if self._clock() - self._opened_at < self.reset_timeout:
+                    raise CircuitOpen(f'{self.name} circuit is open')
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN:
+                # Only one probe at a time; everyone else keeps failing fast
+                if self._probing:
+                    raise CircuitOpen(f'{self.name} circuit is half-open')
+                self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info('%s circuit closed', self.name)
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failures:
+                if self.state != self.OPEN:
+                    self.opens += 1
+                    logger.warning('%s circuit opened after %s consecutive failures', self.name, self.consecutive_failures)
+                self.state = self.OPEN
+                self._opened_at = self._clock()
+
+    def retry_in(self):
+        """Seconds until an open circuit lets a probe through; 0 otherwise"""
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0
+            return max(self._opened_at + self.reset_timeout - self._clock(), 0)
+
+
+class EmailJSError(Exception):
+    def __init__(self, status_code, text):
+        super().__init__(f'EmailJS error {status_code}: {text}')
+        self.status_code = status_code
+
+
+class EmailJSClient:
+    def __init__(self, config):
+        self.config = config
+        self.session = requests.Session()
+        # One pooled keep-alive connection per outbox thread
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(config['EMAIL_OUTBOX_WORKERS'], 1))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.breaker = CircuitBreaker('EmailJS', config['EMAILJS_BREAKER_FAILURES'], config['EMAILJS_BREAKER_RESET'])
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.rejected = 0
+        self.seconds_total = 0.0
+        self.seconds_max = 0.0
+
+    def send(self, subject, body, recipients):
+        """Send one message through the EmailJS REST API, raising on failure (CircuitOpen without calling it)"""
+        try:
+            self.breaker.before_call()
+        except CircuitOpen:
+            with self._lock:
+                self.rejected += 1
+            raise
+        config = self.config
+        data = {
+            "service_id": config['EMAILJS_SERVICE_ID'],
+            "template_id": config['EMAILJS_TEMPLATE_ID'],
+            "user_id": config['EMAILJS_USER_ID'],
+            "accessToken": config['EMAILJS_ACCESS_TOKEN'],
+            "template_params": {
+                "to_email": recipients if isinstance(recipients, str) else ', '.join(recipients),
+                "subject": subject,
+                "message": body
+            }
+        }
+        started = time.perf_counter()
+        status_code = None
+        try:
+            with track_http():
+                response = self.session.post(config['EMAILJS_API_URL'], json=data,
+                                             timeout=(config['EMAILJS_CONNECT_TIMEOUT'], config['EMAILJS_TIMEOUT']))
+            status_code = response.status_code
+            if status_code not in [200, 201, 202]:
+                raise EmailJSError(status_code, response.text)
+        finally:
+            self._record(time.perf_counter() - started, status_code)
+
+    def _record(self, seconds, status_code):
+        """Count one call; status_code is None when no response came back"""
+        with self._lock:
+            self.requests += 1
+            self.failures += status_code not in (200, 201, 202)
+            self.seconds_total += seconds
+            self.seconds_max = max(self.seconds_max, seconds)
+        # A rejected message says nothing about EmailJS being down; timeouts, 5xx and rate limits do
+        if status_code is None or status_code >= 500 or status_code == 429:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'requests': self.requests,
+                'failures': self.failures,
+                'rejected': self.rejected,
+                'seconds_total': round(self.seconds_total, 6),
+                'seconds_max': round(self.seconds_max, 6),
+            }
+        stats['circuit_open'] = int(self.breaker.state == CircuitBreaker.OPEN)
+        stats['circuit_opens'] = self.breaker.opens
+        stats['consecutive_failures'] = self.breaker.consecutive_failures
+        return stats
+
+    def close(self):
+        self.session.close()
+
+
+def enqueue_email(subject, body, recipients):
+    """Add a message to the outbox as part of the caller's transaction"""
+    if not recipients:
+        return None
+    recipient_str = recipients if isinstance(recipients, str) else ', '.join(recipients)
+    message = EmailOutbox(recipients=recipient_str, subject=subject[:255], body=body)
+    db.session.add(message)
+    return message
+
+
+def enqueue_digest(config, subject, body, recipients, category=None, subcategory=None):
+    """Queue a notification for recipients' digests, or send it now if digests are off or it is urgent"""
+    urgent = {category, subcategory} & set(config['EMAIL_DIGEST_URGENT']) - {None}
+    if not config['EMAIL_DIGEST_WINDOW'] or urgent:
+        return enqueue_email(subject, body, recipients)
+    if isinstance(recipients, str):
+        recipients = [recipient.strip() for recipient in recipients.split(',')]
+    for recipient in recipients:
+        db.session.add(EmailDigestItem(recipient=recipient, subject=subject[:255], body=body))
+
+
+def digest_message(items):
+    """(subject, body) of the summary email for a list of EmailDigestItem"""
+    if len(items) == 1:
+        return items[0].subject, items[0].body
+    subject = f'{len(items)} new notifications since {items[0].created_at:%b %d %H:%M} UTC'
+    sections = [f'{n}. {item.subject}\n\n{item.body}' for n, item in enumerate(items, start=1)]
+    return subject, f'{len(items)} new notifications:\n\n' + '\n\n----------\n\n'.join(sections)
+
+
+def flush_digests(config, now=None):
+    """Turn every digest whose oldest item has waited EMAIL_DIGEST_WINDOW into outbox rows.
+
+    Returns the number of outbox rows queued. Rows are claimed with SKIP
+    LOCKED, so several workers never send the same item twice.
+    """
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(seconds=config['EMAIL_DIGEST_WINDOW'])
+    due = db.session.query(EmailDigestItem.recipient).group_by(EmailDigestItem.recipient).having(
+        db.func.min(EmailDigestItem.created_at) <= cutoff
+    ).all()
+    if not due:
+        return 0
+    items = EmailDigestItem.query.filter(
+        EmailDigestItem.recipient.in_([recipient for (recipient,) in due])
+    ).order_by(EmailDigestItem.created_at.asc(), EmailDigestItem.id.asc()).with_for_update(skip_locked=True).all()
+
+    per_recipient = {}
+    for item in items:
+        pending = per_recipient.setdefault(item.recipient, [])
+        if len(pending) < config['EMAIL_DIGEST_MAX_ITEMS']:
+            pending.append(item)
+    # Recipients of the same notifications (e.g. every advocate) get one email together
+    shared = {}
+    for recipient, pending in per_recipient.items():
+        key = tuple((item.subject, item.body) for item in pending)
+        recipients, folded = shared.setdefault(key, ([], []))
+        recipients.append(recipient)
+        folded.extend(pending)
+    for recipients, folded in shared.values():
+        subject, body = digest_message(per_recipient[recipients[0]])
+        enqueue_email(subject, body, recipients)
+        for item in folded:
+            db.session.delete(item)
+    db.session.commit()
+    return len(shared)
+
+
+def retry_delay(config, attempts):
+    """Exponential backoff with jitter for the given number of failed attempts"""
+    delay = min(config['EMAIL_OUTBOX_RETRY_BASE'] * 2 ** (attempts - 1), config['EMAIL_OUTBOX_RETRY_MAX'])
+    return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+class OutboxWorker:
+    def __init__(self, app):
+        self.app = app
+        self.config = app.config
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._pool = None
+        self._digests_swept = False
+        self.client = EmailJSClient(app.config)
+
+    def claim_batch(self):
+        """Mark a batch of due rows as 'sending' and return (id, recipients, subject, body) tuples.
+
+        Rows stuck in 'sending' past their lease are due again, so a crashed
+        worker never loses mail.
+        """
+        now = datetime.utcnow()
+        rows = EmailOutbox.query.filter(
+            EmailOutbox.status.in_(['pending', 'sending']),
+            EmailOutbox.next_attempt_at <= now
+        ).order_by(EmailOutbox.next_attempt_at.asc(), EmailOutbox.id.asc()).limit(
+            self.config['EMAIL_OUTBOX_BATCH_SIZE']
+        ).with_for_update(skip_locked=True).all()
+
+        lease_until = now + timedelta(seconds=self.config['EMAIL_OUTBOX_LEASE'])
+        batch = []
+        for row in rows:
+            row.status = 'sending'
+            row.next_attempt_at = lease_until
+            batch.append((row.id, row.recipients, row.subject, row.body))
+        db.session.commit()
+        return batch
+
+    def _deliver(self, item):
+        message_id, recipients, subject, body = item
+        try:
+            self.client.send(subject, body, recipients)
+            return message_id, None
+        except CircuitOpen as e:
+            return message_id, e
+        except Exception as e:
+            return message_id, str(e) or e.__class__.__name__
+
+    def drain_once(self):
+        """Send one batch of due messages. Returns the number of rows processed."""
+        with self.app.app_context():
+            # With digests off, only items queued before they were switched off need sending, once
+            if self.config['EMAIL_DIGEST_WINDOW'] or not self._digests_swept:
+                flush_digests(self.config)
+                self._digests_swept = True
+            if self.client.breaker.retry_in():
+                # EmailJS is down; leave the rows due until the breaker lets a probe through
+                return 0
+            batch = self.claim_batch()
+            if not batch:
+                return 0
+            results = list(self._get_pool().map(self._deliver, batch))
+
+            now = datetime.utcnow()
+            for message_id, error in results:
+                row = db.session.get(EmailOutbox, message_id)
+                if row is None:
+                    continue
+                if isinstance(error, CircuitOpen):
+                    # Never reached EmailJS, so it does not count as an attempt
+                    row.status = 'pending'
+                    row.next_attempt_at = now + timedelta(seconds=self.client.breaker.retry_in())
+                    continue
+                row.attempts = (row.attempts or 0) + 1
+                if error is None:
+                    row.status = 'sent'
+                    row.sent_at = now
+                    row.last_error = None
+                elif row.attempts >= self.config['EMAIL_OUTBOX_MAX_ATTEMPTS']:
+                    row.status = 'dead'
+                    row.last_error = error
+                    logger.error('Email %s moved to dead letter after %s attempts: %s', message_id, row.attempts, error)
+                else:
+                    row.status = 'pending'
+                    row.last_error = error
+                    row.next_attempt_at = now + retry_delay(self.config, row.attempts)
+                    logger.warning('Email %s failed (attempt %s), retrying: %s', message_id, row.attempts, error)
+            db.session.commit()
+            return len(batch)
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.config['EMAIL_OUTBOX_WORKERS'],
+                                            thread_name_prefix='email-outbox')
+        return self._pool
+
+    def run(self):
+        """Drain the outbox until stop() is called"""
+        while not self._stop.is_set():
+            try:
+                processed = self.drain_once()
+            except Exception:
+                logger.exception('Email outbox worker error')
+                processed = 0
+            if processed < self.config['EMAIL_OUTBOX_BATCH_SIZE']:
+                self._wakeup.wait(self.config['EMAIL_OUTBOX_POLL_INTERVAL'])
+                self._wakeup.clear()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self.run, name='email-outbox', daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        """Ask the worker to poll now instead of waiting for the next interval"""
+        if self.config['EMAIL_OUTBOX_IN_PROCESS']:
+            self.start()
+        self._wakeup.set()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        self.client.close()
+
+
+def init_app(app):
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    worker = OutboxWorker(app)
+    app.extensions['email_outbox'] = worker
+
+    @app.cli.command('outbox-worker')
+    @click.option('--once', is_flag=True, help='Send one batch and exit.')
+    def outbox_worker_command(once):
+        """Drain the email outbox in the foreground."""
+        if once:
+            click.echo(f'Processed {worker.drain_once()} message(s)')
+            return
+        app.config['EMAIL_OUTBOX_IN_PROCESS'] = False
+        click.echo('Email outbox worker running, press Ctrl+C to stop')
+        try:
+            worker.run()
+        except KeyboardInterrupt:
+            worker.stop()
+
+    return worker
@@ -0,0 +1,151 @@
+"""The logged-in user, resolved once per request.
+
+login() puts the user's id and type in the signed session cookie. A
+before_request hook turns them into g.identity (None when nobody is logged
+in). The Teacher or Student row is loaded at most once per request, and only
+when a view asks for identity.profile.
+
+Most authorization only needs the profile id and, for teachers, whether they
+are a guidance advocate. Those are kept in a compact snapshot in the session
+next to user_id, so routes such as replies, deletes, message polling and
+/events do not query the profile at all. A snapshot is only trusted if its
+format version matches SNAPSHOT_VERSION, it belongs to the session's user,
+and it is younger than IDENTITY_SNAPSHOT_MAX_AGE seconds. Whenever the
+profile row is loaded the snapshot is rewritten from it.
+
+Views declare who may call them with login_required():
+
+    @login_required('teacher')
+    @login_required('advocate', api=True)
+    @login_required(api=True)  # any logged-in student or teacher
+"""
+import time
+from functools import wraps
+
+from flask import current_app, flash, g, jsonify, redirect, session, url_for
+
+from models import db, Student, Teacher
+
+DEFAULT_CONFIG = {
+    'IDENTITY_SNAPSHOT': True,  # keep the profile id and role in the session cookie
+    'IDENTITY_SNAPSHOT_MAX_AGE': 300,  # seconds before the snapshot is checked against the database again
+}
+
+# Bump when the snapshot's fields change so old cookies are ignored
+SNAPSHOT_VERSION = 1
+
+PROFILE_MODELS = {'student': Student, 'teacher': Teacher}
+
+
+class Identity:
+    def __init__(self, user_id, user_type, snapshot=None):
+        self.user_id = user_id
+        self.user_type = user_type
+        self._snapshot = snapshot
+        self._profile = None
+        self._loaded = False
+
+    @property
+    def profile(self):
+        """The user's Teacher or Student row, or None if it no longer exists"""
+        if not self._loaded:
+            model = PROFILE_MODELS.get(self.user_type)
+            if model is None:
+                profile = None
+            elif self._snapshot is not None:
+                # Primary key lookup; free when the row is already in the session
+                profile = db.session.get(model, self._snapshot['id'])
+                if profile is not None and profile.user_id != self.user_id:
+                    profile = None
+            else:
+                profile = model.query.filter_by(user_id=self.user_id).first()
+            self._profile = profile
+            self._loaded = True
+            self._remember(profile)
+        return self._profile
+
+    @property
+    def profile_id(self):
+        if self._snapshot is not None:
+            return self._snapshot['id']
+        profile = self.profile
+        return profile.id if profile is not None else None
+
+    @property
+    def is_guidance_advocate(self):
+        if self.user_type != 'teacher':
+            return False
+        if self._snapshot is not None:
+            return self._snapshot['advocate']
+        profile = self.profile
+        return profile is not None and profile.is_guidance_advocate
+
+    def _remember(self, profile):
+        if profile is None:
+            self._snapshot = None
+            session.pop('identity', None)
+            return
+        snapshot = {
+            'v': SNAPSHOT_VERSION,
+            'user_id': self.user_id,
+            'id': profile.id,
+            'advocate': bool(getattr(profile, 'is_guidance_advocate', False)),
+        }
+        previous, self._snapshot = self._snapshot, snapshot
+        # Rewrite the cookie only when the snapshot was missing, expired or out of date
+        if current_app.config['IDENTITY_SNAPSHOT'] and (
+                previous is None or any(previous.get(key) != value for key, value in snapshot.items())):
+            session['identity'] = {**snapshot, 'at': int(time.time())}
+
+
+def _valid_snapshot(config, user_id):
+    snapshot = session.get('identity')
+    if not config['IDENTITY_SNAPSHOT'] or not isinstance(snapshot, dict):
+        return None
+    if snapshot.get('v') != SNAPSHOT_VERSION or snapshot.get('user_id') != user_id:
+        return None
+    if time.time() - snapshot.get('at', 0) > config['IDENTITY_SNAPSHOT_MAX_AGE']:
+        return None
+    return snapshot
+
+
+def load_identity():
+    user_id = session.get('user_id')
+    if user_id is None:
+        g.identity = None
+        return
+    g.identity = Identity(user_id, session.get('user_type'), _valid_snapshot(current_app.config, user_id))
+
+
+def login_required(*roles, api=False):
+    """Let through only logged-in users with one of roles ('student', 'teacher', 'advocate'; any if empty).
+
+    Pages redirect to the login page; with api=True the view answers 401/403 JSON instead.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            identity = g.get('identity')
+            if identity is None:
+                if api:
+                    return jsonify({'error': 'Not logged in'}), 401
+                return redirect(url_for('login'))
+            user_types = {'teacher' if role == 'advocate' else role for role in roles}
+            if (user_types and identity.user_type not in user_types) or identity.profile_id is None:
+                if api:
+                    return jsonify({'error': 'Unauthorized access'}), 403
+                return redirect(url_for('login'))
+            if 'advocate' in roles and 'teacher' not in roles and not identity.is_guidance_advocate:
+                if api:
+                    return jsonify({'error': 'Unauthorized access'}), 403
+                flash('Unauthorized access', 'error')
+                return redirect(url_for('teacher_dashboard'))
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def init_app(app):
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    app.before_request(load_identity)
@@ -0,0 +1,347 @@
+"""Opt-in request timing, SQL instrumentation and /metrics.
+
+With INSTRUMENTATION_ENABLED every request records its wall time, the
+number of SQL statements and the time spent in them (engine events, so the
+replica is included), template rendering time and outbound HTTP time
+(anything wrapped in track_http()). Each request is written as one JSON
+line to the 'instrumentation' logger and added to per-endpoint totals that
+GET /metrics serves in the Prometheus text format, together with the gauges
+other modules register (reference cache, live event streams, DB pool).
+/metrics is only registered when METRICS_TOKEN is set, and scrapers must
+send it as a bearer token.
+
+PROFILE_SLOW_REQUEST_MS turns on the sampling profiler. A single background
+thread samples the stacks of in-flight requests every PROFILE_INTERVAL_MS.
+Requests slower than the threshold have their samples written to
+PROFILE_DIR as collapsed stacks ("frame;frame;frame count"), which
+flamegraph.pl and speedscope read directly. The sampler finds requests by
+OS thread, so it stays off under gevent (serve.py --mode gevent), where
+requests are greenlets and the sampler itself would only run when they
+yield.
+"""
+import contextvars
+import hmac
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import Response, abort, g, request, template_rendered, before_render_template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = {
+    'INSTRUMENTATION_ENABLED': False,
+    'METRICS_TOKEN': None,  # /metrics requires "Authorization: Bearer <token>"; without one it is not served
+    'PROFILE_SLOW_REQUEST_MS': None,  # None disables the sampling profiler
+    'PROFILE_INTERVAL_MS': 5,
+    'PROFILE_DIR': 'profiles',
+}
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Stats of the request running in this context; None outside requests (e.g. the outbox worker)
+_current = contextvars.ContextVar('instrumentation_request', default=None)
+# The enabled app's Metrics, for track_http() calls made outside requests
+_metrics = None
+
+
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        self.template_depth = 0
+        self.template_started = 0.0
+        self.http_count = 0
+        self.http_seconds = 0.0
+        self.thread_id = threading.get_ident()
+        self.stacks = None  # Counter of collapsed stacks while profiling
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter()  # (endpoint, method, status) -> count
+        self.buckets = {}  # endpoint -> [count per DURATION_BUCKETS entry]
+        self.totals = {}  # endpoint -> Counter of summed stats
+        self.outbound = Counter()  # outbound HTTP outside requests too
+        self._gauges = []  # (prefix, callable returning {name: value})
+
+    def register_gauges(self, prefix, collect):
+        """Report collect()'s {name: number} dict as <prefix>_<name> gauges on every scrape"""
+        self._gauges.append((prefix, collect))
+
+    def observe(self, endpoint, method, status, stats, seconds):
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            buckets = self.buckets.setdefault(endpoint, [0] * len(DURATION_BUCKETS))
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    buckets[i] += 1
+            totals = self.totals.setdefault(endpoint, Counter())
+            totals['count'] += 1
+            totals['seconds'] += seconds
+            totals['sql_statements'] += stats.sql_count
+            totals['sql_seconds'] += stats.sql_seconds
+            totals['template_seconds'] += stats.template_seconds
+            totals['outbound_requests'] += stats.http_count
+            totals['outbound_seconds'] += stats.http_seconds
+
+    def record_http(self, seconds):
+        with self._lock:
+            self.outbound['requests'] += 1
+            self.outbound['seconds'] += seconds
+
+    def render(self):
+        """The Prometheus text exposition of everything recorded so far"""
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        with self._lock:
+            family('http_requests_total', 'counter', 'Requests handled, by endpoint, method and status.')
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(f'http_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {count}')
+
+            family('http_request_duration_seconds', 'histogram', 'Request wall time.')
+            for endpoint in sorted(self.buckets):
+                for bound, count in zip(DURATION_BUCKETS, self.buckets[endpoint]):
+                    lines.append(f'http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+                totals = self.totals[endpoint]
+                lines.append(f'http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {totals["count"]}')
+                lines.append(f'http_request_duration_seconds_sum{{endpoint="{endpoint}"}} {totals["seconds"]:.6f}')
+                lines.append(f'http_request_duration_seconds_count{{endpoint="{endpoint}"}} {totals["count"]}')
+
+            for key, help_text in [
+                ('sql_statements', 'SQL statements executed while handling requests.'),
+                ('sql_seconds', 'Time spent in SQL statements while handling requests.'),
+                ('template_seconds', 'Time spent rendering templates.'),
+                ('outbound_requests', 'Outbound HTTP requests made while handling requests.'),
+                ('outbound_seconds', 'Time spent in outbound HTTP requests while handling requests.'),
+            ]:
+                name = f'http_request_{key}_total'
+                family(name, 'counter', help_text)
+                for endpoint in sorted(self.totals):
+                    value = self.totals[endpoint][key]
+                    lines.append(f'{name}{{endpoint="{endpoint}"}} {value:.6f}' if isinstance(value, float)
+                                 else f'{name}{{endpoint="{endpoint}"}} {value}')
+
+            family('outbound_http_requests_total', 'counter', 'Outbound HTTP requests, including background jobs.')
+            lines.append(f"outbound_http_requests_total {self.outbound['requests']}")
+            family('outbound_http_seconds_total', 'counter', 'Time spent in outbound HTTP requests.')
+            lines.append(f"outbound_http_seconds_total {self.outbound['seconds']:.6f}")
+
+        for prefix, collect in self._gauges:
+            try:
+                values = collect()
+            except Exception:
+                logger.exception('Collecting %s metrics failed', prefix)
+                continue
+            for name, value in sorted(values.items()):
+                metric = re.sub(r'\W', '_', f'{prefix}_{name}')
+                family(metric, 'gauge', f'{prefix} {name}.')
+                lines.append(f'{metric} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+class StackSampler:
+    """Samples the Python stacks of registered threads from one background thread"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._active = {}  # thread id -> Counter
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, thread_id):
+        counter = Counter()
+        with self._lock:
+            self._active[thread_id] = counter
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+                self._thread.start()
+        return counter
+
+    def stop(self, thread_id):
+        with self._lock:
+            self._active.pop(thread_id, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                active = list(self._active.items())
+            if not active:
+                continue
+            frames = sys._current_frames()
+            for thread_id, counter in active:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    counter[collapse_stack(frame)] += 1
+
+
+def collapse_stack(frame):
+    """'outermost;...;innermost' with frames written as file:function"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+@contextmanager
+def track_http():
+    """Time an outbound HTTP call, charging it to the current request if there is one"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        stats = _current.get()
+        if stats is not None:
+            stats.http_count += 1
+            stats.http_seconds += seconds
+        if _metrics is not None:
+            _metrics.record_http(seconds)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault('instrumentation_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    started = conn.info.get('instrumentation_started')
+    if stats is not None and started:
+        stats.sql_count += 1
+        stats.sql_seconds += time.perf_counter() - started.pop()
+
+
+def _before_render(sender, template, context, **extra):
+    stats = _current.get()
+    if stats is not None:
+        # Only the outermost render counts; includes and nested renders are part of it
+        if stats.template_depth == 0:
+            stats.template_started = time.perf_counter()
+        stats.template_depth += 1
+
+
+def _rendered(sender, template, context, **extra):
+    stats = _current.get()
+    if stats is not None and stats.template_depth:
+        stats.template_depth -= 1
+        if stats.template_depth == 0:
+            stats.template_seconds += time.perf_counter() - stats.template_started
+
+
+def _gevent_patched():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+def init_app(app):
+    global _metrics
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    metrics = Metrics()
+    app.extensions['instrumentation'] = metrics
+    if not app.config['INSTRUMENTATION_ENABLED']:
+        return metrics
+    _metrics = metrics
+
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+
+    slow_ms = app.config['PROFILE_SLOW_REQUEST_MS']
+    if slow_ms is not None and _gevent_patched():
+        logger.warning('PROFILE_SLOW_REQUEST_MS ignored: the sampling profiler cannot see greenlets under gevent')
+        slow_ms = None
+    sampler = StackSampler(app.config['PROFILE_INTERVAL_MS'] / 1000) if slow_ms is not None else None
+
+    @app.before_request
+    def start_request_timer():
+        stats = RequestStats()
+        g.instrumentation_token = _current.set(stats)
+        if sampler is not None:
+            stats.stacks = sampler.start(stats.thread_id)
+
+    @app.after_request
+    def record_status(response):
+        g.instrumentation_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_request(error=None):
+        token = g.pop('instrumentation_token', None)
+        if token is None:
+            return
+        stats = _current.get()
+        _current.reset(token)
+        seconds = time.perf_counter() - stats.started
+        endpoint = request.endpoint or '(unmatched)'
+        status = g.pop('instrumentation_status', 500)
+        if sampler is not None:
+            sampler.stop(stats.thread_id)
+        metrics.observe(endpoint, request.method, status, stats, seconds)
+
+        entry = {
+            'method': request.method,
+            'path': request.path,
+            'endpoint': endpoint,
+            'status': status,
+            'duration_ms': round(seconds * 1000, 2),
+            'sql_statements': stats.sql_count,
+            'sql_ms': round(stats.sql_seconds * 1000, 2),
+            'template_ms': round(stats.template_seconds * 1000, 2),
+            'http_requests': stats.http_count,
+            'http_ms': round(stats.http_seconds * 1000, 2),
+        }
+        if sampler is not None and seconds * 1000 >= slow_ms and stats.stacks:
+            entry['profile'] = _write_profile(app.config['PROFILE_DIR'], endpoint, seconds, stats.stacks)
+        logger.info(json.dumps(entry))
+
+    token = app.config['METRICS_TOKEN']
+    if not token:
+        logger.warning('METRICS_TOKEN is not set; /metrics is disabled rather than served publicly')
+        return metrics
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            abort(401)
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    return metrics
+
+
+def _write_profile(directory, endpoint, seconds, stacks):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{time.strftime("%Y%m%d-%H%M%S")}-{endpoint}-{int(seconds * 1000)}ms.folded')
+    with open(path, 'w') as profile:
+        for stack, count in stacks.most_common():
+            profile.write(f'{stack} {count}\n')
+    return path
@@ -0,0 +1,168 @@
+"""Server-Sent Events for dashboards and consultation threads.
+
+Request handlers call publish_after_commit() while building a transaction;
+the events are handed to the broker only once the session commits, so a
+rolled-back reply never reaches anyone. Every teacher and student has a
+channel ('teacher:<id>', 'student:<id>') and /events streams theirs.
+
+LocalBroker is an in-process pub/sub: each subscriber gets a bounded queue.
+Anything with the same subscribe()/publish() methods (e.g. a wrapper around
+Redis or PostgreSQL LISTEN/NOTIFY for multi-process deployments) can be
+passed to init_app() instead.
+
+A stream holds no database connection or app context while it waits; it
+only blocks on its queue. Under gevent (`python serve.py --mode gevent`)
+that is a cheap greenlet, but under the threaded server it would pin one OS
+thread per open dashboard. So by default /events is only served when the
+process is gevent-patched. Elsewhere the dashboards render without the
+events URL and behave as before live updates existed; conversations keep
+their message long-poll. LIVE_EVENTS_ENABLED forces it on or off. Streams
+are still capped at LIVE_EVENTS_MAX_STREAMS and closed after
+LIVE_EVENTS_MAX_DURATION seconds (EventSource reconnects on its own).
+"""
+import itertools
+import json
+import queue
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db
+
+DEFAULT_CONFIG = {
+    'LIVE_EVENTS_ENABLED': None,  # serve /events; None means only when running under gevent
+    'LIVE_EVENTS_MAX_STREAMS': 200,  # concurrent /events connections per process
+    'LIVE_EVENTS_MAX_DURATION': 300,  # seconds before a stream is closed and the browser reconnects
+    'LIVE_EVENTS_HEARTBEAT': 15,  # seconds between keep-alive comments
+    'LIVE_EVENTS_QUEUE_SIZE': 100,  # undelivered events kept per subscriber
+}
+
+
+class Subscription:
+    def __init__(self, broker, channels, maxsize):
+        self.broker = broker
+        self.channels = channels
+        self.queue = queue.Queue(maxsize)
+        # Set when events were dropped because the subscriber fell behind
+        self.overflowed = False
+
+    def get(self, timeout=None):
+        """Next event dict, or None if none arrived within timeout"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class LocalBroker:
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._subscribers = {}  # channel -> set of Subscription
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def subscribe(self, *channels):
+        subscription = Subscription(self, channels, self.queue_size)
+        with self._lock:
+            for channel in channels:
+                self._subscribers.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscribers = self._subscribers.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[channel]
+
+    def publish(self, channel, name, data):
+        message = {'id': next(self._ids), 'event': name, 'data': data}
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(message)
+            except queue.Full:
+                subscription.overflowed = True
+        return len(subscribers)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(set().union(*self._subscribers.values())) if self._subscribers else 0
+
+
+def publish_after_commit(channel, name, data):
+    """Publish an event on channel once the current db.session transaction commits"""
+    session = db.session()
+    session.info.setdefault('live_events', []).append(
+        (current_app.extensions['live_events'], channel, name, data)
+    )
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_pending(session):
+    for broker, channel, name, data in session.info.pop('live_events', ()):
+        broker.publish(channel, name, data)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_pending(session):
+    session.info.pop('live_events', None)
+
+
+def format_event(message):
+    return f"id: {message['id']}\nevent: {message['event']}\ndata: {json.dumps(message['data'])}\n\n"
+
+
+def stream(subscription, heartbeat, max_duration):
+    """Generate the SSE body for subscription; closes it when the client goes away or time runs out"""
+    deadline = time.monotonic() + max_duration
+    try:
+        # Browsers wait this long (ms) before reconnecting after the stream ends
+        yield 'retry: 3000\n\n'
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            message = subscription.get(timeout=min(heartbeat, remaining))
+            if subscription.overflowed:
+                # Events were lost; ask the page to reload its state
+                yield 'event: resync\ndata: {}\n\n'
+                break
+            yield format_event(message) if message else ': keep-alive\n\n'
+    finally:
+        subscription.close()
+
+
+def cooperative():
+    """True when gevent has monkey-patched this process, so a waiting stream costs a greenlet, not a thread"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+def init_app(app, broker=None):
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    if app.config['LIVE_EVENTS_ENABLED'] is None:
+        # serve.py patches before importing the app, so this is already known here
+        app.config['LIVE_EVENTS_ENABLED'] = cooperative()
+    broker = broker or LocalBroker(app.config['LIVE_EVENTS_QUEUE_SIZE'])
+    app.extensions['live_events'] = broker
+    return broker
@@ -0,0 +1,169 @@
+"""Schema migrations for databases created with db.create_all().
+
+create_all() only creates missing tables, so indexes and columns added to
+models.py never reach an existing deployment. Each migration below is
+applied once, recorded in the schema_migration table, and written so that
+re-running it against a partially migrated database is harmless.
+
+    flask db upgrade    # create missing tables, then apply pending migrations
+    flask db status     # list applied and pending migrations
+"""
+import click
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateIndex
+
+from models import db, SchemaMigration, User, Consultation
+from teacher_stats import reconcile_counters
+import consultation_search
+import category_trends
+from categories import CATEGORY_DATA
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def decorator(fn):
+        MIGRATIONS.append((version, description, fn))
+        return fn
+    return decorator
+
+
+def _find_index(name):
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name == name:
+                return index
+    raise KeyError(f'Index {name} is not declared in models.py')
+
+
+def create_index(name):
+    """Create a declared index if it is missing.
+
+    On PostgreSQL the index is built CONCURRENTLY so a live deployment keeps
+    accepting writes while it is created.
+    """
+    index = _find_index(name)
+    engine = db.engine
+    ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=engine.dialect))
+    if engine.dialect.name == 'postgresql':
+        ddl = ddl.replace('INDEX ', 'INDEX CONCURRENTLY ', 1)
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.exec_driver_sql(ddl)
+
+
+def add_column(table_name, column_name):
+    """Add a column declared in models.py to an existing table if it is missing"""
+    engine = db.engine
+    existing = {c['name'] for c in inspect(engine).get_columns(table_name)}
+    if column_name in existing:
+        return
+    column = db.metadata.tables[table_name].c[column_name]
+    column_type = column.type.compile(dialect=engine.dialect)
+    with engine.begin() as conn:
+        conn.exec_driver_sql(f'ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}')
+
+
+@migration('0001', 'Composite indexes on dashboard filter columns')
+def add_dashboard_indexes():
+    for name in [
+        'ix_consultation_teacher_deleted_status_created',
+        'ix_consultation_student_deleted',
+        'ix_student_grade_section_archived',
+        'ix_student_advocate_archived',
+        'ix_consultation_message_consultation_created',
+        'ix_email_outbox_status_next_attempt',
+    ]:
+        create_index(name)
+
+
+@migration('0002', 'Keyset pagination indexes on consultation (created_at, id)')
+def add_pagination_indexes():
+    create_index('ix_consultation_teacher_created')
+    create_index('ix_consultation_student_created')
+
+
+@migration('0003', 'Backfill per-teacher consultation counters')
+def backfill_teacher_counters():
+    # create_all() has already added the teacher_consultation_stats table
+    reconcile_counters()
+
+
+@migration('0004', 'Normalize stored emails and add a unique index on lower(email)')
+def normalize_emails():
+    normalized = db.func.lower(db.func.trim(User.email))
+    # Two accounts differing only in case cannot be merged automatically
+    duplicates = db.session.scalars(
+        db.select(normalized).group_by(normalized).having(db.func.count() > 1).order_by(normalized)
+    ).all()
+    if duplicates:
+        raise RuntimeError(
+            'Cannot normalize emails, these belong to more than one account: '
+            + ', '.join(duplicates) + '. Rename or remove the extra accounts and run the upgrade again.'
+        )
+    db.session.execute(db.update(User).where(User.email != normalized).values(email=normalized))
+    db.session.commit()
+    create_index('ix_user_email_lower')
+
+
+@migration('0005', 'Full-text search indexes on consultation subjects and messages')
+def add_search_indexes():
+    if db.engine.dialect.name == 'postgresql':
+        create_index('ix_consultation_subject_search')
+        create_index('ix_consultation_message_search')
+    else:
+        with db.engine.begin() as conn:
+            consultation_search.install_sqlite(conn)
+
+
+@migration('0006', 'Category keys on consultation and daily category rollups')
+def add_category_rollups():
+    add_column('consultation', 'category')
+    add_column('consultation', 'subcategory')
+    # Older rows only have the label in subject; map each label back to its keys
+    for category, data in CATEGORY_DATA.items():
+        for subcategory, label in data['subcategories'].items():
+            db.session.execute(
+                db.update(Consultation)
+                .where(Consultation.category.is_(None), Consultation.subject.in_([label, f'Preconsultation: {label}']))
+                # Keep updated_at; this is not a change anyone made to the consultation
+                .values(category=category, subcategory=subcategory, updated_at=Consultation.updated_at)
+            )
+    db.session.commit()
+    # create_all() has already added the consultation_daily_rollup table
+    category_trends.rebuild_rollups()
+
+
+def pending_migrations():
+    applied = set()
+    if inspect(db.engine).has_table(SchemaMigration.__tablename__):
+        applied = {m.version for m in SchemaMigration.query.all()}
+    return [m for m in MIGRATIONS if m[0] not in applied]
+
+
+def upgrade(echo=print):
+    """Create missing tables and apply every pending migration in order"""
+    db.create_all()
+    for version, description, fn in pending_migrations():
+        echo(f'Applying {version}: {description}')
+        fn()
+        db.session.add(SchemaMigration(version=version, description=description))
+        db.session.commit()
+
+
+def init_app(app):
+    @app.cli.group('db')
+    def db_command():
+        """Database schema commands."""
+
+    @db_command.command('upgrade')
+    def upgrade_command():
+        """Create missing tables and apply pending migrations."""
+        upgrade(click.echo)
+        click.echo('Database is up to date')
+
+    @db_command.command('status')
+    def status_command():
+        """Show applied and pending migrations."""
+        pending = {m[0] for m in pending_migrations()}
+        for version, description, _ in MIGRATIONS:
+            click.echo(f"{'pending' if version in pending else 'applied'}  {version}  {description}")
@@ -1,7 +1,18 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 
-db = SQLAlchemy()
+from db_routing import RoutingSession
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+def search_vector(column):
+    """PostgreSQL full-text document for a text column.
+
+    The GIN indexes below and consultation_search must build it the same way,
+    or the planner will not use the index.
+    """
+    return db.func.to_tsvector(db.literal_column("'english'"), column)
 
 # Initialize models after db is created
 
@@ -12,6 +23,17 @@ class User(db.Model):
     user_type = db.Column(db.String(20), nullable=False)  # 'student' or 'teacher'
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # Emails are compared case-insensitively; this keeps that a single indexed
+        # lookup and stops 'A@x.com' and 'a@x.com' becoming two accounts
+        db.Index('ix_user_email_lower', db.func.lower(email), unique=True),
+    )
+
+    @classmethod
+    def find_by_email(cls, email):
+        """Case-insensitive lookup served by ix_user_email_lower"""
+        return cls.query.filter(db.func.lower(cls.email) == email.strip().lower()).first()
+
 class Student(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), unique=True, nullable=False)
@@ -32,8 +54,15 @@ class Student(db.Model):
     archived_at = db.Column(db.DateTime, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    user = db.relationship('User', backref='student_profile')
-    consultations = db.relationship('Consultation', backref='student', lazy=True)
+    __table_args__ = (
+        db.Index('ix_student_grade_section_archived', 'grade', 'section', 'archived'),
+        db.Index('ix_student_advocate_archived', 'preferred_guidance_advocate_id', 'archived'),
+    )
+    
+    # Loader strategies: the profile's user row and a consultation's student are
+    # needed wherever those objects are shown, so both come in through a JOIN.
+    user = db.relationship('User', backref='student_profile', lazy='joined')
+    consultations = db.relationship('Consultation', backref=db.backref('student', lazy='joined'), lazy=True)
     preferred_advocate = db.relationship('Teacher', backref='preferred_students', foreign_keys=[preferred_guidance_advocate_id])
     
     def full_name(self):
@@ -54,7 +83,7 @@ class Teacher(db.Model):
     specialization = db.Column(db.String(200), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    user = db.relationship('User', backref='teacher_profile')
+    user = db.relationship('User', backref='teacher_profile', lazy='joined')
     consultations = db.relationship('Consultation', backref='teacher', lazy=True)
     
     def full_name(self):
@@ -65,16 +94,31 @@ class Teacher(db.Model):
 class Consultation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=False)
-    teacher_id = db.Column(db.Integer, db.ForeignKey('teacher.id'), nullable=False)
+    # active_history: teacher_stats needs the committed value even when the attribute was expired
+    teacher_id = db.column_property(db.Column(db.Integer, db.ForeignKey('teacher.id'), nullable=False), active_history=True)
     subject = db.Column(db.String(200), nullable=False)
-    status = db.Column(db.String(20), default='pending')  # 'pending', 'read', 'responded'
-    deleted = db.Column(db.Boolean, default=False)
+    category = db.Column(db.String(30), nullable=True)  # categories.CATEGORY_DATA key, e.g. 'school'
+    subcategory = db.Column(db.String(40), nullable=True)  # e.g. 'school_grades'
+    status = db.column_property(db.Column(db.String(20), default='pending'), active_history=True)  # 'pending', 'read', 'responded'
+    deleted = db.column_property(db.Column(db.Boolean, default=False), active_history=True)
     deleted_by = db.Column(db.String(20), nullable=True)  # 'student' or 'teacher'
     deleted_at = db.Column(db.DateTime, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
-    messages = db.relationship('ConsultationMessage', backref='consultation', lazy=True, cascade='all, delete-orphan')
+    __table_args__ = (
+        db.Index('ix_consultation_teacher_deleted_status_created', 'teacher_id', 'deleted', 'status', 'created_at'),
+        db.Index('ix_consultation_student_deleted', 'student_id', 'deleted'),
+        # Keyset pagination walks (created_at, id) newest first within one teacher or student
+        db.Index('ix_consultation_teacher_created', 'teacher_id', 'created_at', 'id'),
+        db.Index('ix_consultation_student_created', 'student_id', 'created_at', 'id'),
+        # Full-text search; SQLite uses FTS5 tables instead (see consultation_search)
+        db.Index('ix_consultation_subject_search', search_vector(subject), postgresql_using='gin').ddl_if(dialect='postgresql'),
+    )
+    
+    # Only view_consultation needs messages, and it asks for them explicitly
+    messages = db.relationship('ConsultationMessage', backref='consultation', lazy='select', cascade='all, delete-orphan',
+                               order_by='ConsultationMessage.created_at')
 
 class ConsultationMessage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -84,4 +128,84 @@ class ConsultationMessage(db.Model):
     message = db.Column(db.Text, nullable=False)
     attachment_filename = db.Column(db.String(255), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_consultation_message_consultation_created', 'consultation_id', 'created_at'),
+        db.Index('ix_consultation_message_search', search_vector(message), postgresql_using='gin').ddl_if(dialect='postgresql'),
+    )
+    
+    attachment = db.relationship('MessageAttachment', backref='message', uselist=False, lazy='joined', cascade='all, delete-orphan')
+
+class AttachmentBlob(db.Model):
+    sha256 = db.Column(db.String(64), primary_key=True)  # file is stored at blobs/<sha256[:2]>/<sha256>
+    size = db.Column(db.Integer, nullable=False)
+    content_type = db.Column(db.String(100), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class MessageAttachment(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    message_id = db.Column(db.Integer, db.ForeignKey('consultation_message.id'), unique=True, nullable=False)
+    blob_sha256 = db.Column(db.String(64), db.ForeignKey('attachment_blob.sha256'), nullable=False, index=True)
+    filename = db.Column(db.String(255), nullable=False)  # original name as uploaded
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    blob = db.relationship('AttachmentBlob', lazy='joined')
+
+class TeacherConsultationStats(db.Model):
+    # Kept in step with Consultation by teacher_stats.py; `flask reconcile-stats` rebuilds it
+    teacher_id = db.Column(db.Integer, db.ForeignKey('teacher.id'), primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)  # including deleted consultations
+    pending = db.Column(db.Integer, nullable=False, default=0)  # status counts exclude deleted ones
+    read = db.Column(db.Integer, nullable=False, default=0)
+    responded = db.Column(db.Integer, nullable=False, default=0)
+
+
+class ConsultationDailyRollup(db.Model):
+    # Consultations opened per UTC day; maintained by category_trends.py, `flask rebuild-trends` rebuilds it.
+    # Key columns are never NULL so the upsert can match on them: '' / 0 stand for unknown.
+    day = db.Column(db.Date, primary_key=True)
+    teacher_id = db.Column(db.Integer, db.ForeignKey('teacher.id'), primary_key=True, autoincrement=False)
+    category = db.Column(db.String(30), primary_key=True, default='')
+    subcategory = db.Column(db.String(40), primary_key=True, default='')
+    grade = db.Column(db.Integer, primary_key=True, default=0, autoincrement=False)  # the student's at the time
+    section = db.Column(db.String(10), primary_key=True, default='')
+    count = db.Column(db.Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        db.Index('ix_consultation_daily_rollup_teacher_day', 'teacher_id', 'day'),
+    )
+
+
+class EmailOutbox(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    recipients = db.Column(db.Text, nullable=False)  # Comma-separated values
+    subject = db.Column(db.String(255), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), default='pending')  # 'pending', 'sending', 'sent', 'dead'
+    attempts = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.Text, nullable=True)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)  # also the claim lease while 'sending'
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    
+    __table_args__ = (
+        db.Index('ix_email_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+
+
+class EmailDigestItem(db.Model):
+    # One notification waiting to be folded into its recipient's next digest (see email_outbox.py)
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_email_digest_item_recipient_created', 'recipient', 'created_at'),
+    )
 
+class SchemaMigration(db.Model):
+    version = db.Column(db.String(20), primary_key=True)
+    description = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -0,0 +1,130 @@
+"""Password hashing off the request thread.
+
+Hashing and checking a password is deliberately slow CPU work, and on the
+request thread it holds the GIL, so a burst of logins stalls every other
+request in the process. PasswordHasher runs it on a process pool instead:
+request threads only wait on a future.
+
+Backpressure: at most PASSWORD_HASH_MAX_PENDING hashes may be queued or
+running. A request that cannot get a slot within PASSWORD_HASH_QUEUE_TIMEOUT
+seconds raises HashingBusy rather than piling onto an unbounded queue.
+Bulk imports (hash_many) run on a separate, smaller pool of
+PASSWORD_HASH_BULK_WORKERS processes, so a large roster upload never takes
+the slots or workers that logins need.
+
+PASSWORD_HASH_METHOD is any Werkzeug method string, e.g. 'scrypt' or
+'pbkdf2:sha256:600000'. A stored hash made with a different method or cost
+is replaced on the next successful login (see needs_rehash()).
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+DEFAULT_CONFIG = {
+    'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:600000',
+    'PASSWORD_HASH_WORKERS': None,  # pool processes; None means one per CPU, 0 hashes on the request thread
+    'PASSWORD_HASH_MAX_PENDING': None,  # queued + running hashes; None means 4 per worker
+    'PASSWORD_HASH_QUEUE_TIMEOUT': 10,  # seconds to wait for a slot before giving up
+    'PASSWORD_HASH_BULK_WORKERS': None,  # processes for hash_many(); None means half the workers, at least 1
+}
+
+logger = logging.getLogger(__name__)
+
+
+class HashingBusy(Exception):
+    """Too many password hashes are already waiting"""
+
+
+class PasswordHasher:
+    def __init__(self, method='pbkdf2:sha256:600000', workers=None, max_pending=None, queue_timeout=10,
+                 bulk_workers=None):
+        self.method = method
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.bulk_workers = max(self.workers // 2, 1) if bulk_workers is None else bulk_workers
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_pending or max(self.workers, 1) * 4)
+        self._pools = {}  # 'request' or 'bulk' -> ProcessPoolExecutor
+        self._pool_lock = threading.Lock()
+        self._method_prefix = None
+
+    def _get_pool(self, kind='request'):
+        with self._pool_lock:
+            if kind not in self._pools:
+                workers = self.bulk_workers if kind == 'bulk' else self.workers
+                self._pools[kind] = ProcessPoolExecutor(max_workers=workers)
+            return self._pools[kind]
+
+    def _discard_pool(self, kind, pool):
+        """Drop a broken pool so the next call starts a fresh one"""
+        with self._pool_lock:
+            if self._pools.get(kind) is pool:
+                del self._pools[kind]
+        pool.shutdown(wait=False)
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise HashingBusy()
+        try:
+            pool = self._get_pool()
+            try:
+                return pool.submit(fn, *args).result()
+            except BrokenProcessPool:
+                # A worker process died (OOM, kill); without this every later login would fail too
+                logger.warning('Password hashing pool broke, starting a new one')
+                self._discard_pool('request', pool)
+                return self._get_pool().submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def hash_many(self, passwords):
+        """Hash a list of passwords for a bulk import on the bulk pool, leaving the request pool to logins"""
+        hasher = partial(generate_password_hash, method=self.method)
+        if not self.workers or not self.bulk_workers:
+            return [hasher(password) for password in passwords]
+        pool = self._get_pool('bulk')
+        try:
+            return list(pool.map(hasher, passwords, chunksize=8))
+        except BrokenProcessPool:
+            logger.warning('Bulk password hashing pool broke, starting a new one')
+            self._discard_pool('bulk', pool)
+            return list(self._get_pool('bulk').map(hasher, passwords, chunksize=8))
+
+    def needs_rehash(self, password_hash):
+        """True if password_hash was made with a different method or cost than the configured one"""
+        if self._method_prefix is None:
+            # Werkzeug fills in defaults ('pbkdf2' -> 'pbkdf2:sha256:600000'), so ask it once
+            self._method_prefix = generate_password_hash('', self.method).split('$', 1)[0]
+        return password_hash.split('$', 1)[0] != self._method_prefix
+
+    def shutdown(self):
+        with self._pool_lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            pool.shutdown()
+
+
+def init_app(app):
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    hasher = PasswordHasher(
+        app.config['PASSWORD_HASH_METHOD'],
+        workers=app.config['PASSWORD_HASH_WORKERS'],
+        max_pending=app.config['PASSWORD_HASH_MAX_PENDING'],
+        queue_timeout=app.config['PASSWORD_HASH_QUEUE_TIMEOUT'],
+        bulk_workers=app.config['PASSWORD_HASH_BULK_WORKERS']
+    )
+    app.extensions['passwords'] = hasher
+    return hasher
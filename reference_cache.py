@@ -0,0 +1,156 @@
+"""In-process cache for reference data that rarely changes.
+
+The guidance advocate list and the sections of each grade are read on every
+registration page, every grade change in the form and every consultation
+POST, but only change when a teacher registers or edits a profile, or a
+student changes section. ReferenceCache keeps them as plain dicts and lists
+(never ORM objects, which are bound to one session) with a TTL, so each
+worker process refreshes on its own within REFERENCE_CACHE_TTL seconds even
+if another process made the change, and evicts the least recently used key
+once REFERENCE_CACHE_MAXSIZE keys are held.
+
+Code that changes the underlying rows calls invalidate_advocates() or
+invalidate_sections() after committing.
+
+Each value is stored with a version token, a hash of its JSON form taken
+when it is loaded. The API uses it as a strong ETag, so a client that
+already has the current list gets a 304 without the payload being
+serialized again. Every worker derives the same token from the same data.
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy.orm import joinedload
+
+from models import db, Teacher, Student
+
+DEFAULT_CONFIG = {
+    'REFERENCE_CACHE_TTL': 300,  # seconds before a cached value is reloaded
+    'REFERENCE_CACHE_MAXSIZE': 256,
+}
+
+# Offered in the registration form for grades that have no students yet
+DEFAULT_SECTIONS = ['A', 'B', 'C', 'D', 'E']
+
+_MISSING = object()
+
+
+class ReferenceCache:
+    def __init__(self, ttl=300, maxsize=256, clock=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._clock = clock
+        self._data = OrderedDict()  # key -> (expires_at, value), least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > self._clock():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return _MISSING
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (self._clock() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, loader):
+        """Return the cached value for key, calling loader() to fill it on a miss"""
+        value = self.get(key)
+        if value is _MISSING:
+            # Two threads may both load on a cold key; the result is the same either way
+            value = loader()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, prefix=None):
+        """Drop every key, or only the tuple keys whose first item is prefix"""
+        with self._lock:
+            if prefix is None:
+                self._data.clear()
+                return
+            for key in [k for k in self._data if k[0] == prefix]:
+                del self._data[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._data),
+            }
+
+    # Reference data
+
+    def versioned_advocates(self):
+        """(version, advocates) where advocates is shaped like the /api/guidance-advocates response"""
+        return self.get_or_load(('advocates',), lambda: _versioned(_load_guidance_advocates()))
+
+    def guidance_advocates(self):
+        return self.versioned_advocates()[1]
+
+    def advocate_emails(self):
+        return [advocate['email'] for advocate in self.guidance_advocates() if advocate['email']]
+
+    def versioned_sections(self, grade):
+        return self.get_or_load(('sections', grade), lambda: _versioned(_load_sections(grade)))
+
+    def sections(self, grade):
+        return self.versioned_sections(grade)[1]
+
+    def invalidate_advocates(self):
+        self.invalidate('advocates')
+
+    def invalidate_sections(self):
+        self.invalidate('sections')
+
+
+def _versioned(value):
+    encoded = json.dumps(value, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(encoded.encode()).hexdigest(), value
+
+
+def _load_guidance_advocates():
+    advocates = Teacher.query.filter_by(is_guidance_advocate=True).options(joinedload(Teacher.user)).all()
+    return [
+        {
+            'id': advocate.id,
+            'name': advocate.full_name(),
+            'email': advocate.user.email if advocate.user else None,
+            'availability': advocate.availability,
+            'specialization': advocate.specialization,
+            'handling_section': advocate.handling_section,
+            'handling_grade': advocate.handling_grade
+        }
+        for advocate in advocates
+    ]
+
+
+def _load_sections(grade):
+    sections = db.session.query(Student.section).filter_by(grade=grade).distinct().all()
+    section_list = [s[0] for s in sections if s[0]]
+    return sorted(section_list) if section_list else list(DEFAULT_SECTIONS)
+
+
+def init_app(app):
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+    cache = ReferenceCache(app.config['REFERENCE_CACHE_TTL'], app.config['REFERENCE_CACHE_MAXSIZE'])
+    app.extensions['reference_cache'] = cache
+    return cache
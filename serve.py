@@ -0,0 +1,73 @@
+"""Serve the app threaded (the default) or cooperatively with gevent.
+
+    python serve.py                     # one OS thread per request, like `python app.py`
+    python serve.py --mode gevent       # one greenlet per request
+
+Most of a request's time is spent waiting on the network: Postgres round
+trips, EmailJS, and message long-polls and /events streams waiting for a
+reply. In gevent mode the standard library is monkey-patched before the app
+is imported and psycogreen makes psycopg2 yield while a query is in flight,
+so the unchanged views, the requests-based EmailJS client and the outbox
+worker all run as coroutines. A single process then keeps --connections
+requests in flight for the price of a greenlet each instead of a thread.
+Live dashboard updates (/events) are only served in this mode unless
+LIVE_EVENTS_ENABLED says otherwise.
+
+The gevent mode needs `pip install gevent psycogreen`. sqlite3 calls do not
+yield, so it only pays off against Postgres. Since every in-flight request
+may hold a pooled connection, it raises the DB_POOL_SIZE and
+DB_MAX_OVERFLOW defaults (FLASK_ environment variables still win).
+
+benchmarks/serving_modes.py compares the two modes under load.
+"""
+import argparse
+import os
+
+MODES = ('threaded', 'gevent')
+
+
+def patch(mode):
+    """Prepare the process for mode; call before anything imports app"""
+    if mode != 'gevent':
+        return
+    try:
+        from gevent import monkey
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        raise SystemExit('The gevent mode needs gevent and psycogreen: pip install gevent psycogreen')
+    monkey.patch_all()
+    patch_psycopg()
+    os.environ.setdefault('FLASK_DB_POOL_SIZE', '20')
+    os.environ.setdefault('FLASK_DB_MAX_OVERFLOW', '30')
+
+
+def serve(app, mode, host, port, connections=1000):
+    if mode == 'gevent':
+        from gevent.pool import Pool
+        from gevent.pywsgi import WSGIServer
+        print(f' * Serving on http://{host}:{port} with gevent (up to {connections} connections)')
+        WSGIServer((host, port), app, spawn=Pool(connections)).serve_forever()
+    else:
+        app.run(host=host, port=port, threaded=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=MODES, default='threaded')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 5000)))
+    parser.add_argument('--connections', type=int, default=1000, help='concurrent requests in gevent mode')
+    args = parser.parse_args()
+
+    patch(args.mode)
+    from app import app, start_serving
+    import migrations
+    with app.app_context():
+        # Same as `python app.py`: apply pending migrations before serving
+        migrations.upgrade()
+    start_serving()
+    serve(app, args.mode, args.host, args.port, args.connections)
+
+
+if __name__ == '__main__':
+    main()
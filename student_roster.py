@@ -0,0 +1,348 @@
+"""Bulk student import and streaming export.
+
+Imports read a CSV or JSON Lines roster one row at a time, validate each
+row, and insert User + Student pairs in batches with executemany. The
+expensive part, password hashing, runs on the PasswordHasher bulk pool
+(every CPU from the CLI; a separate, smaller pool than logins use in the web
+process), so a school year of students takes a fraction of the time it takes
+through /register.
+
+    flask students import roster.csv
+    flask students export students --format jsonl -o students.jsonl
+    flask students export consultations -o consultations.csv
+
+Rows that fail validation are skipped and reported with their line number;
+they never abort the rest of the import. A roster that cannot be read at all
+past some line (not UTF-8, malformed CSV) stops the import there: the rows
+before it are imported and the report says which line failed.
+"""
+import csv
+import io
+import json
+import sys
+import time
+
+import click
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+
+from models import db, User, Student, Teacher, Consultation
+from passwords import PasswordHasher
+
+DEFAULT_CONFIG = {
+    'STUDENT_IMPORT_BATCH_SIZE': 500,
+}
+
+FORMATS = ('csv', 'jsonl')
+
+# Roster columns; email, password, first_name, last_name, grade and section are required
+IMPORT_FIELDS = [
+    'email', 'password', 'first_name', 'last_name', 'middle_name', 'grade', 'section',
+    'contact_number', 'address', 'emergency_contact_name', 'emergency_contact', 'adviser',
+    'preferred_guidance_advocate_id',
+]
+
+EXPORTS = {
+    'students': [
+        User.email, Student.id, Student.first_name, Student.last_name, Student.middle_name,
+        Student.grade, Student.section, Student.contact_number, Student.address,
+        Student.emergency_contact_name, Student.emergency_contact, Student.adviser,
+        Student.preferred_guidance_advocate_id, Student.archived, Student.created_at,
+    ],
+    'consultations': [
+        Consultation.id, Consultation.student_id, Consultation.teacher_id, Consultation.subject,
+        Consultation.status, Consultation.deleted, Consultation.deleted_by, Consultation.created_at,
+        Consultation.updated_at,
+    ],
+}
+
+
+class RowError(ValueError):
+    pass
+
+
+class RosterError(ValueError):
+    """The roster cannot be read past line"""
+
+    def __init__(self, line, message):
+        super().__init__(f'line {line}: {message}')
+        self.line = line
+        self.message = message
+
+
+class ImportReport:
+    def __init__(self):
+        self.imported = 0
+        self.errors = []  # (line, message)
+        self.failed = None  # RosterError that stopped the import
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    @property
+    def rows_per_second(self):
+        rows = self.imported + len(self.errors)
+        return rows / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self):
+        report = {
+            'imported': self.imported,
+            'skipped': len(self.errors),
+            'errors': [{'line': line, 'error': message} for line, message in sorted(self.errors)],
+            'seconds': round(self.elapsed, 3),
+            'rows_per_second': round(self.rows_per_second, 1),
+        }
+        if self.failed is not None:
+            report['error'] = f'Import stopped at line {self.failed.line}: {self.failed.message}'
+            report['failed_line'] = self.failed.line
+        return report
+
+
+def decode_lines(stream, encoding='utf-8-sig'):
+    """Yield the lines of a binary stream as text, raising RosterError naming the first undecodable line"""
+    for line, raw in enumerate(stream, start=1):
+        try:
+            # Only the first line can carry a byte order mark
+            yield raw.decode(encoding if line == 1 else 'utf-8')
+        except UnicodeDecodeError:
+            raise RosterError(line, 'not valid UTF-8; save the roster as CSV UTF-8 and upload it again')
+
+
+def read_rows(stream, fmt):
+    """Yield (line, row dict) from a binary stream without reading it all into memory"""
+    lines = decode_lines(stream)
+    if fmt == 'csv':
+        reader = csv.DictReader(lines)
+        read = 0  # lines consumed by complete records; the bad record starts right after
+        try:
+            if reader.fieldnames is not None:
+                read = reader.line_num
+            for row in reader:
+                yield reader.line_num, row
+                read = reader.line_num
+        except csv.Error as e:
+            raise RosterError(read + 1, f'malformed CSV ({e})')
+    elif fmt == 'jsonl':
+        for line, text in enumerate(lines, start=1):
+            if not text.strip():
+                continue
+            try:
+                row = json.loads(text)
+            except ValueError:
+                yield line, None
+                continue
+            yield line, row if isinstance(row, dict) else None
+    else:
+        raise ValueError(f'Unknown format: {fmt}')
+
+
+def _text(row, field):
+    value = row.get(field)
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def validate_row(row, advocate_ids):
+    """Return the cleaned roster row, or raise RowError"""
+    if row is None:
+        raise RowError('Not a valid JSON object')
+    clean = {field: _text(row, field) for field in IMPORT_FIELDS}
+    for field in ('email', 'password', 'first_name', 'last_name', 'grade', 'section'):
+        if not clean[field]:
+            raise RowError(f'Missing {field}')
+    clean['email'] = clean['email'].lower()
+    if '@' not in clean['email']:
+        raise RowError('Invalid email')
+    if len(clean['password']) < 6:
+        raise RowError('Password must be at least 6 characters long')
+    try:
+        clean['grade'] = int(clean['grade'])
+    except ValueError:
+        raise RowError('Grade must be a number')
+    clean['section'] = clean['section'].upper()
+    if clean['preferred_guidance_advocate_id']:
+        try:
+            advocate_id = int(clean['preferred_guidance_advocate_id'])
+        except ValueError:
+            raise RowError('preferred_guidance_advocate_id must be a number')
+        if advocate_id not in advocate_ids:
+            raise RowError('Selected guidance advocate not found')
+        clean['preferred_guidance_advocate_id'] = advocate_id
+    return clean
+
+
+def _unregistered(batch, report):
+    """The (line, row) pairs of batch whose email is not taken yet; the others are reported"""
+    emails = [row['email'] for _, row in batch]
+    email_lower = db.func.lower(User.email)
+    taken = set(db.session.scalars(select(email_lower).where(email_lower.in_(emails))))
+    rows = []
+    for line, row in batch:
+        if row['email'] in taken:
+            report.errors.append((line, 'Email already registered'))
+        else:
+            rows.append((line, row))
+    return rows
+
+
+def _insert_rows(rows, hashes):
+    user_ids = db.session.scalars(
+        insert(User).returning(User.id, sort_by_parameter_order=True),
+        [{'email': row['email'], 'password_hash': hashes[row['email']], 'user_type': 'student'}
+         for _, row in rows]
+    ).all()
+    db.session.execute(insert(Student), [
+        {'user_id': user_id, **{k: v for k, v in row.items() if k not in ('email', 'password')}}
+        for user_id, (_, row) in zip(user_ids, rows)
+    ])
+    db.session.commit()
+
+
+def _insert_batch(batch, hasher, report):
+    rows = _unregistered(batch, report)
+    if not rows:
+        return
+    hashes = dict(zip([row['email'] for _, row in rows], hasher.hash_many([row['password'] for _, row in rows])))
+    try:
+        _insert_rows(rows, hashes)
+    except IntegrityError:
+        # Someone registered one of these emails since the check; skip it and try the rest once more
+        db.session.rollback()
+        rows = _unregistered(rows, report)
+        try:
+            if rows:
+                _insert_rows(rows, hashes)
+        except IntegrityError:
+            db.session.rollback()
+            report.errors.extend((line, 'Could not be saved, please import it again') for line, _ in rows)
+            return
+    report.imported += len(rows)
+
+
+def import_students(stream, fmt, hasher, batch_size=500, report=None):
+    """Import a roster from a binary stream, hashing passwords with hasher, and return an ImportReport"""
+    report = report or ImportReport()
+    advocate_ids = set(db.session.scalars(select(Teacher.id).where(Teacher.is_guidance_advocate == True)))
+    seen = set()
+    batch = []
+    try:
+        for line, row in read_rows(stream, fmt):
+            try:
+                clean = validate_row(row, advocate_ids)
+                if clean['email'] in seen:
+                    raise RowError('Duplicate email in file')
+            except RowError as e:
+                report.errors.append((line, str(e)))
+                continue
+            seen.add(clean['email'])
+            batch.append((line, clean))
+            if len(batch) >= batch_size:
+                _insert_batch(batch, hasher, report)
+                batch = []
+    except RosterError as e:
+        # Keep what was read before the bad line, so the report matches what is in the database
+        report.failed = e
+    if batch:
+        _insert_batch(batch, hasher, report)
+    report.elapsed = time.perf_counter() - report.started
+    return report
+
+
+class ExportReport:
+    def __init__(self):
+        self.rows = 0
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+
+def export_rows(table, fmt, chunk_size=1000, report=None):
+    """Yield text chunks of a students or consultations export, streaming rows from the database"""
+    report = report or ExportReport()
+    columns = EXPORTS[table]
+    query = select(*columns)
+    if table == 'students':
+        query = query.join(User, User.id == Student.user_id).order_by(Student.id)
+    else:
+        query = query.order_by(Consultation.id)
+    names = [column.key for column in columns]
+    result = db.session.execute(query.execution_options(yield_per=chunk_size))
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == 'csv':
+        writer.writerow(names)
+    for partition in result.partitions():
+        for row in partition:
+            if fmt == 'csv':
+                writer.writerow(row)
+            else:
+                buffer.write(json.dumps(dict(zip(names, row)), default=str) + '\n')
+        report.rows += len(partition)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    report.elapsed = time.perf_counter() - report.started
+    yield buffer.getvalue()
+
+
+def _format_for(path, fmt):
+    if fmt:
+        return fmt
+    return 'jsonl' if path and path.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def init_app(app):
+    for key, value in DEFAULT_CONFIG.items():
+        app.config.setdefault(key, value)
+
+    @app.cli.group('students')
+    def students_command():
+        """Bulk student import and export."""
+
+    @students_command.command('import')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--format', 'fmt', type=click.Choice(FORMATS), help='Defaults to the file extension.')
+    @click.option('--batch-size', type=int, default=None)
+    @click.option('--workers', type=int, default=None, help='Password hashing processes (default PASSWORD_HASH_WORKERS).')
+    def import_command(path, fmt, batch_size, workers):
+        """Import students from a CSV or JSON Lines roster."""
+        hasher = PasswordHasher(app.config['PASSWORD_HASH_METHOD'],
+                                workers=app.config['PASSWORD_HASH_WORKERS'] if workers is None else workers)
+        # No logins to protect in this process, so the import gets every hashing process
+        hasher.bulk_workers = hasher.workers
+        with open(path, 'rb') as roster:
+            report = import_students(
+                roster, _format_for(path, fmt), hasher,
+                batch_size=batch_size or app.config['STUDENT_IMPORT_BATCH_SIZE']
+            )
+        hasher.shutdown()
+        app.extensions['reference_cache'].invalidate_sections()
+        for line, message in sorted(report.errors):
+            click.echo(f'line {line}: {message}', err=True)
+        click.echo(f'Imported {report.imported} student(s), skipped {len(report.errors)} '
+                   f'in {report.elapsed:.2f}s ({report.rows_per_second:.0f} rows/s)')
+        if report.failed is not None:
+            raise click.ClickException(report.as_dict()['error'])
+
+    @students_command.command('export')
+    @click.argument('table', type=click.Choice(sorted(EXPORTS)))
+    @click.option('--format', 'fmt', type=click.Choice(FORMATS), help='Defaults to the output extension, else csv.')
+    @click.option('-o', '--output', type=click.Path(dir_okay=False), help='Write here instead of stdout.')
+    def export_command(table, fmt, output):
+        """Stream students or consultations as CSV or JSON Lines."""
+        report = ExportReport()
+        out = open(output, 'w', newline='', encoding='utf-8') if output else sys.stdout
+        try:
+            for chunk in export_rows(table, _format_for(output, fmt), report=report):
+                out.write(chunk)
+        finally:
+            if output:
+                out.close()
+        # stderr, so the summary never ends up inside an export written to stdout
+        click.echo(f'Exported {report.rows} {table} row(s) in {report.elapsed:.2f}s '
+                   f'({report.rows_per_second:.0f} rows/s)', err=True)
@@ -0,0 +1,243 @@
+"""Statistics for the teacher dashboard and statistics page.
+
+Per-teacher consultation counts live in TeacherConsultationStats. They are
+updated by a flush hook in the same transaction as the change, using
+relative UPDATEs (pending = pending + 1) so concurrent requests never
+overwrite each other. Every write path through the ORM is covered: new
+consultations, replies and mark-as-read flipping the status, and soft
+deletes. Bulk Core inserts bypass the hook, so follow them with
+reconcile_counters().
+"""
+import click
+from sqlalchemy import case, distinct, event, func, insert, inspect, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from models import db, Student, Teacher, Consultation, TeacherConsultationStats
+
+STATUSES = ('pending', 'read', 'responded')
+COUNTER_COLUMNS = ('total',) + STATUSES
+
+_DIALECT_INSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+
+def _count_where(condition):
+    """COUNT(*) FILTER (WHERE condition) that also works on SQLite"""
+    return func.coalesce(func.sum(case((condition, 1), else_=0)), 0)
+
+
+def compute_teacher_statistics(teacher):
+    """Build the statistics page data for a teacher in two grouped queries.
+
+    Returns (statistics, student_stats) in the same shape the
+    teacher_statistics.html template has always used.
+    """
+    active = Consultation.deleted == False
+
+    # Query 1: the maintained counters, with the two distinct counts riding along as scalar subqueries
+    students_with_consultations = db.session.query(func.count(distinct(Consultation.student_id))).filter(
+        Consultation.teacher_id == teacher.id,
+        active
+    ).scalar_subquery()
+    unique_sections = db.session.query(func.count(distinct(Student.section))).filter(
+        Student.grade == teacher.handling_grade,
+        Student.section == teacher.handling_section
+    ).scalar_subquery()
+
+    row = db.session.query(
+        TeacherConsultationStats.total,
+        TeacherConsultationStats.pending,
+        TeacherConsultationStats.read,
+        TeacherConsultationStats.responded,
+        students_with_consultations,
+        unique_sections
+    ).filter(TeacherConsultationStats.teacher_id == teacher.id).first()
+    if row is None:
+        # Counter row not created yet; count directly
+        counters = teacher_counters(teacher.id)
+        row = tuple(counters[column] for column in COUNTER_COLUMNS) + db.session.query(
+            students_with_consultations, unique_sections).one()
+
+    (total_consultations, pending_consultations, read_consultations,
+     responded_consultations, students_with_consultations, unique_sections) = row
+
+    # Query 2: every student in the section with their consultation count
+    per_student = db.session.query(
+        Consultation.student_id.label('student_id'),
+        func.count(Consultation.id).label('consultation_count')
+    ).filter(
+        Consultation.teacher_id == teacher.id,
+        active
+    ).group_by(Consultation.student_id).subquery()
+
+    consultation_count = func.coalesce(per_student.c.consultation_count, 0)
+    rows = db.session.query(Student, consultation_count).outerjoin(
+        per_student, per_student.c.student_id == Student.id
+    ).filter(
+        Student.grade == teacher.handling_grade,
+        Student.section == teacher.handling_section,
+        Student.archived == False
+    ).order_by(consultation_count.desc(), Student.id.asc()).all()
+
+    student_stats = [
+        {'student': student, 'consultation_count': count}
+        for student, count in rows
+    ]
+
+    total_students = len(student_stats)
+    avg_consultations = total_consultations / total_students if total_students > 0 else 0
+
+    statistics = {
+        'total_students': total_students,
+        'total_consultations': total_consultations,
+        'pending_consultations': pending_consultations,
+        'read_consultations': read_consultations,
+        'responded_consultations': responded_consultations,
+        'unique_sections': unique_sections or 0,
+        'students_with_consultations': students_with_consultations,
+        'avg_consultations': round(avg_consultations, 2),
+        'students_without_consultations': total_students - students_with_consultations,
+        'status_breakdown': {
+            'pending': pending_consultations,
+            'read': read_consultations,
+            'responded': responded_consultations
+        }
+    }
+    return statistics, student_stats
+
+
+def teacher_counters(teacher_id):
+    """Counter row for a teacher as a dict, counted from Consultation if the row is missing"""
+    stats = db.session.get(TeacherConsultationStats, teacher_id)
+    if stats is None:
+        return count_consultations(teacher_id).get(teacher_id, dict.fromkeys(COUNTER_COLUMNS, 0))
+    return {column: getattr(stats, column) for column in COUNTER_COLUMNS}
+
+
+def count_consultations(teacher_id=None, connection=None):
+    """Recount the counters from Consultation; {teacher_id: {'total': .., 'pending': .., ...}}"""
+    active = Consultation.deleted == False
+    query = select(
+        Consultation.teacher_id,
+        func.count(Consultation.id),
+        *[_count_where(active & (Consultation.status == status)) for status in STATUSES]
+    ).group_by(Consultation.teacher_id)
+    if teacher_id is not None:
+        query = query.where(Consultation.teacher_id == teacher_id)
+    rows = (connection or db.session).execute(query).all()
+    return {row[0]: dict(zip(COUNTER_COLUMNS, row[1:])) for row in rows}
+
+
+def _contribution(teacher_id, status, deleted):
+    """What one consultation adds to its teacher's counters"""
+    counts = {'total': 1}
+    if not deleted and status in STATUSES:
+        counts[status] = 1
+    return teacher_id, counts
+
+
+def _previous(state, key):
+    history = state.attrs[key].history
+    if history.deleted:
+        return history.deleted[0]
+    return history.unchanged[0] if history.unchanged else history.added[0]
+
+
+def _add(deltas, contribution, sign):
+    teacher_id, counts = contribution
+    target = deltas.setdefault(teacher_id, dict.fromkeys(COUNTER_COLUMNS, 0))
+    for column, value in counts.items():
+        target[column] += sign * value
+
+
+@event.listens_for(Session, 'after_flush')
+def _update_counters(session, flush_context):
+    deltas = {}
+    new_teachers = []
+    for obj in session.new:
+        if isinstance(obj, Consultation):
+            _add(deltas, _contribution(obj.teacher_id, obj.status, obj.deleted), 1)
+        elif isinstance(obj, Teacher):
+            new_teachers.append(obj.id)
+    for obj in session.dirty:
+        if not isinstance(obj, Consultation):
+            continue
+        state = inspect(obj)
+        if not any(state.attrs[key].history.has_changes() for key in ('teacher_id', 'status', 'deleted')):
+            continue
+        _add(deltas, _contribution(*(_previous(state, key) for key in ('teacher_id', 'status', 'deleted'))), -1)
+        _add(deltas, _contribution(obj.teacher_id, obj.status, obj.deleted), 1)
+    for obj in session.deleted:
+        if isinstance(obj, Consultation):
+            state = inspect(obj)
+            _add(deltas, _contribution(*(_previous(state, key) for key in ('teacher_id', 'status', 'deleted'))), -1)
+
+    if not deltas and not new_teachers:
+        return
+    connection = session.connection()
+    for teacher_id in new_teachers:
+        if teacher_id not in deltas:
+            connection.execute(insert(TeacherConsultationStats).values(
+                teacher_id=teacher_id, **dict.fromkeys(COUNTER_COLUMNS, 0)))
+    table = TeacherConsultationStats.__table__
+    for teacher_id, delta in deltas.items():
+        if not any(delta.values()):
+            continue
+        result = connection.execute(
+            update(table).where(table.c.teacher_id == teacher_id)
+            .values({column: table.c[column] + value for column, value in delta.items() if value})
+        )
+        if result.rowcount == 0:
+            # No row yet (teacher predates the table): count from scratch, which already sees this flush.
+            # If a concurrent transaction created the row meanwhile, its counts lack only this delta.
+            counts = count_consultations(teacher_id, connection).get(teacher_id, dict.fromkeys(COUNTER_COLUMNS, 0))
+            statement = _DIALECT_INSERTS[connection.dialect.name](table).values(teacher_id=teacher_id, **counts)
+            connection.execute(statement.on_conflict_do_update(
+                index_elements=['teacher_id'],
+                set_={column: table.c[column] + value for column, value in delta.items() if value}
+            ))
+
+
+def reconcile_counters(fix=True):
+    """Rebuild every teacher's counters from Consultation.
+
+    Returns [(teacher_id, stored, actual)] for each teacher whose stored
+    counters were wrong or missing; with fix=False nothing is written.
+    """
+    actual = count_consultations()
+    stored = {
+        stats.teacher_id: {column: getattr(stats, column) for column in COUNTER_COLUMNS}
+        for stats in TeacherConsultationStats.query.all()
+    }
+    zero = dict.fromkeys(COUNTER_COLUMNS, 0)
+    drift = []
+    for (teacher_id,) in db.session.query(Teacher.id).order_by(Teacher.id):
+        expected = actual.get(teacher_id, zero)
+        current = stored.get(teacher_id)
+        if current == expected:
+            continue
+        drift.append((teacher_id, current, expected))
+        if fix:
+            if current is None:
+                db.session.add(TeacherConsultationStats(teacher_id=teacher_id, **expected))
+            else:
+                db.session.query(TeacherConsultationStats).filter_by(teacher_id=teacher_id).update(expected)
+    if fix:
+        db.session.commit()
+    return drift
+
+
+def init_app(app):
+    @app.cli.command('reconcile-stats')
+    @click.option('--dry-run', is_flag=True, help='Report drift without rewriting the counters.')
+    def reconcile_stats_command(dry_run):
+        """Rebuild the per-teacher consultation counters and report any drift."""
+        drift = reconcile_counters(fix=not dry_run)
+        for teacher_id, stored, actual in drift:
+            if stored is None:
+                click.echo(f'teacher {teacher_id}: missing, should be {actual}')
+            else:
+                changes = ', '.join(f'{c} {stored[c]} -> {actual[c]}' for c in COUNTER_COLUMNS if stored[c] != actual[c])
+                click.echo(f'teacher {teacher_id}: {changes}')
+        verb = 'found' if dry_run else 'fixed'
+        click.echo(f'{len(drift)} teacher(s) with drift {verb}')
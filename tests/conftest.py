@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    """app.py against a scratch SQLite database, with cheap password hashing and no background threads"""
+    scratch = tmp_path_factory.mktemp('app')
+    os.environ.update({
+        'FLASK_SQLALCHEMY_DATABASE_URI': f'sqlite:///{scratch}/test.db',
+        'FLASK_UPLOAD_FOLDER': str(scratch / 'uploads'),
+        'FLASK_PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
+        'FLASK_PASSWORD_HASH_WORKERS': '0',
+        'FLASK_EMAIL_OUTBOX_IN_PROCESS': 'false',
+    })
+    from app import app
+    import migrations
+    with app.app_context():
+        migrations.upgrade()
+    return app
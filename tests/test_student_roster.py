@@ -0,0 +1,86 @@
+import io
+
+import pytest
+from sqlalchemy import insert
+
+from models import db, User, Student, Teacher, TeacherConsultationStats
+from passwords import PasswordHasher
+import student_roster
+
+HEADER = 'email,password,first_name,last_name,grade,section\n'
+
+
+@pytest.fixture
+def advocate(app):
+    with app.app_context():
+        user = User(email='advocate@example.com', password_hash='x', user_type='teacher')
+        db.session.add(user)
+        db.session.flush()
+        teacher = Teacher(user_id=user.id, first_name='Ada', last_name='Vocate', is_guidance_advocate=True)
+        db.session.add(teacher)
+        db.session.commit()
+        ids = user.id, teacher.id
+    yield ids
+    with app.app_context():
+        db.session.query(Student).delete()
+        db.session.query(TeacherConsultationStats).delete()
+        db.session.query(Teacher).delete()
+        db.session.query(User).delete()
+        db.session.commit()
+
+
+def upload(app, advocate, content, filename='roster.csv'):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'], session['user_type'] = advocate[0], 'teacher'
+    return client.post('/teacher/students/import', data={'roster': (io.BytesIO(content), filename)})
+
+
+def test_non_utf8_roster_stops_with_the_failing_line(app, advocate):
+    content = (HEADER + 'ana@example.com,secret1,Ana,Cruz,11,A\n').encode() + \
+        'jose@example.com,secret1,José,Reyes,11,A\n'.encode('latin-1')
+
+    response = upload(app, advocate, content)
+
+    assert response.status_code == 400
+    report = response.get_json()
+    assert report['failed_line'] == 3
+    assert 'line 3' in report['error']
+    assert report['imported'] == 1
+    with app.app_context():
+        assert [email for (email,) in db.session.query(User.email).filter_by(user_type='student')] == ['ana@example.com']
+
+
+def test_malformed_csv_reports_its_line(app, advocate):
+    # A stray quote swallows the rest of the file into one field, past csv's field size limit
+    content = (HEADER + 'ana@example.com,secret1,Ana,Cruz,11,A\n' + 'ben@example.com,secret1,"Ben,Uy,11,A\n'
+               + 'x' * 200000 + '\n').encode()
+
+    response = upload(app, advocate, content)
+
+    assert response.status_code == 400
+    assert response.get_json()['failed_line'] == 3
+
+
+class RacingHasher(PasswordHasher):
+    """Registers one of the batch's emails from another connection while the batch is being hashed"""
+
+    def __init__(self, email):
+        super().__init__('pbkdf2:sha256:1000', workers=0)
+        self.email = email
+
+    def hash_many(self, passwords):
+        with db.engine.begin() as connection:
+            connection.execute(insert(User).values(email=self.email, password_hash='x', user_type='student'))
+        return super().hash_many(passwords)
+
+
+def test_email_registered_during_import_skips_only_that_row(app, advocate):
+    roster = (HEADER + 'ana@example.com,secret1,Ana,Cruz,11,A\n' + 'ben@example.com,secret1,Ben,Uy,11,A\n').encode()
+
+    with app.app_context():
+        report = student_roster.import_students(io.BytesIO(roster), 'csv', RacingHasher('ben@example.com'))
+
+        assert report.imported == 1
+        assert report.errors == [(3, 'Email already registered')]
+        assert db.session.query(Student).count() == 1